@@ -0,0 +1,281 @@
+"""Batch generation of Bloom's taxonomies for many topics.
+
+Topics come from a directory (one .txt file per topic, the id is its relative
+path) or from a JSONL file (one {"id": ..., "topic": ...} object per line).
+They are sent through a pool of async workers sharing one LLM router (Groq,
+plus the other providers of settings/providers.py, see router.py), within the
+requests-per-minute and tokens-per-minute budgets, with backoff on 429s.
+Questions are validated against the Bloom schema; when a response is cut or
+malformed, its valid questions are kept and only the missing levels are asked
+again (status "partial" if some are still missing after BATCH_MAX_REPAIRS).
+Every result is appended to the output JSONL as soon as it is ready; topics
+already present there with status "ok" are skipped, so an interrupted run
+resumes where it stopped. The questions of the "ok" topics are also appended
+to the record store (record_store.py), under the course given by the first
+folder of their id.
+
+A topic close to one already generated for its course reuses its levels, and
+only the missing ones are asked to the model; generated questions close to
+one the course already has are flagged in the output ("duplicates") or dropped
+(--dedup, see near_duplicates.py).
+
+    python batch_bloom_taxonomy.py chapters/ --output taxonomies.jsonl --workers 8 --rpm 30 --tpm 6000
+
+Use --base-url to point it at a local stub server (e.g. rag/bench/fake_llm_server.py).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+from datetime import datetime
+
+import httpx
+
+from settings import models, prompts, batch, dedup
+import json_stream
+import record_store
+import near_duplicates
+import router
+from create_bloom_taxonomy import build_prompt, build_missing_levels_prompt
+
+
+def estimate_tokens(text):
+    #### ------- Rough token count (about 4 characters per token) used before the real usage is known -------###
+    return len(text) // 4 + 1
+
+
+def load_topics(source):
+    #### ------- [{"id", "topic"}] from a directory of .txt files or from a JSONL file -------###
+    topics = []
+    if os.path.isdir(source):
+        for directory, _, filenames in os.walk(source):
+            for filename in sorted(filenames):
+                if filename.endswith(".txt"):
+                    path = os.path.join(directory, filename)
+                    with open(path, 'r', encoding='utf-8') as f:
+                        topic_id = os.path.splitext(os.path.relpath(path, source))[0].replace(os.sep, "/")
+                        topics.append({"id": topic_id, "topic": f.read()})
+        return sorted(topics, key=lambda topic: topic["id"])
+
+    with open(source, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                item = json.loads(line)
+                topic = item.get("topic", item.get("The topic questions"))
+                topics.append({"id": str(item.get("id", number)), "topic": topic})
+    return topics
+
+
+def completed_ids(output):
+    #### ------- Ids already generated successfully by a previous (possibly interrupted) run -------###
+    done = set()
+    if os.path.exists(output):
+        with open(output, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # last line of a run killed while writing
+                if record.get("status") == "ok":
+                    done.add(record["id"])
+    return done
+
+
+class RateLimiter:
+    #### --------- Sliding one-minute window over both the requests and the tokens sent ------###
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque()      # [sent_at, tokens] of the requests of the last minute
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        #### ------- Waits until the request fits in both budgets; returns its window entry -------###
+        tokens = min(tokens, self.tokens_per_minute)  # a single oversized request must still go through
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                while self._window and now - self._window[0][0] >= 60:
+                    self._window.popleft()
+                used = sum(entry[1] for entry in self._window)
+                if len(self._window) < self.requests_per_minute and used + tokens <= self.tokens_per_minute:
+                    entry = [now, tokens]
+                    self._window.append(entry)
+                    return entry
+                await asyncio.sleep(60 - (now - self._window[0][0]) + 0.01)
+
+    @staticmethod
+    def settle(entry, tokens):
+        #### ------- Replaces the estimate with the usage reported by the API -------###
+        entry[1] = tokens
+
+    def pause(self, seconds):
+        #### ------- The provider said 429: nobody sends anything for a while -------###
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def backoff(attempt):
+    return batch.BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+def retry_after(error):
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+async def generate(client, limiter, prompt, model, max_retries=batch.MAX_RETRIES,
+                   completion_tokens=batch.COMPLETION_TOKENS_ESTIMATE):
+    #### ------- One completion, retried on 429, 5xx and connection errors (once every provider failed it) -------###
+    for attempt in range(max_retries + 1):
+        entry = await limiter.acquire(estimate_tokens(prompt) + completion_tokens)
+        try:
+            response = await client.complete([{"role": "user", "content": prompt}], model, temperature=None)
+        except httpx.HTTPStatusError as e:
+            if attempt == max_retries or not router.llm_router.is_retryable(e):
+                raise
+            delay = backoff(attempt)
+            if e.response.status_code == 429:
+                delay = retry_after(e) or delay
+                limiter.pause(delay)
+            await asyncio.sleep(delay)
+            continue
+        except (httpx.TransportError, router.BackendsUnavailable):
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(backoff(attempt))
+            continue
+
+        if response.get("usage"):
+            limiter.settle(entry, response["usage"]["total_tokens"])
+        return response["choices"][0]["message"]["content"]
+
+
+async def process(client, limiter, item, model, dedup_index=None, course=record_store.DEFAULT_COURSE,
+                  dedup_mode=dedup.MODE):
+    #### ------- Generates one topic; a broken response only costs a retry of its missing levels -------###
+    #### ------- The levels of a close topic already generated are reused, and new questions close to ------###
+    #### ------- those of the course are flagged or dropped (dedup_index) ------###
+    record = {"id": item["id"], "model": model, "generated_at": datetime.now().isoformat(timespec="seconds")}
+    data_json = {"The topic questions": item["topic"]}
+    collector = json_stream.TaxonomyCollector()
+    covered = {}
+    if dedup_index is not None and dedup.REUSE_TOPICS:
+        reused_from, covered = dedup_index.covered_levels(item["topic"], course)
+        if covered:
+            collector.reuse(covered)
+            record.update(reused_from=reused_from, reused_levels=[level for level in collector.levels
+                                                                  if level in covered])
+    missing = collector.missing_levels()
+    if covered:
+        prompt = build_missing_levels_prompt(data_json, prompts.BLOOM_QUESTION_GENERATION_PROMPT, missing)
+    else:
+        prompt = build_prompt(data_json, prompts.BLOOM_QUESTION_GENERATION_PROMPT)
+    try:
+        for attempt in range(batch.MAX_REPAIRS + 1):
+            if not missing:
+                break
+            text = await generate(client, limiter, prompt, model)
+            collector.start()
+            collector.feed(text)
+            collector.close()
+            missing = collector.missing_levels()
+            prompt = build_missing_levels_prompt(data_json, prompts.BLOOM_QUESTION_GENERATION_PROMPT, missing)
+    except Exception as e:
+        return {**record, "status": "error", "error": f"{type(e).__name__}: {e}"}
+
+    taxonomy = {level: questions for level, questions in collector.taxonomy.items() if questions}
+    if dedup_index is not None:
+        generated = {level: questions for level, questions in taxonomy.items() if level not in covered}
+        generated, duplicates = dedup_index.filter_taxonomy(generated, course, item["id"], dedup_mode)
+        taxonomy = {level: covered[level] if level in covered else generated[level]
+                    for level in collector.levels if level in covered or level in generated}
+        if duplicates:
+            record["duplicates"] = duplicates
+        # The levels are counted again on what is left: only a complete taxonomy is "ok" and reusable
+        missing = [level for level in collector.levels if level not in taxonomy]
+    if not missing:
+        if dedup_index is not None:
+            dedup_index.add_topic(item["topic"], taxonomy, course, item["id"])
+        return {**record, "status": "ok", "taxonomy": taxonomy}
+    return {**record, "status": "partial", "taxonomy": taxonomy, "missing": missing, "errors": collector.errors}
+
+
+def course_of(topic_id):
+    #### ------- "physique/ondes" belongs to course "physique" -------###
+    return topic_id.split("/")[0] if "/" in topic_id else record_store.DEFAULT_COURSE
+
+
+async def run_batch(topics, output, workers=batch.WORKERS, requests_per_minute=batch.REQUESTS_PER_MINUTE,
+                    tokens_per_minute=batch.TOKENS_PER_MINUTE, base_url=None, model=models.MODEL_NAME, store=None,
+                    dedup_index=None, dedup_mode=dedup.MODE):
+    done = completed_ids(output)
+    pending = [item for item in topics if item["id"] not in done]
+    print(f"{len(topics)} topics, {len(topics) - len(pending)} already done, {len(pending)} to generate")
+    if not pending:
+        return {}
+
+    client = router.get_router(base_url, model)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    queue = asyncio.Queue()
+    for item in pending:
+        queue.put_nowait(item)
+    counts = {}
+    started = time.monotonic()
+
+    with open(output, 'a', encoding='utf-8') as out:
+        async def worker():
+            while not queue.empty():
+                item = queue.get_nowait()
+                course = course_of(item["id"])
+                record = await process(client, limiter, item, model, dedup_index, course, dedup_mode)
+                # Written as soon as it is ready: a crash loses at most the topics in flight
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                if store is not None and record["status"] == "ok":
+                    store.append_taxonomy(record["taxonomy"], item["id"], course, run=record["generated_at"],
+                                          model=model)
+                counts[record["status"]] = counts.get(record["status"], 0) + 1
+                finished = sum(counts.values())
+                notes = "".join(f", {len(record[key])} {key.replace('_', ' ')}"
+                                for key in ("reused_levels", "duplicates") if record.get(key))
+                print(f"[{finished}/{len(pending)}] {item['id']}: {record['status']}{notes}"
+                      f" ({time.monotonic() - started:.1f}s)")
+
+        await asyncio.gather(*(worker() for _ in range(min(workers, len(pending)))))
+    await client.aclose()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory of .txt topics or JSONL file of {id, topic}")
+    parser.add_argument("--output", default="generated_taxonomies.jsonl")
+    parser.add_argument("--workers", type=int, default=batch.WORKERS)
+    parser.add_argument("--rpm", type=int, default=batch.REQUESTS_PER_MINUTE, help="requests per minute")
+    parser.add_argument("--tpm", type=int, default=batch.TOKENS_PER_MINUTE, help="tokens per minute")
+    parser.add_argument("--model", default=models.MODEL_NAME)
+    parser.add_argument("--base-url", default=None, help="API base URL, e.g. a local stub server")
+    parser.add_argument("--records", default=record_store.RECORDS_DIR, help="record store directory")
+    parser.add_argument("--no-records", action="store_true", help="only write the output JSONL")
+    parser.add_argument("--dedup", default=dedup.MODE, choices=["off", "flag", "drop"],
+                        help="questions close to one already generated for the course")
+    parser.add_argument("--dedup-dir", default=near_duplicates.DEDUP_DIR, help="near-duplicate index directory")
+    args = parser.parse_args()
+
+    store = None if args.no_records else record_store.RecordStore(args.records)
+    dedup_index = None if args.dedup == "off" else near_duplicates.DedupIndex(args.dedup_dir)
+    counts = asyncio.run(run_batch(load_topics(args.source), args.output, args.workers, args.rpm, args.tpm,
+                                   args.base_url, args.model, store, dedup_index, args.dedup))
+    print(f"Done: {counts}. Results appended to '{args.output}'.")
+    sys.exit(1 if counts.get("error") else 0)
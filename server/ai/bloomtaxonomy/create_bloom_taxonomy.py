@@ -1,19 +1,68 @@
-from groq import Groq
-from settings import api, models, prompts
-import json
+from settings import models, prompts
+import re
 from datetime import datetime
+import json_stream
+import record_store
+import near_duplicates
+import router
 
 Bloom_prompt = prompts.BLOOM_QUESTION_GENERATION_PROMPT
 
-def get_response_from_llm(data_json, prompt):
-    client = Groq(api_key=api.GROQ_API_KEY)
-    prompt = str(data_json)  + prompt # Get next prompt from the cycle
+def build_prompt(data_json, prompt):
+    return str(data_json)  + prompt # Get next prompt from the cycle
+
+# Function to extract JSON from within code blocks
+def extract_json_from_story(story_text):
+    # Regex to find JSON within ```json ... ```
+    json_pattern = r"```json\s*(\{.*?\})\s*```"
+    match = re.search(json_pattern, story_text, re.DOTALL)
+    if match:
+        return match.group(1)
+    # If not found, try to find JSON within ```
+    json_pattern_generic = r"```\s*(\{.*?\})\s*```"
+    match = re.search(json_pattern_generic, story_text, re.DOTALL)
+    if match:
+        return match.group(1)
+    # If no code blocks, assume entire response is JSON
+    return story_text.strip()
+
+def build_missing_levels_prompt(data_json, prompt, levels):
+    # Retry of a broken generation: only the levels that are still missing
+    return build_prompt(data_json, prompt) + f"""
+Only generate the following levels: {", ".join(levels)}. Return a JSON object with exactly these keys."""
+
+def stream_response_from_llm(request):
+    # Yields the response text to a full prompt piece by piece as the model generates it,
+    # from whichever provider sent its first token first (router.py)
+    yield from router.get_router().stream_chat_sync([{"role": "user", "content": request}], temperature=None)
+
+def generate_taxonomy(data_json, prompt, on_question=None, max_retries=2, reused=None):
+    # Streams the taxonomy, validating every question as soon as it is complete; if the
+    # response breaks, the valid questions are kept and only the missing levels are asked again.
+    # The levels in `reused` ({level: questions} of a close topic) are not asked at all
+    collector = json_stream.TaxonomyCollector()
+    request = build_prompt(data_json, prompt)
+    if reused:
+        collector.reuse(reused)
+        request = build_missing_levels_prompt(data_json, prompt, collector.missing_levels())
+    for attempt in range(max_retries + 1):
+        if not collector.missing_levels():
+            break
+        collector.start()
+        for piece in stream_response_from_llm(request):
+            for level, question in collector.feed(piece):
+                if on_question is not None:
+                    on_question(level, question)
+        collector.close()
+        missing = collector.missing_levels()
+        if not missing:
+            break
+        request = build_missing_levels_prompt(data_json, prompt, missing)
+    return collector
 
-    response = client.chat.completions.create(
-        messages=[{"role": "user", "content": prompt}],
-        model=models.MODEL_NAME
-    )
-    return response.choices[0].message.content
+def get_response_from_llm(data_json, prompt):
+    prompt = build_prompt(data_json, prompt)
+    return router.get_router().chat_sync([{"role": "user", "content": prompt}], temperature=None)
 
 
 if __name__ == '__main__':
@@ -43,40 +92,38 @@ Exercice 5 : Calcul de la Vitesse et du Retard
     En utilisant la relation V=dΔtV=Δtd​, calculez la célérité d’une onde si la distance parcourue est de 340 mètres et le temps pris est de 1 seconde.
     Si le retard ττ est la différence de temps pour que l'onde atteigne deux points différents dans le milieu, comment calculeriez-vous le retard entre deux points situés à 170 mètres l'un de l'autre, si la vitesse de l'onde est de 340 m/s ?""",
     }
-    bloom = get_response_from_llm(json_data, prompt)
-    print(bloom)
-# Parse the response and save to JSON file with a unique name based on current date and time
-    try:
-        # Function to extract JSON from within code blocks
-        def extract_json_from_story(story_text):
-            import re
-            # Regex to find JSON within ```json ... ```
-            json_pattern = r"```json\s*(\{.*?\})\s*```"
-            match = re.search(json_pattern, story_text, re.DOTALL)
-            if match:
-                return match.group(1)
-            # If not found, try to find JSON within ```
-            json_pattern_generic = r"```\s*(\{.*?\})\s*```"
-            match = re.search(json_pattern_generic, story_text, re.DOTALL)
-            if match:
-                return match.group(1)
-            # If no code blocks, assume entire response is JSON
-            return story_text.strip()
-
-        # Extract JSON string
-        json_str = extract_json_from_story(bloom)
-
-        # Parse the JSON string
-        generated_json = json.loads(json_str)
-
-        # Get current date and time for unique filename
-        current_datetime = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"generated_taxonomy_{current_datetime}.json"
-
-        # Save the JSON to the file
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(generated_json, f, ensure_ascii=False, indent=2)
-
-        print(f"Generated taxonomy questions have been saved to '{filename}'.")
-    except json.JSONDecodeError:
-        print("Failed to parse the LLM response as JSON. Please ensure the response is in valid JSON format.")
+    # Levels already generated for a close topic are reused instead of asked again
+    dedup_index = near_duplicates.DedupIndex()
+    topic = json_data["The topic questions"].strip().splitlines()[0].strip()
+    reused_from, reused = dedup_index.covered_levels(json_data["The topic questions"])
+    if reused:
+        print(f"Reusing the levels {list(reused)} of '{reused_from}'")
+    collector = generate_taxonomy(
+        json_data, prompt,
+        on_question=lambda level, question: print(f"[{level}] {question['id']}: {question['question']}"),
+        reused=reused,
+    )
+    missing = collector.missing_levels()
+    if missing:
+        print(f"Could not generate the levels {missing}: {collector.errors}")
+
+    # Questions close to one already generated are flagged (or dropped, DEDUP_MODE=drop)
+    generated = {level: questions for level, questions in collector.taxonomy.items()
+                 if questions and level not in reused}
+    generated, duplicates = dedup_index.filter_taxonomy(generated, topic=topic)
+    for duplicate in duplicates:
+        print(f"Near-duplicate [{duplicate['level']}] {duplicate['question']} ~ "
+              f"{duplicate['duplicate_of']['question']} ({duplicate['duplicate_of']['topic']})")
+    generated_json = {level: reused.get(level) or generated[level] for level in collector.levels
+                      if level in reused or level in generated}
+    # Only a complete taxonomy, counted after deduplication, is reused for close topics
+    missing = [level for level in collector.levels if level not in generated_json]
+    if not missing:
+        dedup_index.add_topic(json_data["The topic questions"], generated_json, topic=topic)
+
+    # Append the questions to the record store, under the first line of the topic
+    run = datetime.now().strftime("%Y%m%d_%H%M%S")
+    store = record_store.RecordStore()
+    count = store.append_taxonomy(generated_json, topic, run=run, model=models.MODEL_NAME)
+
+    print(f"{count} generated taxonomy questions have been saved to '{store.root}' (run {run}).")
@@ -0,0 +1,361 @@
+"""Batch grading of the student answers in the record store.
+
+Every answer of the selected submissions is graded once and the grades are
+appended to the record store ("grades" rows, scores from 0 to 1):
+
+  blank  empty answers score 0
+  mcq    multiple-choice questions of a taxonomy (the record store's questions
+         or --key files) are checked against their answer; a letter or option
+         number ("b", "2)") counts as the option it designates
+  exact  questions with a key answer but no options: same text, or same number
+         (within NUMERIC_TOLERANCE) and unit
+  llm    everything else is graded by the model, several answers per prompt
+         (grouped by question, within GRADING_PROMPT_TOKENS), by a pool of
+         workers within the rate limits of settings/batch.py; identical
+         answers to the same question are graded once
+
+The first three are scored locally, as whole arrays, without any API call.
+Answers already graded are skipped (--regrade grades them again, the older
+grades stay in the store). The report gives the mean score per student and
+level, the count per method and the cost of the run.
+
+    python grade_answers.py --course physique --key generated_taxonomy_20241128_023527.json --report grades.json
+
+Use --base-url to point it at a local stub server (e.g. rag/bench/fake_llm_server.py).
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import unicodedata
+
+import numpy as np
+
+from settings import models, prompts, batch, grading
+import record_store
+import router
+from batch_bloom_taxonomy import RateLimiter, generate, estimate_tokens
+from create_bloom_taxonomy import extract_json_from_story
+
+NUMBER = re.compile(r"^([-+]?\d+(?:[.,]\d+)?(?:e[-+]?\d+)?)\s*(.*)$")
+CHOICE = re.compile(r"^\(?([a-z]|\d{1,2})\s*[).:]?(?:\s+(.*))?$")
+
+
+## ------------------ Answer key and local scoring --------------###
+
+def normalize_answer(text):
+    #### ------- Case, accents, spacing and trailing punctuation do not change an answer -------###
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return " ".join(text.split()).strip(" .;!?\"'")
+
+
+def resolve_choice(answer, options):
+    #### ------- Normalized option an MCQ answer designates by text, letter or number ("b", "2)", "b) sound") -------###
+    options = [normalize_answer(option) for option in options]
+    if answer in options:
+        return answer
+    match = CHOICE.match(answer)
+    if match:
+        label, rest = match.groups()
+        index = int(label) - 1 if label.isdigit() else ord(label) - ord("a")
+        if 0 <= index < len(options) and (not rest or rest == options[index]):
+            return options[index]
+    return answer
+
+
+def split_number(text):
+    #### ------- (value, unit) of a numeric answer ("340 m/s" -> (340.0, "m/s")), (nan, "") otherwise -------###
+    match = NUMBER.match(text)
+    if not match:
+        return float("nan"), ""
+    return float(match.group(1).replace(",", ".")), match.group(2).replace(" ", "")
+
+
+def key_entry(question_type, answer, options):
+    #### ------- Key of a question, or None when it cannot be checked locally (no answer, or an MCQ ------###
+    #### ------- whose answer is not one of its options: the model grades those) ------###
+    if not answer:
+        return None
+    if options and normalize_answer(answer) not in [normalize_answer(option) for option in options]:
+        return None
+    return {"type": question_type, "answer": answer, "options": options}
+
+
+def load_key(store, course=None, files=()):
+    #### ------- normalized question -> {"type", "answer", "options"} of the questions scored locally -------###
+    key = {}
+    filters = {"course": course} if course else {}
+    for row in store.rows("questions", ["question", "type", "options", "answer"], **filters):
+        entry = key_entry(row["type"], row["answer"], json.loads(row["options"] or "null"))
+        if entry is not None:
+            key[normalize_answer(row["question"])] = entry
+    for path in files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for questions in json.load(f).values():
+                for question in questions:
+                    entry = key_entry(question.get("type"), question.get("answer"), question.get("options"))
+                    if entry is not None:
+                        key[normalize_answer(question.get("question"))] = entry
+    return key
+
+
+def score_keyed(given, expected, is_mcq, tolerance=grading.NUMERIC_TOLERANCE):
+    #### ------- 0/1 scores of normalized answers against normalized keys, compared as whole arrays; ------###
+    #### ------- numbers are compared with a relative tolerance (and their units) except for MCQs ------###
+    given = np.asarray(given, dtype=object)
+    expected = np.asarray(expected, dtype=object)
+    is_mcq = np.asarray(is_mcq, dtype=bool)
+    correct = given == expected
+    # Numbers are parsed once per distinct string, not once per answer
+    strings, inverse = np.unique(np.concatenate([given, expected]).astype(str), return_inverse=True)
+    parsed = [split_number(string) for string in strings]
+    values = np.array([value for value, _ in parsed])[inverse].reshape(2, -1)
+    units = np.array([unit for _, unit in parsed], dtype=object)[inverse].reshape(2, -1)
+    with np.errstate(invalid="ignore"):
+        close = np.isclose(values[0], values[1], rtol=tolerance, atol=0.0)
+    same_unit = (units[0] == units[1]) | (units[1] == "")
+    return (correct | (~is_mcq & close & same_unit)).astype(np.float64)
+
+
+## ------------------ Open answers graded by the model --------------###
+
+def pack_prompts(items, prompt_tokens=grading.PROMPT_TOKENS, max_answers=grading.MAX_ANSWERS_PER_PROMPT):
+    #### ------- Groups the answers ({"id", "level", "question", "answer"}) into packs that fit one prompt; ------###
+    #### ------- answers to the same question go together so the question is sent once per pack ------###
+    budget = prompt_tokens - estimate_tokens(prompts.GRADING_PROMPT)
+    packs, pack, used, question = [], [], 0, None
+    for item in sorted(items, key=lambda item: (item["question"], item["level"], item["id"])):
+        group = (item["question"], item["level"])
+        answer_cost = estimate_tokens(item["answer"]) + 8
+        question_cost = estimate_tokens(item["question"]) + 12
+        cost = answer_cost + (question_cost if group != question else 0)
+        if pack and (len(pack) >= max_answers or used + cost > budget):
+            packs.append(pack)
+            # A new pack sends its question again
+            pack, used, cost = [], 0, answer_cost + question_cost
+        pack.append(item)
+        used += cost
+        question = group
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def render_prompt(pack):
+    questions = {}
+    for item in pack:
+        entry = questions.setdefault((item["question"], item["level"]),
+                                     {"question": item["question"], "level": item["level"], "answers": []})
+        entry["answers"].append({"id": item["id"], "answer": item["answer"]})
+    return prompts.GRADING_PROMPT + json.dumps({"questions": list(questions.values())}, ensure_ascii=False)
+
+
+def parse_grades(text, ids):
+    #### ------- {id: (score from 0 to 1, feedback)} of the valid grades of a response, the others left out -------###
+    try:
+        data = json.loads(extract_json_from_story(text))
+    except (json.JSONDecodeError, TypeError):
+        return {}
+    entries = data.get("grades", []) if isinstance(data, dict) else data
+    grades = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            answer_id, score = int(entry.get("id")), float(entry.get("score"))
+        except (TypeError, ValueError):
+            continue
+        if answer_id in ids and 0 <= score <= grading.MAX_SCORE:
+            grades[answer_id] = (score / grading.MAX_SCORE, str(entry.get("feedback") or ""))
+    return grades
+
+
+async def grade_open(items, base_url=None, model=models.MODEL_NAME, workers=grading.WORKERS,
+                     requests_per_minute=batch.REQUESTS_PER_MINUTE, tokens_per_minute=batch.TOKENS_PER_MINUTE,
+                     prompt_tokens=grading.PROMPT_TOKENS, max_answers=grading.MAX_ANSWERS_PER_PROMPT):
+    #### ------- Grades the open answers: ({id: (score, feedback)}, {"calls", "prompt_tokens", "errors"}) ------###
+    #### ------- Answers a response left out are sent again (MAX_REPAIRS times), in packs of their own ------###
+    grades = {}
+    cost = {"calls": 0, "prompt_tokens": 0, "errors": 0}
+    if not items:
+        return grades, cost
+    client = router.get_router(base_url, model)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    queue = asyncio.Queue()
+    for pack in pack_prompts(items, prompt_tokens, max_answers):
+        queue.put_nowait((pack, 0))
+
+    async def worker():
+        while True:
+            pack, attempt = await queue.get()
+            try:
+                prompt = render_prompt(pack)
+                cost["calls"] += 1
+                cost["prompt_tokens"] += estimate_tokens(prompt)
+                try:
+                    text = await generate(client, limiter, prompt, model,
+                                          completion_tokens=grading.COMPLETION_TOKENS_PER_ANSWER * len(pack))
+                except Exception as e:
+                    cost["errors"] += 1
+                    print(f"Grading request failed: {type(e).__name__}: {e}", file=sys.stderr)
+                    continue
+                grades.update(parse_grades(text, {item["id"] for item in pack}))
+                missing = [item for item in pack if item["id"] not in grades]
+                if missing and attempt < grading.MAX_REPAIRS:
+                    for repair in pack_prompts(missing, prompt_tokens, max_answers):
+                        queue.put_nowait((repair, attempt + 1))
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.aclose()
+    return grades, cost
+
+
+## ------------------ One run over a class --------------###
+
+def answer_key(row):
+    return (row["submission"], row["level"], row["original_question"], row["question"])
+
+
+def pending_answers(store, regrade=False, **filters):
+    #### ------- Answer rows of the selected submissions that have no grade yet (all of them with regrade) -------###
+    graded = set()
+    if not regrade:
+        graded = {answer_key(row) for row in store.rows(
+            "grades", ["submission", "level", "original_question", "question"], **filters)}
+    return [row for row in store.rows("answers", **filters) if answer_key(row) not in graded]
+
+
+def build_report(grades):
+    #### ------- Mean score per student and level, counts per method -------###
+    students, levels, methods = {}, {}, {}
+    for grade in grades:
+        methods[grade["method"]] = methods.get(grade["method"], 0) + 1
+        for table, key in ((students.setdefault(grade["student"], {}), grade["level"]),
+                           (levels, grade["level"])):
+            entry = table.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += grade["score"]
+
+    def mean(table):
+        return {key: {"graded": count, "mean_score": total / count} for key, (count, total) in sorted(table.items())}
+
+    return {"students": {student: mean(table) for student, table in sorted(students.items())},
+            "levels": mean(levels), "methods": methods}
+
+
+def run_grading(store, course=None, topic=None, key_files=(), regrade=False, base_url=None, model=models.MODEL_NAME,
+                workers=grading.WORKERS, requests_per_minute=batch.REQUESTS_PER_MINUTE,
+                tokens_per_minute=batch.TOKENS_PER_MINUTE, prompt_tokens=grading.PROMPT_TOKENS,
+                max_answers=grading.MAX_ANSWERS_PER_PROMPT):
+    #### ------- Grades every pending answer of the course/topic, stores the grades, returns the report -------###
+    started = time.perf_counter()
+    filters = {column: value for column, value in (("course", course), ("topic", topic)) if value}
+    rows = pending_answers(store, regrade, **filters)
+    key = load_key(store, course, key_files)
+    run = uuid.uuid4().hex
+    scores = np.zeros(len(rows))
+    methods = np.empty(len(rows), dtype=object)
+    feedback = [None] * len(rows)
+
+    # Local fast path: blank and keyed answers, scored as arrays
+    answers = [normalize_answer(row["answer"]) for row in rows]
+    methods[:] = "llm"
+    keyed, given, expected, is_mcq = [], [], [], []
+    for i, (row, answer) in enumerate(zip(rows, answers)):
+        if not answer:
+            methods[i] = "blank"
+            continue
+        entry = key.get(normalize_answer(row["question"]))
+        if entry is None:
+            continue
+        options = entry["options"] or []
+        keyed.append(i)
+        is_mcq.append(bool(options))
+        given.append(resolve_choice(answer, options) if options else answer)
+        expected.append(normalize_answer(entry["answer"]))
+        methods[i] = "mcq" if options else "exact"
+    if keyed:
+        scores[keyed] = score_keyed(given, expected, is_mcq)
+    local_seconds = time.perf_counter() - started
+
+    # The rest goes to the model, once per distinct (question, level, answer)
+    items, rows_of = [], {}
+    for i in np.flatnonzero(methods == "llm"):
+        row = rows[i]
+        distinct = (row["question"], row["level"], answers[i])
+        if distinct not in rows_of:
+            rows_of[distinct] = []
+            items.append({"id": len(items), "level": row["level"], "question": row["question"] or "",
+                          "answer": row["answer"].strip()[:grading.MAX_ANSWER_CHARS]})
+        rows_of[distinct].append(i)
+    llm_grades, cost = asyncio.run(grade_open(items, base_url, model, workers, requests_per_minute,
+                                              tokens_per_minute, prompt_tokens, max_answers))
+    ungraded = 0
+    for item, indexes in zip(items, rows_of.values()):
+        if item["id"] not in llm_grades:
+            ungraded += len(indexes)
+            methods[indexes] = None  # not stored: graded by the next run
+            continue
+        score, text = llm_grades[item["id"]]
+        scores[indexes] = score
+        for i in indexes:
+            feedback[i] = text
+
+    created = time.time()
+    grades = [{"created": created, "run": run, "model": model if methods[i] == "llm" else None,
+               "submission": row["submission"], "course": row["course"], "topic": row["topic"],
+               "student": row["student"], "level": row["level"], "original_question": row["original_question"],
+               "question": row["question"], "method": methods[i], "score": float(scores[i]), "feedback": feedback[i]}
+              for i, row in enumerate(rows) if methods[i] is not None]
+    store.append("grades", grades)
+
+    seconds = time.perf_counter() - started
+    return {"run": run, "answers": len(rows), "graded": len(grades), "ungraded": ungraded,
+            "submissions": len({row["submission"] for row in rows}), "llm_answers": len(items),
+            **cost, "local_seconds": local_seconds, "seconds": seconds,
+            "answers_per_second": len(grades) / seconds if seconds else 0.0, **build_report(grades)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--course", default=None, help="grade only this course")
+    parser.add_argument("--topic", default=None, help="grade only this topic (uploaded file)")
+    parser.add_argument("--key", nargs="*", default=[], help="taxonomy JSON files with the MCQ/exact answers")
+    parser.add_argument("--regrade", action="store_true", help="grade the answers already graded again")
+    parser.add_argument("--workers", type=int, default=grading.WORKERS)
+    parser.add_argument("--rpm", type=int, default=batch.REQUESTS_PER_MINUTE, help="requests per minute")
+    parser.add_argument("--tpm", type=int, default=batch.TOKENS_PER_MINUTE, help="tokens per minute")
+    parser.add_argument("--answers-per-prompt", type=int, default=grading.MAX_ANSWERS_PER_PROMPT)
+    parser.add_argument("--model", default=models.MODEL_NAME)
+    parser.add_argument("--base-url", default=None, help="API base URL, e.g. a local stub server")
+    parser.add_argument("--records", default=record_store.RECORDS_DIR, help="record store directory")
+    parser.add_argument("--report", default=None, help="write the full report (JSON) to this file")
+    args = parser.parse_args()
+
+    report = run_grading(record_store.RecordStore(args.records), args.course, args.topic, args.key, args.regrade,
+                         args.base_url, args.model, args.workers, args.rpm, args.tpm,
+                         max_answers=args.answers_per_prompt)
+    levels = list(report["levels"])
+    print(f"{'student':<20}" + "".join(f"{level:>11}" for level in levels))
+    for student, by_level in report["students"].items():
+        print(f"{student:<20}" + "".join(f"{by_level[level]['mean_score']:>11.2f}" if level in by_level
+                                         else f"{'-':>11}" for level in levels))
+    print(f"{report['graded']}/{report['answers']} answers of {report['submissions']} submissions graded "
+          f"in {report['seconds']:.1f}s: {report['methods']}, {report['calls']} LLM calls "
+          f"for {report['llm_answers']} distinct open answers")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if report["ungraded"] else 0)
@@ -0,0 +1,280 @@
+import re
+import json
+
+# Bloom's Taxonomy levels, in order, and the shape of the generated questions
+BLOOM_LEVELS = ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]
+QUESTION_TYPES = {"multiple-choice", "short-answer", "essay"}
+
+_STRING_BODY = re.compile(r'[^"\\]+')
+_SCALAR = re.compile(r'[-+.0-9a-zA-Z]+')  # numbers, true, false, null
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+## ------------------ Incremental JSON parser for streamed LLM output --------------###
+
+class JsonStreamParser:
+    #### --------- Fed the response piece by piece, returns every value whose path has one of `depths` ------###
+    #### --------- elements as soon as it closes, e.g. ("Remember", 0) for the first Remember question. ------###
+    #### --------- Text before the root value (prose, ```json fences) and after it is ignored. A { or [ in the ------###
+    #### --------- prose ("Sure [see below]: {...}") starts a tentative root: until its first key and colon ------###
+    #### --------- (or first item and comma) are read, a parse error only means it was prose, and the search ------###
+    #### --------- goes on after it ------###
+
+    def __init__(self, depths=(2,)):
+        self.depths = set(depths)
+        self.root = None            # the whole document, once it is complete
+        self.error = None           # JsonStreamError once the input is broken; nothing is parsed after it
+        self.done = False
+        self._stack = []            # open containers: {"value", "path", "key", "state"}
+        self._token = None          # string or scalar being read, None between tokens
+        self._in_string = False
+        self._string_is_key = False
+        self._escape = False
+        self._offset = 0            # characters consumed so far, for error messages
+        self._committed = False     # the root has a first key and colon (item and comma): it is the document
+        self._root_offset = 0       # where the tentative root opened
+        self._pending = ""          # text from the tentative root on, parsed again if it turns out to be prose
+        self._pending_start = 0
+        self._held = []             # events of the tentative root, returned once it is committed
+
+    def feed(self, text):
+        #### ------- Returns [(path, value)] of the values completed by this piece of text -------###
+        events = []
+        while not self.done and self.error is None:
+            try:
+                self._parse(text, events)
+                break
+            except JsonStreamError as e:
+                if self._committed or not self._stack:
+                    self.error = e
+                    break
+                # Prose that looked like the start of the document: the search resumes after its { or [
+                text, self._offset = self._pending[1:], self._root_offset + 1
+                self._stack, self._token, self._pending, self._held = [], None, "", []
+                self._in_string = self._escape = False
+        return events
+
+    def close(self):
+        #### ------- End of the response: a document that is still open is an error -------###
+        if not self.done and self.error is None:
+            self.error = JsonStreamError(f"truncated JSON after {self._offset} characters")
+        return self.root
+
+    def _fail(self, message, i):
+        raise JsonStreamError(f"{message} at character {self._offset + i}")
+
+    def _parse(self, text, events):
+        self._pending_start = 0     # where the tentative root opened in this piece of text
+        try:
+            self._parse_text(text, events)
+        finally:
+            if self._stack and not self._committed:
+                self._pending += text[self._pending_start:]
+
+    def _parse_text(self, text, events):
+        i, n = 0, len(text)
+        while i < n and not self.done:
+            if self._in_string:
+                i = self._read_string(text, i, events)
+                continue
+            if self._token is not None:
+                match = _SCALAR.match(text, i)
+                if match:
+                    self._token += match.group()
+                    i = match.end()
+                    continue
+                self._finish_scalar(i, events)
+                continue
+
+            c = text[i]
+            if not self._stack:
+                if c in "{[":
+                    self._open(c)
+                    self._pending_start, self._root_offset, self._pending = i, self._offset + i, ""
+                i += 1
+                continue
+            if c.isspace():
+                i += 1
+                continue
+
+            frame = self._stack[-1]
+            state = frame["state"]
+            expects_value = state in ("value", "value_or_end")
+            if c in "{[" and expects_value:
+                self._open(c)
+            elif c == "}" and isinstance(frame["value"], dict) and state in ("key_or_end", "comma_or_end"):
+                self._close(events)
+            elif c == "]" and isinstance(frame["value"], list) and state in ("value_or_end", "comma_or_end"):
+                self._close(events)
+            elif c == "," and state == "comma_or_end":
+                frame["state"] = "key" if isinstance(frame["value"], dict) else "value"
+                self._commit(events)
+            elif c == ":" and state == "colon":
+                frame["state"] = "value"
+                self._commit(events)
+            elif c == '"' and (expects_value or state in ("key", "key_or_end")):
+                self._string_is_key = not expects_value
+                self._in_string = True
+                self._token = ""
+            elif c in "-0123456789tfn" and expects_value:
+                self._token = c
+            else:
+                self._fail(f"unexpected {c!r}", i)
+            i += 1
+        self._offset += n
+
+    def _read_string(self, text, i, events):
+        if self._escape:
+            self._token += text[i]
+            self._escape = False
+            return i + 1
+        match = _STRING_BODY.match(text, i)
+        if match:
+            self._token += match.group()
+            return match.end()
+        if text[i] == "\\":
+            self._token += "\\"
+            self._escape = True
+            return i + 1
+        # closing quote
+        try:
+            value = json.loads('"' + self._token + '"')
+        except json.JSONDecodeError:
+            self._fail("invalid string", i)
+        self._token = None
+        self._in_string = False
+        frame = self._stack[-1]
+        if self._string_is_key:
+            frame["key"] = value
+            frame["state"] = "colon"
+        else:
+            self._add(value, events)
+        return i + 1
+
+    def _finish_scalar(self, i, events):
+        try:
+            value = json.loads(self._token)
+        except json.JSONDecodeError:
+            self._fail(f"invalid value {self._token!r}", i)
+        self._token = None
+        self._add(value, events)
+
+    def _commit(self, events):
+        if len(self._stack) == 1 and not self._committed:
+            self._committed = True
+            self._pending = ""
+            events.extend(self._held)
+            self._held = []
+
+    def _child_path(self):
+        frame = self._stack[-1]
+        key = frame["key"] if isinstance(frame["value"], dict) else len(frame["value"])
+        return frame["path"] + (key,)
+
+    def _open(self, c):
+        path = self._child_path() if self._stack else ()
+        if c == "{":
+            self._stack.append({"value": {}, "path": path, "key": None, "state": "key_or_end"})
+        else:
+            self._stack.append({"value": [], "path": path, "key": None, "state": "value_or_end"})
+
+    def _close(self, events):
+        frame = self._stack.pop()
+        if not self._stack:
+            self.root = frame["value"]
+            self.done = True
+            events.extend(self._held)
+            self._held = []
+        else:
+            self._add(frame["value"], events)
+
+    def _add(self, value, events):
+        #### ------- Containers join their parent only once closed: a broken tail never leaks half a value -------###
+        path = self._child_path()
+        frame = self._stack[-1]
+        if isinstance(frame["value"], dict):
+            frame["value"][frame["key"]] = value
+        else:
+            frame["value"].append(value)
+        frame["state"] = "comma_or_end"
+        if len(path) in self.depths:
+            (events if self._committed else self._held).append((path, value))
+
+
+## ------------------ Bloom schema --------------###
+
+def is_valid_item(item):
+    #### ------- {"id", "type", "question"} plus options/answer for multiple-choice questions -------###
+    if not isinstance(item, dict):
+        return False
+    if not all(isinstance(item.get(key), str) and item[key].strip() for key in ("id", "type", "question")):
+        return False
+    if item["type"] not in QUESTION_TYPES:
+        return False
+    if item["type"] == "multiple-choice":
+        options = item.get("options")
+        return (isinstance(options, list) and len(options) >= 2 and all(isinstance(o, str) for o in options)
+                and item.get("answer") in options)
+    return True
+
+
+def is_valid_level_question(value):
+    #### ------- One aligned question of the Streamlit transformer: a non-empty string -------###
+    return isinstance(value, str) and bool(value.strip()) and value.strip() != "N/A"
+
+
+class TaxonomyCollector:
+    #### --------- Builds a {level: [questions]} taxonomy from one or more streamed responses. Each question ------###
+    #### --------- is validated as soon as it closes and kept even if the rest of the response is broken, ------###
+    #### --------- so a retry only has to ask for the levels still missing ------###
+
+    def __init__(self, levels=BLOOM_LEVELS):
+        self.levels = list(levels)
+        self.taxonomy = {level: [] for level in self.levels}
+        self.closed = set()         # levels whose list was received in full at least once
+        self.rejected = []          # (path, value) of the questions that failed validation
+        self.errors = []            # parse errors of the responses seen so far
+        self.parser = None
+        self.start()
+
+    def reuse(self, taxonomy):
+        #### ------- Takes the levels of a taxonomy already generated; they count as received -------###
+        for level, questions in taxonomy.items():
+            if level in self.taxonomy and questions:
+                self.taxonomy[level] = list(questions)
+                self.closed.add(level)
+
+    def start(self):
+        #### ------- Begins a new response (a first generation or a retry of the missing levels) -------###
+        self.parser = JsonStreamParser(depths=(1, 2))
+
+    def feed(self, text):
+        #### ------- Returns [(level, question)] of the valid questions completed by this piece of text -------###
+        accepted = []
+        for path, value in self.parser.feed(text):
+            level = path[0]
+            if level not in self.taxonomy:
+                continue
+            if len(path) == 1:
+                if isinstance(value, list):
+                    self.closed.add(level)
+                continue
+            ids = {item["id"] for item in self.taxonomy[level]}
+            if is_valid_item(value) and value["id"] not in ids:
+                self.taxonomy[level].append(value)
+                accepted.append((level, value))
+            else:
+                self.rejected.append((path, value))
+        return accepted
+
+    def close(self):
+        self.parser.close()
+        if self.parser.error is not None:
+            self.errors.append(str(self.parser.error))
+
+    def missing_levels(self):
+        #### ------- Levels never received in full, or without a single valid question -------###
+        return [level for level in self.levels if level not in self.closed or not self.taxonomy[level]]
@@ -0,0 +1,347 @@
+"""Near-duplicate detection of generated questions and topics (MinHash + LSH).
+
+Every question is cut into character shingles and summarized by a MinHash
+signature, whose agreement with another signature estimates the Jaccard
+similarity of their shingles. The signatures are cut into bands; two texts
+become candidates when they agree on a whole band, found with one binary
+search per band in the sorted band keys, so a lookup only compares the
+signature with a few candidates whatever the size of the index.
+
+Two indexes are kept next to the records (DEDUP_DIR, records/dedup/ by
+default), each as an append-only file of signatures plus one JSON line per
+text:
+
+  questions  generated questions; new ones close to a question of the same
+             course are flagged or dropped (DEDUP_MODE)
+  topics     the topics already generated, with their taxonomy; a topic close
+             to one of them reuses its levels, and only the missing levels
+             are asked to the model
+
+    python near_duplicates.py import generated_taxonomy_*.json --course physique
+    python near_duplicates.py query "What is an example of a mechanical wave?" --course physique
+    python near_duplicates.py stats
+"""
+import os
+import json
+import zlib
+import fcntl
+import argparse
+import unicodedata
+
+import numpy as np
+
+from settings import dedup
+import record_store
+
+DEDUP_DIR = os.getenv('DEDUP_DIR', os.path.join(record_store.RECORDS_DIR, "dedup"))
+
+# Universal hashing modulo a prime above 2**32: (a * x + b) % PRIME with a < 2**31 never overflows 64 bits
+PRIME = np.uint64((1 << 32) + 15)
+
+
+def normalize_text(text):
+    #### ------- Case, accents, punctuation and spacing do not make two questions different -------###
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c if c.isalnum() else " " for c in text if not unicodedata.combining(c)).casefold()
+    return " ".join(text.split())
+
+
+def shingles(text, size=dedup.SHINGLE_CHARS):
+    #### ------- Hashes (uint64) of the distinct `size`-character shingles of the normalized text -------###
+    text = normalize_text(text)
+    pieces = {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+    return np.fromiter((zlib.crc32(piece.encode('utf-8')) for piece in pieces), dtype=np.uint64, count=len(pieces))
+
+
+class MinHashLSH:
+    #### --------- Append-only MinHash/LSH index of texts with a JSON payload each, persisted in a directory ------###
+    #### --------- (meta.json, signatures.bin, payloads.jsonl). Several processes may append to it: ------###
+    #### --------- writes hold a file lock and every lookup first reads what the others appended (one stat()) ------###
+
+    def __init__(self, directory, num_perm=dedup.NUM_PERM, bands=dedup.BANDS, shingle_chars=dedup.SHINGLE_CHARS,
+                 seed=dedup.SEED):
+        if num_perm % bands:
+            raise ValueError(f"{num_perm} hashes cannot be cut into {bands} bands")
+        self.directory = directory
+        self.meta = {"num_perm": num_perm, "bands": bands, "shingle_chars": shingle_chars, "seed": seed}
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored != self.meta:
+                raise ValueError(f"{directory} was built with {stored}, not {self.meta}: remove it to rebuild")
+        else:
+            with open(meta_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(self.meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+        # Random odd multipliers that fold the rows of a band into one key
+        self._fold = rng.integers(0, 1 << 63, num_perm // bands, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.shingle_chars = shingle_chars
+
+        self._signatures_path = os.path.join(directory, "signatures.bin")
+        self._payloads_path = os.path.join(directory, "payloads.jsonl")
+        self._row_bytes = num_perm * 8
+        # Rows [0, len(self)) of these buffers are used
+        self._signatures = np.zeros((0, num_perm), np.uint64)
+        self._keys = np.zeros((0, bands), np.uint64)
+        self.payloads = []
+        self._payload_bytes = 0
+        # Band keys sorted once per band (binary search), one contiguous row per band; rows added since
+        # then wait in a small dict
+        self._sorted = np.zeros((bands, 0), np.uint64)
+        self._order = np.zeros((bands, 0), np.int64)
+        self._recent = {}
+        self._recent_rows = 0
+        self.refresh()
+
+    def __len__(self):
+        return len(self.payloads)
+
+    @property
+    def signatures(self):
+        return self._signatures[:len(self)]
+
+    ## ------------------ Signatures --------------###
+
+    def signature(self, text):
+        values = shingles(text, self.shingle_chars)
+        if not len(values):
+            return np.full(len(self._a), PRIME, np.uint64)
+        return ((self._a[:, None] * values[None, :] + self._b[:, None]) % PRIME).min(axis=1)
+
+    def band_keys(self, signatures):
+        #### ------- (n, bands) keys of (n, num_perm) signatures; uint64 arithmetic wraps around -------###
+        bands = signatures.reshape(len(signatures), self.bands, self.rows_per_band)
+        return (bands * self._fold).sum(axis=2, dtype=np.uint64)
+
+    @staticmethod
+    def similarity(signature, signatures):
+        #### ------- Estimated Jaccard similarity of one signature with each row of `signatures` -------###
+        return (signatures == signature).mean(axis=1)
+
+    ## ------------------ Persistence --------------###
+
+    def _locked(self):
+        lock = open(os.path.join(self.directory, "lock"), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def refresh(self):
+        #### ------- Reads the rows appended (by any process) since the last refresh -------###
+        try:
+            size = os.path.getsize(self._signatures_path)
+        except FileNotFoundError:
+            return
+        if size < (len(self) + 1) * self._row_bytes:
+            return
+        with open(self._payloads_path, 'rb') as f:
+            f.seek(self._payload_bytes)
+            lines = f.read().split(b"\n")[:-1]  # a line being written has no newline yet
+        with open(self._signatures_path, 'rb') as f:
+            f.seek(len(self) * self._row_bytes)
+            data = f.read(len(lines) * self._row_bytes)
+        count = min(len(lines), len(data) // self._row_bytes)
+        if count:
+            signatures = np.frombuffer(data[:count * self._row_bytes], np.uint64).reshape(count, -1)
+            self._extend(signatures, [json.loads(line) for line in lines[:count]])
+            self._payload_bytes += sum(len(line) + 1 for line in lines[:count])
+
+    @staticmethod
+    def _append(buffer, start, rows):
+        #### ------- Writes rows at `start`, growing the buffer geometrically (adding one row is not a copy) -------###
+        if start + len(rows) > len(buffer):
+            grown = np.zeros((max(2 * len(buffer), start + len(rows), 1024), buffer.shape[1]), buffer.dtype)
+            grown[:start] = buffer[:start]
+            buffer = grown
+        buffer[start:start + len(rows)] = rows
+        return buffer
+
+    def _extend(self, signatures, payloads):
+        start = len(self)
+        keys = self.band_keys(signatures)
+        self._signatures = self._append(self._signatures, start, signatures)
+        self._keys = self._append(self._keys, start, keys)
+        self.payloads.extend(payloads)
+        self._recent_rows += len(signatures)
+        if self._recent_rows > max(1024, len(self) // 8):
+            by_band = np.ascontiguousarray(self._keys[:len(self)].T)
+            self._order = np.argsort(by_band, axis=1, kind="stable")
+            self._sorted = np.take_along_axis(by_band, self._order, axis=1)
+            self._recent, self._recent_rows = {}, 0
+        else:
+            for row, row_keys in enumerate(keys.tolist(), start):
+                for band, key in enumerate(row_keys):
+                    self._recent.setdefault((band, key), []).append(row)
+
+    def add_many(self, texts, payloads):
+        #### ------- Appends texts with their payloads; returns the rows they got -------###
+        signatures = np.stack([self.signature(text) for text in texts]) if texts else None
+        if signatures is None:
+            return []
+        lines = b"".join(json.dumps(payload, ensure_ascii=False).encode('utf-8') + b"\n" for payload in payloads)
+        with self._locked():
+            self.refresh()
+            # Drops what a crashed writer left half-written, so both files stay row-aligned
+            with open(self._signatures_path, 'ab') as f:
+                f.truncate(len(self) * self._row_bytes)
+                f.write(signatures.tobytes())
+            with open(self._payloads_path, 'ab') as f:
+                f.truncate(self._payload_bytes)
+                f.write(lines)
+            start = len(self)
+            self._extend(signatures, list(payloads))
+            self._payload_bytes += len(lines)
+        return list(range(start, len(self)))
+
+    def add(self, text, payload):
+        return self.add_many([text], [payload])[0]
+
+    ## ------------------ Lookups --------------###
+
+    def candidates(self, keys):
+        #### ------- Rows that share at least one band with the band keys of a signature -------###
+        rows = set()
+        # A numpy uint64 key: a Python int would make searchsorted convert the whole column
+        for band, key in enumerate(keys):
+            column = self._sorted[band]
+            lo, hi = np.searchsorted(column, key, 'left'), np.searchsorted(column, key, 'right')
+            rows.update(self._order[band, lo:hi].tolist())
+            rows.update(self._recent.get((band, int(key)), ()))
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+    def query(self, text, threshold=dedup.THRESHOLD, where=None):
+        #### ------- [(similarity, row, payload)] of the texts at least `threshold` similar, closest first; ------###
+        #### ------- `where(payload)` restricts the matches (e.g. to one course) ------###
+        self.refresh()
+        signature = self.signature(text)
+        rows = self.candidates(self.band_keys(signature[None, :])[0])
+        if not len(rows):
+            return []
+        similarities = self.similarity(signature, self.signatures[rows])
+        matches = [(float(similarity), int(row), self.payloads[row])
+                   for similarity, row in zip(similarities, rows) if similarity >= threshold]
+        if where is not None:
+            matches = [match for match in matches if where(match[2])]
+        return sorted(matches, key=lambda match: (-match[0], match[1]))
+
+
+class DedupIndex:
+    #### --------- The questions and topics already generated, per course ------###
+
+    def __init__(self, root=DEDUP_DIR, threshold=dedup.THRESHOLD):
+        self.root = root
+        self.threshold = threshold
+        self.questions = MinHashLSH(os.path.join(root, "questions"))
+        self.topics = MinHashLSH(os.path.join(root, "topics"))
+
+    def find_question(self, text, course=record_store.DEFAULT_COURSE):
+        #### ------- (similarity, payload) of the closest question of the course, or None -------###
+        matches = self.questions.query(text, self.threshold, lambda payload: payload["course"] == course)
+        return (matches[0][0], matches[0][2]) if matches else None
+
+    def filter_taxonomy(self, taxonomy, course=record_store.DEFAULT_COURSE, topic=None, mode=dedup.MODE):
+        #### ------- Checks the questions of a new taxonomy against those of the course (and against each ------###
+        #### ------- other), then indexes the ones kept. Returns (taxonomy, duplicates): with mode "drop" the ------###
+        #### ------- duplicates are removed from the taxonomy, except the first one of a level they would leave ------###
+        #### ------- empty; each duplicate is {"level", "id", "question", "similarity", "kept", ------###
+        #### ------- "duplicate_of": {"topic", "level", "id", "question"}} ------###
+        if mode == "off":
+            return taxonomy, []
+        kept, duplicates, texts, payloads = {}, [], [], []
+        for level, questions in taxonomy.items():
+            kept[level] = []
+            first_dropped = None
+            for question in questions:
+                match = self.find_question(question["question"], course)
+                if match is not None:
+                    similarity, original = match
+                    duplicates.append({"level": level, "id": question.get("id"), "question": question["question"],
+                                       "similarity": similarity, "kept": mode != "drop", "duplicate_of": original})
+                    if mode == "drop":
+                        first_dropped = first_dropped or (question, duplicates[-1])
+                        continue
+                kept[level].append(question)
+                if match is None:
+                    payload = {"course": course, "topic": topic, "level": level, "id": question.get("id"),
+                               "question": question["question"]}
+                    # Indexed right away so the questions of this taxonomy are also checked against each other
+                    self.questions.add(question["question"], payload)
+            if not kept[level] and first_dropped is not None:
+                # A level is never lost to deduplication: its first duplicate stays, flagged
+                kept[level].append(first_dropped[0])
+                first_dropped[1]["kept"] = True
+        return {level: questions for level, questions in kept.items() if questions}, duplicates
+
+    def covered_levels(self, topic_text, course=record_store.DEFAULT_COURSE):
+        #### ------- (topic id, {level: questions}) of the closest topic already generated for the course, ------###
+        #### ------- or (None, {}); the levels of every close topic are merged, the closest first ------###
+        matches = self.topics.query(topic_text, self.threshold, lambda payload: payload["course"] == course)
+        levels = {}
+        for _, _, payload in matches:
+            for level, questions in payload["taxonomy"].items():
+                levels.setdefault(level, questions)
+        return (matches[0][2]["topic"] if matches else None), levels
+
+    def add_topic(self, topic_text, taxonomy, course=record_store.DEFAULT_COURSE, topic=None):
+        return self.topics.add(topic_text, {"course": course, "topic": topic, "taxonomy": taxonomy})
+
+    def stats(self):
+        courses = {}
+        for name, index in (("questions", self.questions), ("topics", self.topics)):
+            index.refresh()
+            for payload in index.payloads:
+                entry = courses.setdefault(payload["course"], {"questions": 0, "topics": 0})
+                entry[name] += 1
+        return courses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=DEDUP_DIR)
+    parser.add_argument("--threshold", type=float, default=dedup.THRESHOLD)
+    commands = parser.add_subparsers(dest="command", required=True)
+    imports = commands.add_parser("import", help="index the questions of generated taxonomy files (or of the "
+                                                 "record store when no file is given), reporting the duplicates")
+    imports.add_argument("files", nargs="*")
+    imports.add_argument("--course", default=record_store.DEFAULT_COURSE)
+    imports.add_argument("--records", default=record_store.RECORDS_DIR)
+    query = commands.add_parser("query", help="questions close to a text")
+    query.add_argument("text")
+    query.add_argument("--course", default=record_store.DEFAULT_COURSE)
+    commands.add_parser("stats", help="indexed questions and topics per course")
+    args = parser.parse_args()
+
+    index = DedupIndex(args.root, args.threshold)
+    if args.command == "import":
+        if args.files:
+            sources = []
+            for path in args.files:
+                with open(path, 'r', encoding='utf-8') as f:
+                    sources.append((args.course, os.path.splitext(os.path.basename(path))[0], json.load(f)))
+        else:
+            grouped = {}
+            for row in record_store.RecordStore(args.records).rows("questions"):
+                taxonomy = grouped.setdefault((row["course"], row["topic"]), {})
+                taxonomy.setdefault(row["level"], []).append({"id": row["question_id"], "question": row["question"]})
+            sources = [(course, topic, taxonomy) for (course, topic), taxonomy in grouped.items()]
+        for course, topic, taxonomy in sources:
+            _, duplicates = index.filter_taxonomy(taxonomy, course, topic, mode="flag")
+            print(f"{course}/{topic}: {sum(map(len, taxonomy.values()))} questions, {len(duplicates)} duplicates")
+            for duplicate in duplicates:
+                original = duplicate["duplicate_of"]
+                print(f"  [{duplicate['level']}] {duplicate['question']}\n"
+                      f"    ~{duplicate['similarity']:.2f} [{original['level']}] {original['question']} "
+                      f"({original['topic']})")
+    elif args.command == "query":
+        for similarity, _, payload in index.questions.query(args.text, args.threshold,
+                                                            lambda payload: payload["course"] == args.course):
+            print(f"{similarity:.2f}  [{payload['level']}] {payload['question']}  ({payload['topic']})")
+    else:
+        print(json.dumps(index.stats(), ensure_ascii=False, indent=2))
@@ -0,0 +1,460 @@
+"""Append-only store of generated questions, student answers and their grades.
+
+Every write is one small JSONL segment (written to a temporary file, then
+renamed, so readers never see half of it). Once COMPACT_SEGMENTS segments have
+piled up, a background thread compacts them into one part sorted by course,
+topic, Bloom level and student (or question id; student before level for
+grades): Parquet when pyarrow is installed, gzipped JSONL otherwise. Parts are
+then merged by size tier: COMPACT_TIER_PARTS parts of about the same size make
+one part of the next tier, so a row is rewritten a few times in its life
+instead of at every compaction. A manifest lists the live parts, their row
+counts and the segments they absorbed, so a crash during compaction never
+counts a row twice. The files a compaction replaces are only deleted by the
+next one, so a reader that loaded the previous manifest can still open them.
+Statistics are computed part by part from the few columns they need.
+
+    python record_store.py stats answers --course physique
+    python record_store.py stats grades --student s01
+    python record_store.py compact
+    python record_store.py import ../rag/src/student_answers_*.json generated_taxonomy_*.json
+"""
+import os
+import glob
+import gzip
+import json
+import time
+import math
+import uuid
+import argparse
+import threading
+
+# Where the records live; shared by the Streamlit app and the generators
+RECORDS_DIR = os.getenv('BLOOM_RECORDS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'records'))
+
+# Segments that trigger a compaction, parts of one size tier merged together (a tier holds parts of
+# COMPACT_TIER_PARTS^n to COMPACT_TIER_PARTS^(n+1) rows), and parts large enough to never be merged again
+COMPACT_SEGMENTS = int(os.getenv('BLOOM_RECORDS_COMPACT_SEGMENTS', '64'))
+COMPACT_TIER_PARTS = int(os.getenv('BLOOM_RECORDS_COMPACT_TIER_PARTS', '4'))
+COMPACT_PART_ROWS = int(os.getenv('BLOOM_RECORDS_COMPACT_PART_ROWS', '1000000'))
+ROW_GROUP_ROWS = 65536
+
+DEFAULT_COURSE = "default"
+
+# Columns of each kind of record (types for Parquet) and the order rows are sorted in
+SCHEMAS = {
+    "questions": {
+        "columns": {"created": "float64", "run": "string", "model": "string", "course": "string",
+                    "topic": "string", "level": "string", "question_id": "string", "type": "string",
+                    "question": "string", "options": "string", "answer": "string"},
+        "sort": ("course", "topic", "level", "question_id"),
+    },
+    "answers": {
+        "columns": {"created": "float64", "submission": "string", "course": "string", "topic": "string",
+                    "student": "string", "level": "string", "original_question": "string", "question": "string",
+                    "answer": "string", "answer_chars": "int64", "answered": "bool"},
+        "sort": ("course", "topic", "level", "student"),
+    },
+    "grades": {
+        "columns": {"created": "float64", "run": "string", "model": "string", "submission": "string",
+                    "course": "string", "topic": "string", "student": "string", "level": "string",
+                    "original_question": "string", "question": "string", "method": "string",
+                    "score": "float64", "feedback": "string"},
+        "sort": ("course", "topic", "student", "level"),
+    },
+}
+
+MANIFEST_FILE = "manifest.json"
+
+
+def _arrow():
+    #### ------- (pyarrow, pyarrow.parquet, pyarrow.compute) when installed, None otherwise -------###
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.compute
+    except ImportError:
+        return None
+    return pyarrow, pyarrow.parquet, pyarrow.compute
+
+
+def taxonomy_rows(taxonomy, topic, course=DEFAULT_COURSE, run=None, model=None):
+    #### ------- One row per question of a {level: [questions]} taxonomy -------###
+    created = time.time()
+    run = run or uuid.uuid4().hex
+    for level, questions in taxonomy.items():
+        for question in questions:
+            options = question.get("options")
+            yield {"created": created, "run": run, "model": model, "course": course, "topic": topic,
+                   "level": level, "question_id": question.get("id"), "type": question.get("type"),
+                   "question": question.get("question"),
+                   "options": json.dumps(options, ensure_ascii=False) if options is not None else None,
+                   "answer": question.get("answer")}
+
+
+def answer_rows(student_answers, student, topic, course=DEFAULT_COURSE, submission=None):
+    #### ------- One row per (original question, level) of the app's {"Topic Questions": [...]} submission -------###
+    created = time.time()
+    submission = submission or uuid.uuid4().hex
+    for answer_set in student_answers["Topic Questions"]:
+        for level, sub_question in answer_set["Sub-Questions"].items():
+            answer = sub_question.get("Answer") or ""
+            yield {"created": created, "submission": submission, "course": course, "topic": topic,
+                   "student": student, "level": level, "original_question": answer_set.get("Original Question"),
+                   "question": sub_question.get("Question"), "answer": answer,
+                   "answer_chars": len(answer.strip()), "answered": bool(answer.strip())}
+
+
+def _matches(row, filters):
+    return all(row.get(column) == value for column, value in filters.items())
+
+
+def _tier(rows):
+    return int(math.log(max(rows, 1), max(COMPACT_TIER_PARTS, 2)))
+
+
+# (root, kind) being compacted by a thread of this process
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+
+class RecordStore:
+
+    def __init__(self, root=RECORDS_DIR, compact_segments=COMPACT_SEGMENTS):
+        self.root = root
+        self.compact_segments = compact_segments
+
+    def _dir(self, kind):
+        if kind not in SCHEMAS:
+            raise ValueError(f"unknown kind of record: {kind!r}")
+        directory = os.path.join(self.root, kind)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    @staticmethod
+    def _write_atomic(path, data):
+        with open(path + ".tmp", 'wb') as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def _manifest(self, kind):
+        #### ------- {"parts": [file names], "rows": {part: row count}, "absorbed": [segment names already in ------###
+        #### ------- a part], "replaced": [files merged by the last compaction, deleted by the next one]} -------###
+        path = os.path.join(self._dir(kind), MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {"parts": [], "rows": {}, "absorbed": [], "replaced": []}
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest.setdefault("rows", {})
+        return manifest
+
+    def _segments(self, kind, manifest):
+        absorbed = set(manifest["absorbed"])
+        names = sorted(os.path.basename(path) for path in glob.glob(os.path.join(self._dir(kind), "segment-*.jsonl")))
+        return [name for name in names if name not in absorbed]
+
+    ## ------------------ Writing --------------###
+
+    def append(self, kind, rows):
+        #### ------- Writes the rows as one new segment; returns how many were written. The compaction it may ------###
+        #### ------- trigger runs in a background thread: the app's submit button never waits for it -------###
+        columns = SCHEMAS[kind]["columns"]
+        lines = [json.dumps({column: row.get(column) for column in columns}, ensure_ascii=False) for row in rows]
+        if not lines:
+            return 0
+        name = f"segment-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.jsonl"
+        self._write_atomic(os.path.join(self._dir(kind), name), ("\n".join(lines) + "\n").encode('utf-8'))
+        if self.compact_segments and len(self._segments(kind, self._manifest(kind))) >= self.compact_segments:
+            self.compact_in_background(kind)
+        return len(lines)
+
+    def append_taxonomy(self, taxonomy, topic, course=DEFAULT_COURSE, run=None, model=None):
+        return self.append("questions", taxonomy_rows(taxonomy, topic, course, run, model))
+
+    def append_answers(self, student_answers, student, topic, course=DEFAULT_COURSE, submission=None):
+        return self.append("answers", answer_rows(student_answers, student, topic, course, submission))
+
+    ## ------------------ Compaction --------------###
+
+    def _lock(self, kind):
+        #### ------- Only one process compacts a kind at a time; a lock older than 10 minutes is stale -------###
+        path = os.path.join(self._dir(kind), "compact.lock")
+        try:
+            if time.time() - os.path.getmtime(path) > 600:
+                os.remove(path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            return None
+
+    def compact_in_background(self, kind):
+        #### ------- Starts a compaction thread, unless one of this process already compacts the kind -------###
+        key = (os.path.abspath(self.root), kind)
+        with _compacting_lock:
+            if key in _compacting:
+                return None
+            _compacting.add(key)
+
+        def run():
+            try:
+                # Segments appended during a compaction are compacted by the same thread
+                while self.compact(kind) and len(self._segments(kind, self._manifest(kind))) >= self.compact_segments:
+                    pass
+            finally:
+                with _compacting_lock:
+                    _compacting.discard(key)
+
+        # Not a daemon: a script that appended its last rows lets the compaction finish before exiting
+        thread = threading.Thread(target=run, name=f"compact-{kind}")
+        thread.start()
+        return thread
+
+    def compact(self, kind=None):
+        #### ------- Merges the segments into one sorted part, then parts by size tier; returns rows written -------###
+        if kind is None:
+            return {kind: self.compact(kind) for kind in SCHEMAS}
+        lock = self._lock(kind)
+        if lock is None:
+            return 0
+        try:
+            return self._compact(kind)
+        finally:
+            os.remove(lock)
+
+    def _compact(self, kind):
+        directory = self._dir(kind)
+        manifest = self._manifest(kind)
+        # The files merged by the last compaction are only deleted now: until then, a reader that loaded the
+        # manifest before it could still be opening them
+        for stale in manifest["replaced"]:
+            try:
+                os.remove(os.path.join(directory, stale))
+            except FileNotFoundError:
+                pass
+        manifest["replaced"] = []
+        for part in manifest["parts"]:
+            if part not in manifest["rows"]:    # manifest written before the row counts were kept
+                manifest["rows"][part] = self._part_rows(kind, part)
+
+        written = 0
+        segments = self._segments(kind, manifest)
+        if segments:
+            written += self._merge(kind, manifest, [], segments)
+        while True:
+            tiers = {}
+            for part in manifest["parts"]:
+                if manifest["rows"][part] < COMPACT_PART_ROWS:
+                    tiers.setdefault(_tier(manifest["rows"][part]), []).append(part)
+            full = [parts for tier, parts in sorted(tiers.items()) if len(parts) >= COMPACT_TIER_PARTS]
+            if not full:
+                return written
+            written += self._merge(kind, manifest, full[0], [])
+
+    def _merge(self, kind, manifest, parts, segments):
+        #### ------- Writes the rows of the parts and segments as one sorted part, then the manifest that ------###
+        #### ------- swaps them for it (updated in place); returns its row count -------###
+        directory = self._dir(kind)
+        rows = []
+        for part in parts:
+            rows.extend(self._read_part(kind, part))
+        for segment in segments:
+            rows.extend(self._read_segment(kind, segment))
+        sort = SCHEMAS[kind]["sort"]
+        rows.sort(key=lambda row: tuple(row.get(column) or "" for column in sort))
+
+        arrow = _arrow()
+        name = f"part-{time.time_ns():020d}" + (".parquet" if arrow else ".jsonl.gz")
+        path = os.path.join(directory, name)
+        if arrow:
+            pa, pq, _ = arrow
+            table = pa.Table.from_pylist(rows, schema=self._arrow_schema(kind))
+            pq.write_table(table, path + ".tmp", row_group_size=ROW_GROUP_ROWS, compression="zstd")
+            os.replace(path + ".tmp", path)
+        else:
+            data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode('utf-8')
+            self._write_atomic(path, gzip.compress(data))
+
+        # The new part replaces the merged ones only once the manifest says so; the merged files are deleted
+        # by the next compaction
+        existing = set(os.listdir(directory))
+        manifest["parts"] = [part for part in manifest["parts"] if part not in parts] + [name]
+        manifest["rows"] = {part: manifest["rows"][part] for part in manifest["parts"] if part != name}
+        manifest["rows"][name] = len(rows)
+        manifest["absorbed"] = [segment for segment in manifest["absorbed"] if segment in existing] + segments
+        manifest["replaced"] = manifest["replaced"] + parts + segments
+        self._write_atomic(os.path.join(directory, MANIFEST_FILE), json.dumps(manifest, indent=1).encode('utf-8'))
+        return len(rows)
+
+    def _arrow_schema(self, kind):
+        pa = _arrow()[0]
+        types = {"string": pa.string(), "float64": pa.float64(), "int64": pa.int64(), "bool": pa.bool_()}
+        return pa.schema([(column, types[kind_type]) for column, kind_type in SCHEMAS[kind]["columns"].items()])
+
+    def _part_rows(self, kind, part):
+        path = os.path.join(self._dir(kind), part)
+        if part.endswith(".parquet"):
+            return _arrow()[1].read_metadata(path).num_rows
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return sum(1 for _ in f)
+
+    ## ------------------ Reading --------------###
+
+    def _read_segment(self, kind, segment):
+        with open(os.path.join(self._dir(kind), segment), 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _read_part(self, kind, part, columns=None, filters=None):
+        path = os.path.join(self._dir(kind), part)
+        if part.endswith(".parquet"):
+            pq = _arrow()[1]
+            predicates = [(column, "=", value) for column, value in (filters or {}).items()] or None
+            return pq.read_table(path, columns=columns, filters=predicates).to_pylist()
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return [row for row in map(json.loads, f) if _matches(row, filters or {})]
+
+    def rows(self, kind, columns=None, **filters):
+        #### ------- Every row of a kind matching the filters (column=value), parts first -------###
+        manifest = self._manifest(kind)
+        for part in manifest["parts"]:
+            yield from self._read_part(kind, part, columns, filters)
+        for segment in self._segments(kind, manifest):
+            for row in self._read_segment(kind, segment):
+                if _matches(row, filters):
+                    yield {column: row.get(column) for column in columns} if columns else row
+
+    def _tables(self, kind, columns, filters):
+        #### ------- Parquet parts as Arrow tables (only the needed columns and row groups), then the rest as rows -------###
+        manifest = self._manifest(kind)
+        predicates = [(column, "=", value) for column, value in filters.items()] or None
+        rows = []
+        for part in manifest["parts"]:
+            if part.endswith(".parquet"):
+                yield _arrow()[1].read_table(os.path.join(self._dir(kind), part), columns=columns,
+                                             filters=predicates)
+            else:
+                rows.extend(self._read_part(kind, part, columns, filters))
+        for segment in self._segments(kind, manifest):
+            rows.extend(row for row in self._read_segment(kind, segment) if _matches(row, filters))
+        yield rows
+
+    ## ------------------ Statistics --------------###
+
+    def answer_stats(self, **filters):
+        #### ------- Per Bloom level: answers, answered (non-empty), distinct students, mean answer length -------###
+        partial = {}    # level -> [answers, answered, chars, students]
+        for batch in self._tables("answers", ["level", "student", "answered", "answer_chars", "created"], filters):
+            if isinstance(batch, list):
+                grouped = {}
+                for row in batch:
+                    entry = grouped.setdefault((row["level"], row["student"]), [0, 0, 0])
+                    entry[0] += 1
+                    entry[1] += bool(row["answered"])
+                    entry[2] += row["answer_chars"] or 0
+                groups = [(level, student, *entry) for (level, student), entry in grouped.items()]
+            else:
+                table = batch.group_by(["level", "student"]).aggregate(
+                    [("created", "count"), ("answered", "sum"), ("answer_chars", "sum")]).to_pydict()
+                groups = zip(table["level"], table["student"], table["created_count"],
+                             table["answered_sum"], table["answer_chars_sum"])
+            for level, student, answers, answered, chars in groups:
+                entry = partial.setdefault(level, [0, 0, 0, set()])
+                entry[0] += answers
+                entry[1] += answered or 0
+                entry[2] += chars or 0
+                entry[3].add(student)
+        return {level: {"answers": answers, "answered": answered, "answered_rate": answered / answers,
+                        "students": len(students), "mean_answer_chars": chars / answered if answered else 0.0}
+                for level, (answers, answered, chars, students) in sorted(partial.items())}
+
+    def question_stats(self, **filters):
+        #### ------- Per Bloom level: questions, count by type, distinct topics -------###
+        partial = {}    # level -> [questions, {type: count}, topics]
+        for batch in self._tables("questions", ["level", "type", "topic", "created"], filters):
+            if isinstance(batch, list):
+                grouped = {}
+                for row in batch:
+                    key = (row["level"], row["type"], row["topic"])
+                    grouped[key] = grouped.get(key, 0) + 1
+                groups = [(*key, count) for key, count in grouped.items()]
+            else:
+                table = batch.group_by(["level", "type", "topic"]).aggregate([("created", "count")]).to_pydict()
+                groups = zip(table["level"], table["type"], table["topic"], table["created_count"])
+            for level, question_type, topic, count in groups:
+                entry = partial.setdefault(level, [0, {}, set()])
+                entry[0] += count
+                entry[1][question_type] = entry[1].get(question_type, 0) + count
+                entry[2].add(topic)
+        return {level: {"questions": questions, "by_type": by_type, "topics": len(topics)}
+                for level, (questions, by_type, topics) in sorted(partial.items())}
+
+    def grade_stats(self, **filters):
+        #### ------- Per Bloom level: graded answers, mean score (0 to 1), count by method -------###
+        partial = {}    # level -> [graded, score sum, {method: count}]
+        for batch in self._tables("grades", ["level", "method", "score"], filters):
+            if isinstance(batch, list):
+                grouped = {}
+                for row in batch:
+                    entry = grouped.setdefault((row["level"], row["method"]), [0, 0.0])
+                    entry[0] += 1
+                    entry[1] += row["score"] or 0.0
+                groups = [(*key, *entry) for key, entry in grouped.items()]
+            else:
+                table = batch.group_by(["level", "method"]).aggregate(
+                    [("score", "count"), ("score", "sum")]).to_pydict()
+                groups = zip(table["level"], table["method"], table["score_count"], table["score_sum"])
+            for level, method, count, total in groups:
+                entry = partial.setdefault(level, [0, 0.0, {}])
+                entry[0] += count
+                entry[1] += total or 0.0
+                entry[2][method] = entry[2].get(method, 0) + count
+        return {level: {"graded": graded, "mean_score": total / graded if graded else 0.0, "by_method": by_method}
+                for level, (graded, total, by_method) in sorted(partial.items())}
+
+    def stats(self, kind, **filters):
+        if kind == "grades":
+            return self.grade_stats(**filters)
+        return self.answer_stats(**filters) if kind == "answers" else self.question_stats(**filters)
+
+    ## ------------------ Files written before the store existed --------------###
+
+    def import_file(self, path, course=DEFAULT_COURSE, student="unknown"):
+        #### ------- A student_answers_<ts>.json or generated_taxonomy_<ts>.json file; returns (kind, rows) -------###
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        topic = os.path.splitext(os.path.basename(path))[0]
+        if "Topic Questions" in data:
+            return "answers", self.append_answers(data, student, topic, course, submission=topic)
+        return "questions", self.append_taxonomy(data, topic, course, run=topic)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=RECORDS_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    stats = commands.add_parser("stats", help="per-level statistics")
+    stats.add_argument("kind", choices=sorted(SCHEMAS))
+    for column in ("course", "topic", "student", "level"):
+        stats.add_argument(f"--{column}")
+    compact = commands.add_parser("compact", help="merge the segments into sorted parts")
+    compact.add_argument("kind", nargs="?", choices=sorted(SCHEMAS))
+    imports = commands.add_parser("import", help="import JSON files written by older versions")
+    imports.add_argument("files", nargs="+")
+    imports.add_argument("--course", default=DEFAULT_COURSE)
+    imports.add_argument("--student", default="unknown")
+    args = parser.parse_args()
+
+    store = RecordStore(args.root)
+    if args.command == "stats":
+        filters = {column: getattr(args, column) for column in ("course", "topic", "student", "level")
+                   if getattr(args, column) is not None}
+        if args.kind == "questions":
+            filters.pop("student", None)
+        print(json.dumps(store.stats(args.kind, **filters), ensure_ascii=False, indent=2))
+    elif args.command == "compact":
+        print(json.dumps(store.compact(args.kind)))
+    else:
+        for path in args.files:
+            kind, count = store.import_file(path, args.course, args.student)
+            print(f"{path}: {count} {kind} rows")
@@ -0,0 +1,29 @@
+import os
+import sys
+
+from settings import api, models, providers
+
+# The router lives with the RAG service (rag/src/llm_router.py), so both pick providers the same way
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rag", "src"))
+import llm_router  # noqa: E402
+from llm_router import BackendsUnavailable  # noqa: E402,F401
+
+# One router per (base URL, model), so the latency statistics of a provider outlive a batch
+_routers = {}
+
+
+def backends(base_url=None, model=models.MODEL_NAME):
+    #### ------- Groq (its OpenAI-compatible API) at `base_url`, then OpenAI if OPENAI_MODEL is set -------###
+    groq_url = (base_url or providers.GROQ_BASE_URL).rstrip("/") + "/openai/v1"
+    configured = [{"name": "groq", "base_url": groq_url, "model": model, "api_key": api.GROQ_API_KEY}]
+    if providers.OPENAI_MODEL:
+        configured.append({"name": "openai", "base_url": providers.OPENAI_BASE_URL, "model": providers.OPENAI_MODEL,
+                           "api_key_env": "OPENAI_API_KEY"})
+    return configured
+
+
+def get_router(base_url=None, model=models.MODEL_NAME):
+    key = (base_url, model)
+    if key not in _routers:
+        _routers[key] = llm_router.LLMRouter(backends(base_url, model), hedge=providers.HEDGE)
+    return _routers[key]
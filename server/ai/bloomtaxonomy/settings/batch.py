@@ -0,0 +1,16 @@
+import os
+
+# Batch generation: worker pool size and the provider's rate limits (per minute)
+WORKERS = int(os.getenv('BATCH_WORKERS', '8'))
+REQUESTS_PER_MINUTE = int(os.getenv('BATCH_REQUESTS_PER_MINUTE', '30'))
+TOKENS_PER_MINUTE = int(os.getenv('BATCH_TOKENS_PER_MINUTE', '6000'))
+
+# Tokens budgeted for each completion before the actual usage is known
+COMPLETION_TOKENS_ESTIMATE = int(os.getenv('BATCH_COMPLETION_TOKENS_ESTIMATE', '2500'))
+
+# Retries of a topic on rate-limit (429), server and connection errors, with exponential backoff
+MAX_RETRIES = int(os.getenv('BATCH_MAX_RETRIES', '6'))
+BACKOFF_SECONDS = float(os.getenv('BATCH_BACKOFF_SECONDS', '2'))
+
+# Extra requests for the levels still missing when a response is cut or malformed
+MAX_REPAIRS = int(os.getenv('BATCH_MAX_REPAIRS', '2'))
\ No newline at end of file
@@ -0,0 +1,18 @@
+import os
+
+# What happens to a generated question close to one already generated for the same course:
+## off: nothing, flag: kept and reported, drop: not stored
+MODE = os.getenv('DEDUP_MODE', 'flag')
+
+# Estimated Jaccard similarity (character shingles) above which two questions, or two topics, are the same
+THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.7'))
+
+# Topics this close to one already generated reuse its levels instead of asking the model for them again
+REUSE_TOPICS = os.getenv('DEDUP_REUSE_TOPICS', '1') == '1'
+
+# MinHash signature: NUM_PERM hashes of the SHINGLE_CHARS-character shingles, cut into BANDS LSH bands
+# (candidates are pairs that agree on a whole band: about (1 / BANDS) ** (BANDS / NUM_PERM) similarity and up)
+NUM_PERM = int(os.getenv('DEDUP_NUM_PERM', '128'))
+BANDS = int(os.getenv('DEDUP_BANDS', '32'))
+SHINGLE_CHARS = int(os.getenv('DEDUP_SHINGLE_CHARS', '5'))
+SEED = 1
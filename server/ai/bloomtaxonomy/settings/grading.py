@@ -0,0 +1,21 @@
+import os
+
+# Grading of the open-ended answers: worker pool size (the rate limits are those of settings/batch.py)
+WORKERS = int(os.getenv('GRADING_WORKERS', '8'))
+
+# Answers packed into one prompt: at most this many, within this many prompt tokens
+MAX_ANSWERS_PER_PROMPT = int(os.getenv('GRADING_MAX_ANSWERS_PER_PROMPT', '20'))
+PROMPT_TOKENS = int(os.getenv('GRADING_PROMPT_TOKENS', '3000'))
+MAX_ANSWER_CHARS = int(os.getenv('GRADING_MAX_ANSWER_CHARS', '2000'))  # longer answers are cut
+
+# Completion tokens budgeted per answer (score + one sentence of feedback) before the actual usage is known
+COMPLETION_TOKENS_PER_ANSWER = int(os.getenv('GRADING_COMPLETION_TOKENS_PER_ANSWER', '60'))
+
+# Extra prompts for the answers a response left out or graded with an invalid score
+MAX_REPAIRS = int(os.getenv('GRADING_MAX_REPAIRS', '1'))
+
+# Relative tolerance of the numeric answers checked against a key ("340 m/s")
+NUMERIC_TOLERANCE = float(os.getenv('GRADING_NUMERIC_TOLERANCE', '0.01'))
+
+# The model grades on 0..MAX_SCORE; stored scores are divided by it (0 to 1)
+MAX_SCORE = 4
@@ -125,4 +125,12 @@ The AI should produce a JSON file similar to the example provided, but specifica
 
 "])""")
 
-SYNTHETIC_DATA_PROMPT = os.getenv('PROMPTS', "")
\ No newline at end of file
+SYNTHETIC_DATA_PROMPT = os.getenv('PROMPTS', "")
+
+GRADING_PROMPT = os.getenv('GRADING_PROMPT', """You are grading the answers of high school students to Bloom's Taxonomy questions.
+The JSON below lists questions, each with its Bloom level and the answers of several students.
+Grade every answer on its own, for the question it answers and at the expected cognitive level:
+0 = missing, off-topic or wrong, 1 = mostly wrong, 2 = partly correct, 3 = mostly correct, 4 = fully correct.
+Return only a JSON object, with one entry per answer id and one short sentence of feedback each:
+{"grades": [{"id": 1, "score": 3, "feedback": "..."}]}
+""")
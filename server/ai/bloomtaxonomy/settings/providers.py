@@ -0,0 +1,10 @@
+import os
+
+# LLM providers the generation and grading scripts route between (router.py): Groq always,
+# plus any OpenAI-compatible API when OPENAI_MODEL is set (the model to ask it for)
+GROQ_BASE_URL = os.getenv('GROQ_BASE_URL', 'https://api.groq.com')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', '')
+
+# Send a call slower than the provider's p95 to the next provider too, and keep the first answer
+HEDGE = os.getenv('LLM_HEDGE', '1') == '1'
@@ -0,0 +1,115 @@
+"""Lookup cost of the near-duplicate index (bloomtaxonomy/near_duplicates.py).
+
+Indexes N synthetic questions (sentences drawn from the words of rag/data/*.txt
+and of bloomtaxonomy/generated_taxonomy_20241128_023527.json) for each --sizes
+value, then looks up near-duplicates of indexed questions (case, punctuation
+and one word changed) and new questions, two ways:
+
+  lsh    candidates that share a band with the query, then their signatures
+  scan   the signature of every indexed question (what a brute-force check costs)
+
+and reports the time per lookup, the signatures compared per lookup and the
+recall of the LSH lookups (near-duplicates the scan finds above the threshold
+that the LSH also finds). The LSH cost should stay almost flat as N grows.
+
+    python bench_dedup.py --sizes 1000 10000 100000 --queries 500
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+BLOOM_DIR = os.path.join(RAG_DIR, "..", "bloomtaxonomy")
+sys.path.insert(0, BLOOM_DIR)
+
+import numpy as np  # noqa: E402
+
+import near_duplicates  # noqa: E402
+from settings import dedup  # noqa: E402
+
+
+def vocabulary():
+    words = []
+    sources = [os.path.join(RAG_DIR, "data", name) for name in sorted(os.listdir(os.path.join(RAG_DIR, "data")))
+               if name.endswith(".txt")]
+    for path in sources + [os.path.join(BLOOM_DIR, "generated_taxonomy_20241128_023527.json")]:
+        with open(path, 'r', encoding='utf-8') as f:
+            words.extend(re.findall(r"\w{3,}", f.read()))
+    return sorted(set(words))
+
+
+def make_question(rng, words):
+    return " ".join(rng.choice(words) for _ in range(rng.randint(8, 16))).capitalize() + " ?"
+
+
+def near_duplicate(rng, question, words):
+    #### --------- Same question with another case, no punctuation and one word replaced ------###
+    tokens = question.rstrip(" ?").split()
+    tokens[rng.randrange(len(tokens))] = rng.choice(words)
+    return " ".join(tokens).upper() if rng.random() < 0.5 else " ".join(tokens).lower() + "."
+
+
+def run_size(size, args, words):
+    rng = random.Random(size)
+    index = near_duplicates.MinHashLSH(tempfile.mkdtemp(prefix="bloom-dedup-"))
+    questions = [make_question(rng, words) for _ in range(size)]
+    start = time.perf_counter()
+    for offset in range(0, size, 1000):
+        batch = questions[offset:offset + 1000]
+        index.add_many(batch, [{"course": "bench", "question": question} for question in batch])
+    add_seconds = time.perf_counter() - start
+
+    queries = [near_duplicate(rng, rng.choice(questions), words) if i % 2 == 0 else make_question(rng, words)
+               for i in range(args.queries)]
+    lsh_times, scan_times, compared, found, expected = [], [], [], 0, 0
+    signatures = index.signatures
+    for query in queries:
+        start = time.perf_counter()
+        signature = index.signature(query)
+        rows = index.candidates(index.band_keys(signature[None, :])[0])
+        similarities = index.similarity(signature, signatures[rows])
+        lsh_matches = set(rows[similarities >= args.threshold].tolist())
+        lsh_times.append(time.perf_counter() - start)
+        compared.append(len(rows))
+
+        start = time.perf_counter()
+        signature = index.signature(query)
+        scan_matches = set(np.flatnonzero(index.similarity(signature, signatures) >= args.threshold).tolist())
+        scan_times.append(time.perf_counter() - start)
+        expected += len(scan_matches)
+        found += len(scan_matches & lsh_matches)
+    return {"size": size, "add_us": 1e6 * add_seconds / size,
+            "lsh_us": 1e6 * statistics.median(lsh_times), "scan_us": 1e6 * statistics.median(scan_times),
+            "compared": statistics.mean(compared), "recall": found / expected if expected else 1.0,
+            "duplicates": expected}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--threshold", type=float, default=dedup.THRESHOLD)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    words = vocabulary()
+    results = [run_size(size, args, words) for size in args.sizes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'questions':>9} {'add (us)':>9} {'lsh (us)':>9} {'scan (us)':>10} {'compared':>9} {'recall':>7} "
+          f"{'duplicates':>10}")
+    for r in results:
+        print(f"{r['size']:>9} {r['add_us']:>9.0f} {r['lsh_us']:>9.0f} {r['scan_us']:>10.0f} {r['compared']:>9.1f} "
+              f"{r['recall']:>7.3f} {r['duplicates']:>10}")
+
+
+if __name__ == "__main__":
+    main()
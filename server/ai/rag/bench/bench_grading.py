@@ -0,0 +1,133 @@
+"""Throughput of the batch grading of student answers (bloomtaxonomy/grade_answers.py).
+
+Builds a synthetic class in a temporary record store: every student answers
+every question of bloomtaxonomy/generated_taxonomy_20241128_023527.json (plus
+one numeric question), the multiple-choice ones by option text, letter, a
+wrong option or not at all, the open ones from a small pool of answers (so
+some are identical). The class is then graded against the fake LLM server
+once per --per-prompt value, and the run reports the answers graded per
+second, the LLM calls and the prompt tokens:
+
+  1   one open answer per prompt (no packing)
+  20  up to 20 open answers per prompt, grouped by question
+
+MCQ and numeric answers are scored locally in every run; the run fails if an
+answer is left ungraded or if a local score is wrong.
+
+    python bench_grading.py --students 60 --latency 0.5 --per-prompt 1 20
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+BLOOM_DIR = os.path.join(RAG_DIR, "..", "bloomtaxonomy")
+sys.path.insert(0, os.path.join(RAG_DIR, "src"))
+sys.path.insert(0, BLOOM_DIR)
+
+import fake_llm_server  # noqa: E402
+
+TAXONOMY_PATH = os.path.join(BLOOM_DIR, "generated_taxonomy_20241128_023527.json")
+NUMERIC_QUESTION = {"id": "AP9", "type": "short-answer", "answer": "343 m/s",
+                    "question": "What is the speed of sound in air at 20 °C?"}
+# Numeric answers and whether they match "343 m/s" within the default tolerance
+NUMERIC_ANSWERS = [("343 m/s", True), ("343m/s", True), ("343,0 m/s", True), ("345 m/s", True),
+                   ("300 m/s", False), ("343 km/h", False)]
+
+
+def reply(messages):
+    #### --------- Grades every answer id of a grading prompt (score from the answer length) ------###
+    content = messages[-1]["content"]
+    payload = json.loads(content[content.index('{"questions"'):])
+    grades = [{"id": answer["id"], "score": len(answer["answer"]) % 5, "feedback": "Fake feedback."}
+              for question in payload["questions"] for answer in question["answers"]]
+    return json.dumps({"grades": grades})
+
+
+def build_class(store, taxonomy, students, seed=0):
+    #### --------- Appends one submission per student; returns the expected score of each keyed answer ------###
+    rng = random.Random(seed)
+    expected = {}
+    rounds = max(len(questions) for questions in taxonomy.values())
+    for s in range(students):
+        student = f"student{s:03d}"
+        submission = {"Topic Questions": []}
+        for i in range(rounds):
+            answer_set = {"Original Question": f"Question {i + 1}", "Sub-Questions": {}}
+            for level, questions in taxonomy.items():
+                if i >= len(questions):
+                    continue
+                question = questions[i]
+                options = question.get("options")
+                if options and question["answer"] in options:
+                    right = options.index(question["answer"])
+                    wrong = (right + 1) % len(options)
+                    answer, score = rng.choice([(question["answer"], 1.0), (chr(ord("a") + right), 1.0),
+                                                (f"{right + 1})", 1.0), (options[wrong], 0.0), ("", 0.0)])
+                elif question.get("answer") and not options:
+                    answer, correct = rng.choice(NUMERIC_ANSWERS)
+                    score = float(correct)
+                else:
+                    answer = rng.choice(["", f"Answer {rng.randrange(4)}",
+                                         f"A longer answer about {question['question'][:40]} ({rng.randrange(12)})"])
+                    score = None
+                answer_set["Sub-Questions"][level] = {"Question": question["question"], "Answer": answer}
+                if score is not None:
+                    expected[(student, level, question["question"])] = score
+            submission["Topic Questions"].append(answer_set)
+        store.append_answers(submission, student, "ondes", "physique", submission=student)
+    return expected
+
+
+def run(args, per_prompt, taxonomy):
+    import record_store
+    import grade_answers
+    store = record_store.RecordStore(tempfile.mkdtemp(prefix="bloom-grading-"))
+    store.append_taxonomy(taxonomy, "ondes", "physique")
+    expected = build_class(store, taxonomy, args.students)
+    report = grade_answers.run_grading(store, "physique", base_url=f"http://127.0.0.1:{args.llm_port}",
+                                       model="fake", workers=args.workers, requests_per_minute=10 ** 9,
+                                       tokens_per_minute=10 ** 12, max_answers=per_prompt)
+    keys = ((grade["score"], (grade["student"], grade["level"], grade["question"])) for grade in store.rows("grades"))
+    wrong = sum(score != expected[key] for score, key in keys if key in expected)
+    return report, wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=60)
+    parser.add_argument("--per-prompt", type=int, nargs="+", default=[1, 20], help="open answers per prompt")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency in seconds")
+    parser.add_argument("--llm-port", type=int, default=8130)
+    args = parser.parse_args()
+
+    with open(TAXONOMY_PATH, 'r', encoding='utf-8') as f:
+        taxonomy = json.load(f)
+    taxonomy["Apply"] = taxonomy.get("Apply", []) + [NUMERIC_QUESTION]
+    fake_llm_server.serve_in_thread(fake_llm_server.create_app(latency=args.latency, reply=reply, token_delay=0),
+                                    args.llm_port)
+
+    failed = False
+    print(f"{'per prompt':>10} {'answers':>8} {'local':>6} {'open':>6} {'calls':>6} {'prompt tok':>10} "
+          f"{'seconds':>8} {'answers/s':>10} {'local ms':>9}")
+    for per_prompt in args.per_prompt:
+        report, wrong = run(args, per_prompt, taxonomy)
+        local = sum(report["methods"].get(method, 0) for method in ("blank", "mcq", "exact"))
+        print(f"{per_prompt:>10} {report['answers']:>8} {local:>6} {report['llm_answers']:>6} {report['calls']:>6} "
+              f"{report['prompt_tokens']:>10} {report['seconds']:>8.2f} {report['answers_per_second']:>10.0f} "
+              f"{1000 * report['local_seconds']:>9.1f}")
+        if report["ungraded"] or report["errors"] or wrong:
+            print(f"           {report['ungraded']} ungraded, {report['errors']} failed calls, "
+                  f"{wrong} wrong local scores")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Cold-start benchmark: how long importing each module of the service takes.
+
+Every module is imported --runs times, each time in a fresh interpreter started
+with -X importtime, and the median wall time of the import is reported with
+the heaviest packages it pulled in. Heavy dependencies (langchain, openai,
+tiktoken, chromadb, ...) are only loaded on first use or by the server warm-up
+(llm.warm_up), so a module that imports one of them at load time is reported as
+a regression, whatever the timings. --baseline compares with the report of a
+previous run and exits with status 1 when an import got slower than
+--tolerance, or when --max-ms is exceeded.
+
+    python bench_imports.py --output imports.json
+    python bench_imports.py --baseline imports.json --max-ms 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+SRC_DIR = os.path.join(RAG_DIR, "src")
+
+# Modules imported by `python llm.py`, uvicorn workers (main) and the Streamlit app
+MODULES = ["tokenization", "context_packer", "embeddings", "vector_store", "lexical", "llm", "corpus",
+           "ingest", "bloom", "main"]
+
+# Run before every timed import (and the interpreter start-up measure): llm, and the modules that import it,
+# need the user's keys module, which is not in the repository
+KEYS_SETUP = "import sys, types; sys.modules.setdefault('keys', types.SimpleNamespace(key='fake-key'))"
+
+# Also run before the timed import of one module: main opens the job queue, the corpus index and the embedding
+# cache when it is imported, which must not be the real ones
+SETUP = {
+    "main": "import tempfile, config; "
+            "workdir = tempfile.mkdtemp(prefix='bench-imports-'); "
+            "config.INGEST_DB_PATH = workdir + '/jobs.sqlite'; config.INGEST_UPLOAD_DIR = workdir + '/uploads'; "
+            "config.CORPUS_INDEX_DIR = workdir + '/corpus'; config.EMBEDDING_CACHE_PATH = workdir + '/embeddings.sqlite'",
+}
+
+# Packages that must not be imported when one of the modules is
+LAZY_PACKAGES = {"langchain", "openai", "tiktoken", "chromadb", "streamlit", "pyarrow", "groq"}
+
+SNIPPET = "{setup}; import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+
+
+def import_once(module=None):
+    #### --------- (seconds, {top-level package: cumulative seconds}, every top-level package imported) of one ------###
+    #### --------- import in a fresh interpreter; the timings are those of the packages the module imports itself ------###
+    #### --------- (module=None measures the interpreter start-up alone) ------###
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.environ.get("PYTHONPATH")])))
+    statement = f"import {module}" if module else "pass"
+    setup = "; ".join(filter(None, [KEYS_SETUP, SETUP.get(module)]))
+    snippet = SNIPPET.format(setup=setup, statement=statement)
+    # main mounts static/ relative to the working directory: it runs from the rag directory, like uvicorn
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", snippet],
+                             capture_output=True, text=True, cwd=RAG_DIR if module == "main" else SRC_DIR, env=env)
+    if process.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{process.stderr[-2000:]}")
+    packages, imported = {}, set()
+    for line in process.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nested imports indented by two more spaces
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue    # header
+        top = name.strip().split(".")[0]
+        imported.add(top)
+        if (len(name) - len(name.lstrip()) - 1) // 2 == 1:
+            # Imported by the measured module; what they import in turn is counted in their time
+            packages[top] = packages.get(top, 0.0) + int(cumulative) / 1e6
+    return float(process.stdout.strip().splitlines()[-1]), packages, imported
+
+
+def measure(module, runs, startup):
+    seconds, packages, imported = [], {}, set()
+    for _ in range(runs):
+        elapsed, loaded, imported = import_once(module)
+        seconds.append(elapsed)
+        packages = {name: value for name, value in loaded.items() if name not in startup}
+    heaviest = sorted(packages.items(), key=lambda item: -item[1])[:5]
+    return {
+        "p50_ms": 1000 * statistics.median(seconds),
+        "min_ms": 1000 * min(seconds),
+        "heaviest": {name: round(1000 * value, 2) for name, value in heaviest},
+        "eager": sorted(LAZY_PACKAGES & (imported - startup)),
+    }
+
+
+def compare(report, baseline, tolerance):
+    #### --------- Prints the relative change of every import; returns the regressions ------###
+    regressions = []
+    for module, result in sorted(report["results"].items()):
+        previous = baseline["results"].get(module)
+        if not previous or not previous["p50_ms"]:
+            continue
+        change = (result["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"]
+        flag = "  REGRESSION" if change > tolerance else ""
+        if flag:
+            regressions.append(module)
+        print(f"{module:<16} {previous['p50_ms']:>9.1f} -> {result['p50_ms']:>9.1f} ms {100 * change:>+8.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument("--output", default="bench_imports.json")
+    parser.add_argument("--baseline", help="report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative slowdown counted as a regression")
+    parser.add_argument("--max-ms", type=float, help="budget for the median import of any module")
+    args = parser.parse_args()
+
+    # Packages the interpreter loads before any of ours (site, sitecustomize) are not counted
+    startup = import_once()[2]
+    results = {}
+    failures = []
+    for module in args.modules:
+        result = results[module] = measure(module, args.runs, startup)
+        heaviest = ", ".join(f"{name} {ms:.0f}ms" for name, ms in result["heaviest"].items())
+        print(f"{module:<16} p50 {result['p50_ms']:8.1f} ms   {heaviest}")
+        if result["eager"]:
+            failures.append(f"{module} imports {', '.join(result['eager'])} at load time")
+        if args.max_ms is not None and result["p50_ms"] > args.max_ms:
+            failures.append(f"{module} takes {result['p50_ms']:.0f} ms to import (budget {args.max_ms:.0f} ms)")
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=HERE)
+    report = {
+        "meta": {"commit": commit.stdout.strip(), "python": platform.python_version(),
+                 "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": args.runs},
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to '{args.output}'.")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            failures += [f"{module} got slower by more than {100 * args.tolerance:.0f}%"
+                         for module in compare(report, json.load(f), args.tolerance)]
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
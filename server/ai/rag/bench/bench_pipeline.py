@@ -0,0 +1,302 @@
+"""Offline benchmark of the whole RAG pipeline and of the Bloom taxonomy generator.
+
+No API key and no network: embeddings come from the deterministic hash
+embedder and the chat model is the local fake server (canned latency). For
+every corpus scale, a fresh process builds a synthetic corpus from
+rag/data/*.txt (each copy varied so that no chunk repeats) and measures:
+
+  chunk      tokenize + split the corpus                (s, chunks, tokens)
+  index      embed + build + persist the vector/BM25 index (s)
+  load       re-open the persisted index                (s)
+  retrieve   hybrid top-k per question                  (latency percentiles)
+  prompt     build the QA prompt                        (latency, prompt tokens)
+  query      QueryRunner end to end, concurrent clients  (latency, throughput)
+  bloom      create_bloom_taxonomy.generate_taxonomy    (latency, questions)
+
+plus the peak RSS of the process. The results are written as JSON; pass
+--baseline with the file of a previous run to print the relative changes and
+exit with status 1 when a metric got worse than --tolerance.
+
+    python bench_pipeline.py --scales 1 10 100 --output bench.json
+    python bench_pipeline.py --scales 1 10 100 --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+BLOOM_DIR = os.path.join(RAG_DIR, "..", "bloomtaxonomy")
+sys.path.insert(0, os.path.join(RAG_DIR, "src"))
+
+# Metrics where a higher value is better; every other timing/size metric is better lower
+HIGHER_IS_BETTER = {"throughput_rps"}
+# Metrics checked against the tolerance (max_ms is a single sample, too noisy to gate on)
+GATED_SUFFIXES = ("p50_ms", "p95_ms", "seconds", "_mb", "_rps")
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        "p50_ms": 1000 * statistics.median(samples),
+        "p95_ms": 1000 * samples[int(0.95 * (len(samples) - 1))],
+        "max_ms": 1000 * samples[-1],
+    }
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def build_corpus(scale, path, seed=0):
+    #### --------- rag/data/*.txt repeated `scale` times; the lines of each copy are tagged and shuffled ------###
+    #### --------- within their paragraph so every chunk (and every embedding) is new ------###
+    data_dir = os.path.join(RAG_DIR, "data")
+    base = []
+    for name in sorted(os.listdir(data_dir)):
+        if name.endswith(".txt"):
+            with open(os.path.join(data_dir, name), 'r', encoding='utf-8') as f:
+                base.append(f.read())
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as out:
+        for copy in range(scale):
+            for text in base:
+                for paragraph in text.split("\n\n"):
+                    lines = [line for line in paragraph.split("\n") if line.strip()]
+                    if copy:
+                        lines = [f"{line} (partie {copy})" for line in lines]
+                        rng.shuffle(lines)
+                    out.write("\n".join(lines) + "\n\n")
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def sample_questions(text, count, seed=0):
+    #### --------- Questions made of words of the corpus, so lexical and dense retrieval both have hits ------###
+    rng = random.Random(seed)
+    lines = [line.strip() for line in text.split("\n") if len(line.split()) >= 6]
+    questions = []
+    for _ in range(count):
+        words = rng.choice(lines).split()
+        start = rng.randrange(0, len(words) - 5)
+        questions.append("Qu'est-ce que " + " ".join(words[start:start + 6]) + " ?")
+    return questions
+
+
+def configure(workdir, llm_port):
+    #### --------- Offline settings; must run before llm/corpus/main are imported ------###
+    import config
+    config.EMBEDDING_BACKEND = "hash"
+    config.VECTOR_BACKEND = "numpy"
+    config.LLM_BASE_URL = f"http://127.0.0.1:{llm_port}/v1"
+    config.INDEX_DIR = os.path.join(workdir, "index")
+    config.EMBEDDING_CACHE_PATH = os.path.join(workdir, "embeddings.sqlite")
+    config.CORPUS_INDEX_DIR = os.path.join(workdir, "corpus")
+    sys.modules.setdefault("keys", types.SimpleNamespace(key="fake-key"))
+    # create_bloom_taxonomy goes through bloomtaxonomy/router.py, whose default backend is Groq: its base URL and
+    # key are read from these variables (settings/providers.py, settings/api.py), pointed at the same fake server
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{llm_port}"
+    os.environ.setdefault("GROQ_API_KEY", "fake-key")
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+async def run_queries(runner, questions, concurrency):
+    latencies = []
+    queue = list(questions)
+
+    async def client():
+        while queue:
+            question = queue.pop()
+            start = time.perf_counter()
+            await runner.arun_query(question)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+def run_scale(args):
+    #### --------- Runs in a child process, prints one JSON line of measurements ------###
+    import fake_llm_server
+    workdir = tempfile.mkdtemp(prefix=f"rag-bench-{args.child}-")
+    configure(workdir, args.llm_port)
+
+    with open(os.path.join(BLOOM_DIR, "generated_taxonomy_20241128_023527.json"), 'r', encoding='utf-8') as f:
+        taxonomy = f.read()
+
+    def reply(messages):
+        # The Bloom prompt gets a canned taxonomy, RAG questions a short canned answer
+        if "Bloom" in messages[-1]["content"]:
+            return taxonomy
+        return "Réponse : " + " ".join(messages[-1]["content"].split()[:40])
+
+    fake_llm_server.serve_in_thread(
+        fake_llm_server.create_app(latency=args.latency, reply=reply, token_delay=args.token_delay), args.llm_port)
+
+    import config
+    import llm
+    import llm_router
+    import tokenization
+
+    scale = args.child
+    document_path = os.path.join(workdir, f"corpus_x{scale}.txt")
+    text = build_corpus(scale, document_path)
+    tokenizer = tokenization.TextTokenizer()
+    result = {"scale": scale, "corpus_chars": len(text), "stages": {}}
+    stages = result["stages"]
+
+    spans, seconds = timed(lambda: list(tokenizer.iter_file_chunks(document_path)))
+    stages["chunk"] = {"seconds": seconds, "chunks": len(spans),
+                       "tokens": sum(tokenizer.count_tokens(span.text) for span in spans)}
+
+    index = llm.DocumentIndex(document_path, config.INDEX_DIR)
+    _, seconds = timed(index.load)
+    stages["index"] = {"seconds": seconds}
+    _, seconds = timed(llm.DocumentIndex(document_path, config.INDEX_DIR).load)
+    stages["load"] = {"seconds": seconds}
+
+    chunk_store = index.chunk_store
+    questions = sample_questions(text, args.queries)
+    latencies, retrieved = [], []
+    for question in questions:
+        chunks, seconds = timed(chunk_store.retrieve_top_n_chunks, question, config.TOP_N_CHUNKS)
+        latencies.append(seconds)
+        retrieved.append(chunks)
+    stages["retrieve"] = percentiles(latencies)
+
+    latencies, prompt_tokens = [], []
+    for question, chunks in zip(questions, retrieved):
+        messages, seconds = timed(llm.build_messages, question, chunks)
+        latencies.append(seconds)
+        prompt_tokens.append(sum(tokenizer.count_tokens(m["content"]) for m in messages))
+    stages["prompt"] = {**percentiles(latencies), "prompt_tokens_p50": statistics.median(prompt_tokens),
+                        "prompt_tokens_max": max(prompt_tokens)}
+
+    async def query_stage():
+        runner = llm.QueryRunner(document_path, chunk_store=chunk_store)
+        try:
+            return await run_queries(runner, questions, args.concurrency)
+        finally:
+            await llm_router.get_router().aclose()
+
+    latencies, elapsed = asyncio.run(query_stage())
+    stages["query"] = {**percentiles(latencies), "throughput_rps": len(latencies) / elapsed,
+                       "concurrency": args.concurrency}
+
+    if args.bloom_runs:
+        sys.path.insert(0, BLOOM_DIR)
+        import create_bloom_taxonomy
+        latencies, counts = [], []
+        for run in range(args.bloom_runs):
+            collector, seconds = timed(create_bloom_taxonomy.generate_taxonomy,
+                                       {"The topic questions": questions[run % len(questions)]},
+                                       create_bloom_taxonomy.Bloom_prompt)
+            latencies.append(seconds)
+            counts.append(sum(len(items) for items in collector.taxonomy.values()))
+        stages["bloom"] = {**percentiles(latencies), "questions_p50": statistics.median(counts)}
+
+    result["peak_rss_mb"] = peak_rss_mb()
+    print(json.dumps(result))
+
+
+def flatten(results):
+    #### --------- {"x10.query.p95_ms": value, ...} of every numeric metric of a report ------###
+    flat = {}
+    for result in results:
+        prefix = f"x{result['scale']}"
+        flat[f"{prefix}.peak_rss_mb"] = result["peak_rss_mb"]
+        for stage, metrics in result["stages"].items():
+            for name, value in metrics.items():
+                flat[f"{prefix}.{stage}.{name}"] = value
+    return flat
+
+
+def compare(report, baseline, tolerance):
+    #### --------- Prints the relative change of every timing/size metric; returns the regressions ------###
+    current, previous = flatten(report["results"]), flatten(baseline["results"])
+    regressions = []
+    for key in sorted(current):
+        if key not in previous or not previous[key]:
+            continue
+        change = (current[key] - previous[key]) / previous[key]
+        name = key.rsplit(".", 1)[-1]
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = "  REGRESSION" if name.endswith(GATED_SUFFIXES) and worse > tolerance else ""
+        if flag:
+            regressions.append(key)
+        print(f"{key:<40} {previous[key]:>12.3f} -> {current[key]:>12.3f} {100 * change:>+8.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--queries", type=int, default=50, help="questions per scale")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients of the query stage")
+    parser.add_argument("--bloom-runs", type=int, default=3, help="taxonomies generated per scale (0 to skip)")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake LLM latency in seconds")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="fake LLM delay between streamed tokens")
+    parser.add_argument("--llm-port", type=int, default=8110)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--baseline", help="report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown counted as a regression")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_scale(args)
+        return
+
+    results = []
+    for scale in args.scales:
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", str(scale), "--queries", str(args.queries),
+             "--concurrency", str(args.concurrency), "--bloom-runs", str(args.bloom_runs),
+             "--latency", str(args.latency), "--token-delay", str(args.token_delay), "--llm-port", str(args.llm_port)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        s = result["stages"]
+        print(f"x{scale:<5} {result['corpus_chars'] / 1e6:7.2f} MB  {s['chunk']['chunks']:>7} chunks"
+              f"  chunk {s['chunk']['seconds']:7.2f}s  index {s['index']['seconds']:7.2f}s"
+              f"  load {s['load']['seconds']:6.3f}s  retrieve p95 {s['retrieve']['p95_ms']:7.2f}ms"
+              f"  query {s['query']['throughput_rps']:6.1f} req/s  RSS {result['peak_rss_mb']:7.1f} MB")
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=HERE)
+    report = {
+        "meta": {"commit": commit.stdout.strip(), "python": platform.python_version(),
+                 "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "fake_llm_latency": args.latency,
+                 "queries": args.queries, "concurrency": args.concurrency},
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to '{args.output}'.")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {100 * args.tolerance:.0f}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
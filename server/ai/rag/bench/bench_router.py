@@ -0,0 +1,133 @@
+"""Latency and availability of the LLM router (rag/src/llm_router.py).
+
+Starts two fake LLM servers with different latency profiles:
+
+  fast    --fast-latency per call, but --tail-rate of the calls take --tail-latency
+  steady  --steady-latency per call, no tail
+
+and sends the same chat calls through three clients:
+
+  single  the fast server only (what a single provider gives)
+  routed  both servers, to the one with the lowest expected latency, failing over on errors
+  hedged  routed, plus a second call to the other server when the first is slower than its p95
+
+Every run lasts --seconds; in its middle third the fast server answers every
+call with a 500 (an outage): the router should stop sending it calls (circuit breaker), fail
+over to the steady one, and come back to the fast one once the outage is over.
+The run reports p50/p95/p99 latency, failed calls and the calls per server,
+and fails if routing loses calls or if hedging does not cut the p99.
+
+    python bench_router.py --seconds 12 --concurrency 8
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import fake_llm_server  # noqa: E402
+import config  # noqa: E402
+import llm_router  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "Qu'est-ce qu'une onde mécanique ?"}]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def run(client, apps, args):
+    #### --------- Sends calls for --seconds, --concurrency at a time; the fast server is down in the middle third ------###
+    latencies, errors = [], 0
+    started = time.perf_counter()
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() - started < args.seconds:
+            elapsed = time.perf_counter() - started
+            apps["fast"].state.error_rate = 1.0 if args.seconds / 3 <= elapsed < 2 * args.seconds / 3 else 0.0
+            start = time.perf_counter()
+            try:
+                await client.chat(MESSAGES, model="fake")
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+                # A failed call is retried by the user after a while, not in a tight loop
+                await asyncio.sleep(args.fast_latency)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    finally:
+        await client.aclose()
+        apps["fast"].state.error_rate = 0.0
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=12.0, help="duration of each run")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--fast-latency", type=float, default=0.05)
+    parser.add_argument("--tail-rate", type=float, default=0.03, help="share of the fast server's slow calls")
+    parser.add_argument("--tail-latency", type=float, default=1.0)
+    parser.add_argument("--steady-latency", type=float, default=0.12)
+    parser.add_argument("--cooldown", type=float, default=1.0, help="seconds a tripped circuit stays open")
+    parser.add_argument("--port", type=int, default=8140, help="first of the two fake server ports")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    config.ROUTER_BREAKER_COOLDOWN = args.cooldown
+    apps = {"fast": fake_llm_server.create_app(latency=args.fast_latency, slow_rate=args.tail_rate,
+                                               slow_latency=args.tail_latency),
+            "steady": fake_llm_server.create_app(latency=args.steady_latency)}
+    urls = {}
+    for offset, (name, app) in enumerate(apps.items()):
+        fake_llm_server.serve_in_thread(app, args.port + offset)
+        urls[name] = f"http://127.0.0.1:{args.port + offset}/v1"
+
+    def backends(names):
+        return [{"name": name, "base_url": urls[name], "api_key": "fake"} for name in names]
+
+    clients = {"single": llm_router.LLMRouter(backends(["fast"]), hedge=False, explore_rate=0),
+               "routed": llm_router.LLMRouter(backends(["fast", "steady"]), hedge=False),
+               "hedged": llm_router.LLMRouter(backends(["fast", "steady"]), hedge=True)}
+    results = []
+    for name, client in clients.items():
+        before = {server: app.state.calls["chat"] for server, app in apps.items()}
+        start = time.perf_counter()
+        latencies, errors = asyncio.run(run(client, apps, args))
+        seconds = time.perf_counter() - start
+        calls = {server: app.state.calls["chat"] - before[server] for server, app in apps.items()}
+        results.append({"client": name, "ok": len(latencies), "errors": errors, "seconds": seconds,
+                        "p50_ms": 1000 * statistics.median(latencies), "p95_ms": 1000 * percentile(latencies, 0.95),
+                        "p99_ms": 1000 * percentile(latencies, 0.99), "calls": calls,
+                        "hedged": client.counters["hedged"], "failovers": client.counters["failovers"]})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'client':<7} {'ok':>5} {'errors':>6} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'fast':>5} "
+              f"{'steady':>6} {'hedged':>6} {'failovers':>9}")
+        for r in results:
+            print(f"{r['client']:<7} {r['ok']:>5} {r['errors']:>6} {r['p50_ms']:>7.0f} {r['p95_ms']:>7.0f} "
+                  f"{r['p99_ms']:>7.0f} {r['calls']['fast']:>5} {r['calls']['steady']:>6} {r['hedged']:>6} "
+                  f"{r['failovers']:>9}")
+
+    by_client = {r["client"]: r for r in results}
+    failures = [f"{name}: {by_client[name]['errors']} failed calls" for name in ("routed", "hedged")
+                if by_client[name]["errors"]]
+    if by_client["hedged"]["p99_ms"] >= by_client["single"]["p99_ms"]:
+        failures.append("hedging did not cut the p99 latency")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Summary tree of a long transcript and what broad questions cost with it (rag/src/summaries.py).
+
+Offline (hash embedder, fake chat model whose "summary" is the first words
+of its input, as many as the prompt asks for). Builds the index and the
+summary tree of --document with one summary call at a time and with
+--workers in parallel, and reports the levels, the calls and the build time
+of each. Then asks every question of QUESTIONS and checks the level it is
+routed to; for the broad ones it compares the prompt built from retrieved
+chunks (what every question got before) with the one built from summaries:
+
+  tokens     prompt tokens of the question
+  coverage   share of the document the context stands for (the character
+             ranges of its chunks, or of the chunks its summaries cover)
+
+The run fails if a question is routed to the wrong level, or if a question
+about the whole document gets a prompt that does not cover all of it or is
+larger than the chunk one.
+
+    python bench_summaries.py --document ../data/1_transcript.txt --latency 0.2 --workers 8
+"""
+import os
+import re
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+sys.path.insert(0, os.path.join(RAG_DIR, "src"))
+
+import fake_llm_server  # noqa: E402
+
+# (question, expected route: "document", "section" or None for chunk retrieval)
+QUESTIONS = [
+    ("Résume la séance.", "document"),
+    ("Peux-tu me faire un résumé de tout le document ?", "document"),
+    ("Quels sont les points clés ?", "document"),
+    ("Summarize the lecture", "document"),
+    ("Fais un résumé de la partie sur le magasin de Madison Avenue.", "section"),
+    ("What are the main points about the dividend and the vote of the resolutions?", "section"),
+    ("Qui est le représentant de la société H51 ?", None),
+    ("Quel est le chiffre d'affaires de l'exercice 2022 ?", None),
+    ("What is this lecture about?", "document"),
+    # Detail questions that merely contain "about": their numbers and formulas are in the chunks, not the summaries
+    ("What is the speed of sound in air at about 20 degrees?", None),
+    ("What is the wavelength about?", None),
+    ("What is a progressive wave, and what is the delay about when the distance is 170 m?", None),
+]
+
+
+def reply(messages):
+    #### --------- First words of the text to summarize, as many as the prompt asks for ------###
+    content = messages[-1]["content"]
+    asked = re.search(r"at most (\d+) words", content)
+    if asked is None:
+        return "Fake answer."
+    text = content.split("----------------\n", 1)[1]
+    return " ".join(text.split()[:int(asked.group(1))])
+
+
+def configure(workdir, llm_port):
+    #### --------- Offline settings; must run before llm/summaries are imported ------###
+    import config
+    config.EMBEDDING_BACKEND = "hash"
+    config.VECTOR_BACKEND = "numpy"
+    config.LLM_BASE_URL = f"http://127.0.0.1:{llm_port}/v1"
+    config.INDEX_DIR = os.path.join(workdir, "index")
+    config.EMBEDDING_CACHE_PATH = os.path.join(workdir, "embeddings.sqlite")
+    sys.modules.setdefault("keys", types.SimpleNamespace(key="fake-key"))
+
+
+def coverage(chunks, length):
+    #### --------- Share of the document's characters in the union of the ranges the context stands for ------###
+    ranges = sorted(tuple(chunk.metadata["range"]) if "range" in chunk.metadata
+                    else (chunk.metadata["start"], chunk.metadata["end"]) for chunk in chunks)
+    covered, end = 0, 0
+    for a, b in ranges:
+        a = max(a, end)
+        if b > a:
+            covered += b - a
+            end = b
+    return covered / length
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--document", default=os.path.join(RAG_DIR, "data", "1_transcript.txt"))
+    parser.add_argument("--workers", type=int, default=8, help="summary calls in flight in the parallel build")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake LLM latency in seconds")
+    parser.add_argument("--reduce-words", type=int, help="length asked for the section and document summaries "
+                                                          "(default: SUMMARY_REDUCE_WORDS)")
+    parser.add_argument("--llm-port", type=int, default=8170)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-summaries-")
+    configure(workdir, args.llm_port)
+    fake_llm_server.serve_in_thread(fake_llm_server.create_app(latency=args.latency, reply=reply), args.llm_port)
+    import llm
+    import llm_router
+    import summaries
+    import context_packer
+    if args.reduce_words:
+        llm.config.SUMMARY_REDUCE_WORDS = args.reduce_words
+
+    index = llm.DocumentIndex(args.document)
+    index.load()
+    directory = os.path.join(index.index_dir, index.key)
+    chunks, metadatas = llm.chunk_document(args.document)
+    with open(args.document, 'r', encoding='utf-8') as f:
+        length = len(f.read())
+
+    builds = []
+    for workers in (1, args.workers):
+        async def run():
+            try:
+                return await summaries.build_tree(chunks, metadatas, workers=workers)
+            finally:
+                await llm_router.get_router().aclose()
+
+        start = time.perf_counter()
+        texts, nodes, cost = asyncio.run(run())
+        levels = [sum(node["level"] == level for node in nodes) for level in range(nodes[-1]["level"] + 1)]
+        builds.append({"workers": workers, "seconds": time.perf_counter() - start, "levels": levels, **cost})
+    tree = {"model": "fake", "prompt_version": summaries.PROMPT_VERSION, "levels": levels, **cost,
+            "embedding_model": llm.embeddings.get_embeddings().model}
+    summaries.save(os.path.join(directory, summaries.SUMMARY_DIR), texts, nodes, tree)
+    index.chunk_store = None
+    chunk_store = index.load()
+
+    async def prompts(question):
+        #### --------- (chunk prompt, routed prompt) of a question, as QueryRunner builds them ------###
+        runner = llm.QueryRunner(args.document, chunk_store=chunk_store)
+        vector = await asyncio.to_thread(llm.embeddings.get_embeddings().embed_query, question)
+        routed = await runner.aretrieve(question, vector)
+        plain = chunk_store.retrieve(question, vector)
+        return plain, routed
+
+    questions, failures = [], []
+    for question, expected in QUESTIONS:
+        level = summaries.route(question)
+        plain, routed = asyncio.run(prompts(question))
+        row = {"question": question, "route": level or "chunks"}
+        for name, context in (("chunks", plain), ("routed", routed)):
+            messages = llm.build_messages(question, context)
+            row[f"{name}_tokens"] = sum(context_packer.count_tokens(m["content"]) for m in messages)
+            row[f"{name}_coverage"] = coverage(context, length)
+        questions.append(row)
+        if level != expected:
+            failures.append(f"'{question}' routed to {level or 'chunks'}, expected {expected or 'chunks'}")
+        elif level == "document" and (row["routed_coverage"] < 0.99 or row["routed_tokens"] > row["chunks_tokens"]):
+            failures.append(f"'{question}': the document summary covers {row['routed_coverage']:.0%} of it "
+                            f"in {row['routed_tokens']} tokens")
+
+    if args.json:
+        print(json.dumps({"chunks": len(chunks), "builds": builds, "questions": questions}, indent=2))
+    else:
+        print(f"{len(chunks)} chunks of {os.path.basename(args.document)} ({length} characters)")
+        print(f"{'workers':>7} {'levels':<16} {'calls':>6} {'prompt tok':>10} {'seconds':>8}")
+        for b in builds:
+            print(f"{b['workers']:>7} {' -> '.join(map(str, b['levels'])):<16} {b['calls']:>6} "
+                  f"{b['prompt_tokens']:>10} {b['seconds']:>8.2f}")
+        print(f"\n{'route':<9} {'chunk tok':>9} {'covers':>7} {'routed tok':>10} {'covers':>7}  question")
+        for q in questions:
+            print(f"{q['route']:<9} {q['chunks_tokens']:>9} {q['chunks_coverage']:>7.0%} {q['routed_tokens']:>10} "
+                  f"{q['routed_coverage']:>7.0%}  {q['question']}")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Compares the Chroma and the NumPy vector store backends of ChunkStore.
+
+For each backend and corpus size, a fresh process builds (and persists) the
+store from synthetic embeddings, re-opens it from disk, and runs top-k
+queries. Reported: build time, load time, query latency percentiles and the
+resident memory of the process.
+
+    python bench_vector_store.py --sizes 300 3000 30000 --dim 1536 --queries 200
+"""
+import os
+import sys
+import json
+import zlib
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+
+class RandomEmbeddings:
+    #### --------- Deterministic random unit vectors, so only the vector store is measured ------###
+    def __init__(self, dim):
+        self.dim = dim
+
+    def _vector(self, text):
+        rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+        return rng.standard_normal(self.dim).astype(np.float32).tolist()
+
+    def embed_documents(self, texts):
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+def rss_mb():
+    #### --------- Current resident set size of this process ------###
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def run_backend(backend, size, dim, queries, k):
+    #### --------- Runs in a child process, prints one JSON line of measurements ------###
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    if backend == "numpy":
+        from vector_store import NumpyVectorStore as Store
+    else:
+        from langchain.vectorstores import Chroma as Store
+    import_time = time.perf_counter() - start
+
+    embedding = RandomEmbeddings(dim)
+    texts = [f"chunk {i} " + "lorem ipsum " * 20 for i in range(size)]
+    directory = tempfile.mkdtemp(prefix=f"bench-{backend}-")
+
+    start = time.perf_counter()
+    store = Store.from_texts(texts=texts, embedding=embedding, persist_directory=directory)
+    store.persist()
+    build_time = time.perf_counter() - start
+    del store
+
+    start = time.perf_counter()
+    if backend == "numpy":
+        store = Store.load(directory, embedding)
+    else:
+        store = Store(persist_directory=directory, embedding_function=embedding)
+    load_time = time.perf_counter() - start
+
+    vectors = embedding.embed_documents([f"query {i}" for i in range(queries)])
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        store.similarity_search_by_vector(vector, k=k)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    print(json.dumps({
+        "backend": backend, "size": size, "import_s": import_time, "build_s": build_time, "load_s": load_time,
+        "query_p50_ms": 1000 * latencies[len(latencies) // 2],
+        "query_p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+        "rss_mb": rss_mb(), "rss_delta_mb": rss_mb() - rss_start,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["chroma", "numpy"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[300, 3000, 30000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--child", nargs=2, metavar=("BACKEND", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_backend(args.child[0], int(args.child[1]), args.dim, args.queries, args.k)
+        return
+
+    print(f"{'backend':>8} {'chunks':>7} {'import s':>9} {'build s':>8} {'load s':>7}"
+          f" {'p50 ms':>7} {'p95 ms':>7} {'RSS MB':>7}")
+    for size in args.sizes:
+        for backend in args.backends:
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", backend, str(size), "--dim", str(args.dim),
+                 "--queries", str(args.queries), "--k", str(args.k)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            print(f"{r['backend']:>8} {r['size']:>7} {r['import_s']:>9.3f} {r['build_s']:>8.3f} {r['load_s']:>7.3f}"
+                  f" {r['query_p50_ms']:>7.3f} {r['query_p95_ms']:>7.3f} {r['rss_mb']:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
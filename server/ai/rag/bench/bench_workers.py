@@ -0,0 +1,214 @@
+"""Multi-worker benchmark: memory and throughput of /query under uvicorn --workers.
+
+Runs the service with --workers N against the fake LLM server, once per mode:
+
+  build    every worker opens the index built by llm.DocumentIndex (vectors
+           memory-mapped, texts and BM25 index loaded in each process)
+  serving  SERVING_MODE = True: every worker maps the version published by
+           serving.build, nothing of the index is copied into the processes
+
+and reports the throughput, the latency and the memory of the workers: RSS
+counts shared pages once per process, PSS splits them between the processes
+that map them, so the total PSS is what the workers really cost. In serving
+mode a new version is published half-way through the load (unless --no-swap;
+the build competes with the workers for the CPU), and the run fails if a
+request failed or if a worker did not switch to it.
+
+    python bench_workers.py --workers 4 --scale 200
+"""
+import os
+import sys
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+sys.path.insert(0, os.path.join(RAG_DIR, "src"))
+
+from bench_pipeline import build_corpus, sample_questions, percentiles  # noqa: E402
+
+
+def configure():
+    #### --------- Settings of the parent and of every worker, passed through the environment ------###
+    #### --------- (the workers are fresh interpreters); must run before llm/serving/main are imported ------###
+    import config
+    workdir = os.environ["BENCH_WORKDIR"]
+    config.EMBEDDING_BACKEND = "hash"
+    config.VECTOR_BACKEND = "numpy"
+    config.LLM_BASE_URL = f"http://127.0.0.1:{os.environ['BENCH_LLM_PORT']}/v1"
+    config.DOCUMENT_PATH = os.path.join(workdir, "document.txt")
+    config.INDEX_DIR = os.path.join(workdir, "index")
+    config.SERVING_INDEX_DIR = os.path.join(workdir, "serving")
+    config.SERVING_MODE = os.environ.get("BENCH_MODE") == "serving"
+    config.EMBEDDING_CACHE_PATH = os.path.join(workdir, "embeddings.sqlite")
+    config.CORPUS_DIR = os.path.join(workdir, "corpus-data")
+    config.CORPUS_INDEX_DIR = os.path.join(workdir, "corpus")
+    config.INGEST_DB_PATH = os.path.join(workdir, "jobs.sqlite")
+    config.INGEST_UPLOAD_DIR = os.path.join(workdir, "uploads")
+    os.makedirs(config.CORPUS_DIR, exist_ok=True)
+    sys.modules.setdefault("keys", types.SimpleNamespace(key="fake-key"))
+
+
+def create_app():
+    #### --------- uvicorn factory, called in each worker ------###
+    configure()
+    import main
+    return main.app
+
+
+def memory_mb(pid):
+    #### --------- (RSS, PSS) of a process in MB, from /proc (Linux) ------###
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if name in ("Rss", "Pss"):
+                values[name] = int(rest.split()[0]) / 1024
+    return values["Rss"], values["Pss"]
+
+
+def worker_pids(pid):
+    #### --------- Workers started by the uvicorn supervisor (not the multiprocessing resource tracker) ------###
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        children = [int(child) for child in f.read().split()]
+    workers = []
+    for child in children:
+        with open(f"/proc/{child}/cmdline", 'rb') as f:
+            if b"spawn_main" in f.read():
+                workers.append(child)
+    return workers
+
+
+async def run_load(url, questions, concurrency, requests, halfway=None):
+    #### --------- `halfway` runs in a thread once half of the requests are done, without pausing the clients ------###
+    latencies, errors = [], []
+    done = 0
+    background = []
+
+    async def client(http, offset):
+        nonlocal done
+        for i in range(requests):
+            start = time.perf_counter()
+            response = await http.get(f"{url}/query", params={"query": questions[(offset + i) % len(questions)],
+                                                               "no_cache": True})
+            if response.status_code != 200:
+                errors.append(response.status_code)
+            latencies.append(time.perf_counter() - start)
+            done += 1
+            if halfway is not None and done == concurrency * requests // 2:
+                background.append(asyncio.create_task(asyncio.to_thread(halfway)))
+
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=concurrency)) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http, c * requests) for c in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    await asyncio.gather(*background)
+    return {"throughput_rps": len(latencies) / elapsed, "errors": len(errors), **percentiles(latencies)}
+
+
+async def served_versions(url, workers):
+    #### --------- Versions reported by the workers, sampled until every worker answered (or 20 tries per worker) ------###
+    versions = {}
+    async with httpx.AsyncClient(timeout=10) as http:
+        for _ in range(20 * workers):
+            # A new connection each time, so the requests are spread over the workers
+            response = await http.get(f"{url}/index", headers={"Connection": "close"})
+            body = response.json()
+            versions[body["pid"]] = body.get("version", body.get("key"))
+            if len(versions) == workers:
+                break
+    return versions
+
+
+def run_mode(mode, args, questions):
+    os.environ["BENCH_MODE"] = mode
+    import config
+    import llm
+    import serving
+    if mode == "serving":
+        serving.build(force=True)
+    else:
+        llm.DocumentIndex(config.DOCUMENT_PATH).get_chunk_store()
+
+    url = f"http://127.0.0.1:{args.app_port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "bench_workers:create_app", "--factory", "--workers", str(args.workers),
+         "--port", str(args.app_port), "--log-level", "warning"],
+        cwd=RAG_DIR, env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [HERE, os.path.join(RAG_DIR, "src"),
+                                                                          os.environ.get("PYTHONPATH")]))))
+    try:
+        deadline = time.time() + 120
+        while True:
+            try:
+                if len(asyncio.run(served_versions(url, args.workers))) == args.workers:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.time() > deadline or server.poll() is not None:
+                raise RuntimeError(f"{mode}: the workers did not start")
+            time.sleep(0.5)
+
+        published = []
+        halfway = None
+        if mode == "serving" and args.swap:
+            halfway = lambda: published.append(serving.build(force=True)["version"])  # noqa: E731
+        result = asyncio.run(run_load(url, questions, args.concurrency, args.requests, halfway))
+        pids = worker_pids(server.pid)
+        memory = [memory_mb(pid) for pid in pids]
+        result.update(workers=len(pids), rss_mb=sum(rss for rss, _ in memory), pss_mb=sum(pss for _, pss in memory))
+        if published:
+            versions = asyncio.run(served_versions(url, args.workers))
+            result["switched"] = sum(version == published[0] for version in versions.values())
+        return result
+    finally:
+        server.terminate()
+        server.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--scale", type=int, default=200, help="copies of rag/data/*.txt in the served document")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=20, help="requests sent by each client")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake LLM latency in seconds")
+    parser.add_argument("--modes", nargs="+", default=["build", "serving"], choices=["build", "serving"])
+    parser.add_argument("--no-swap", dest="swap", action="store_false",
+                        help="do not publish a new version during the serving run")
+    parser.add_argument("--llm-port", type=int, default=8110)
+    parser.add_argument("--app-port", type=int, default=8111)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-workers-")
+    os.environ.update(BENCH_WORKDIR=workdir, BENCH_LLM_PORT=str(args.llm_port))
+    configure()
+    import fake_llm_server  # imports embeddings, so only once the cache path is set
+    fake_llm_server.serve_in_thread(fake_llm_server.create_app(latency=args.latency, token_delay=0),
+                                    args.llm_port)
+    text = build_corpus(args.scale, os.path.join(workdir, "document.txt"))
+    questions = sample_questions(text, 200)
+
+    failed = False
+    print(f"{'mode':<8} {'workers':>7} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'RSS (MB)':>9} "
+          f"{'PSS (MB)':>9} {'errors':>6}")
+    for mode in args.modes:
+        result = run_mode(mode, args, questions)
+        print(f"{mode:<8} {result['workers']:>7} {result['throughput_rps']:>8.1f} {result['p50_ms']:>9.1f} "
+              f"{result['p95_ms']:>9.1f} {result['rss_mb']:>9.1f} {result['pss_mb']:>9.1f} {result['errors']:>6}")
+        failed |= result["errors"] > 0
+        if "switched" in result:
+            print(f"         {result['switched']}/{result['workers']} workers switched to the version published "
+                  f"during the load")
+            failed |= result["switched"] != result["workers"]
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
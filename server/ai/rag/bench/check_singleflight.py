@@ -0,0 +1,114 @@
+"""Concurrency check of the request coalescing (single flight) of /query and /query/stream.
+
+Starts the fake OpenAI-compatible server and the RAG service in this process,
+fires bursts of concurrent requests and counts the chat completions the fake
+server received during each burst:
+
+  same question, N clients                    /query          -> 1 upstream call
+  same question up to case/spaces/"?"         /query          -> 1 upstream call
+  same question, N streaming clients          /query/stream   -> 1 upstream call,
+                                                                 every client gets the whole answer
+  N different questions                       /query          -> N upstream calls
+
+The answer cache is bypassed (no_cache=true) so only the coalescing can save
+calls. Exits with status 1 if a burst made a different number of calls, or if
+a client got a different answer than the others.
+
+    python check_singleflight.py --clients 50 --latency 0.5
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+sys.path.insert(0, os.path.join(RAG_DIR, "src"))
+
+import fake_llm_server  # noqa: E402
+from load_test import configure  # noqa: E402
+
+QUESTION = "Qu'est-ce qu'une onde mécanique progressive ?"
+
+
+async def ask(http, url, query):
+    response = await http.get(f"{url}/query", params={"query": query, "no_cache": True})
+    response.raise_for_status()
+    return response.json()["response"]["result"]
+
+
+async def ask_stream(http, url, query):
+    #### --------- (event names, answer) of one /query/stream request ------###
+    events, tokens = [], []
+    async with http.stream("GET", f"{url}/query/stream", params={"query": query, "no_cache": True}) as response:
+        response.raise_for_status()
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+                events.append(event)
+            elif line.startswith("data:") and event == "token":
+                tokens.append(json.loads(line[len("data:"):]))
+    return events, "".join(tokens)
+
+
+async def burst(url, llm_url, requests):
+    #### --------- (answers, chat calls made upstream) of requests sent all at once ------###
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=len(requests))) as http:
+        before = (await http.get(f"{llm_url}/stats")).json().get("chat", 0)
+        answers = await asyncio.gather(*(request(http, url, query) for request, query in requests))
+        after = (await http.get(f"{llm_url}/stats")).json().get("chat", 0)
+    return answers, after - before
+
+
+def run_checks(url, llm_url, clients):
+    variants = [QUESTION, QUESTION.upper(), "  " + QUESTION.replace(" ", "   "), QUESTION.rstrip(" ?")]
+    checks = [
+        ("same question", [(ask, QUESTION)] * clients, 1),
+        ("same question, variants", [(ask, variants[i % len(variants)]) for i in range(clients)], 1),
+        ("same question, streamed", [(ask_stream, QUESTION)] * clients, 1),
+        ("different questions", [(ask, f"{QUESTION} ({i})") for i in range(clients)], clients),
+    ]
+    failures = []
+    print(f"{'burst':<26} {'clients':>7} {'upstream calls':>15} {'expected':>9}")
+    for name, requests, expected in checks:
+        answers, calls = asyncio.run(burst(url, llm_url, requests))
+        print(f"{name:<26} {len(requests):>7} {calls:>15} {expected:>9}")
+        if calls != expected:
+            failures.append(f"{name}: {calls} upstream calls, expected {expected}")
+        if expected == 1 and len({json.dumps(answer) for answer in answers}) != 1:
+            failures.append(f"{name}: the clients did not all get the same answer")
+        if name.endswith("streamed") and any(events[0] != "sources" or events[-1] != "done" for events, _ in answers):
+            failures.append(f"{name}: a stream did not go from sources to done")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency in seconds")
+    parser.add_argument("--llm-port", type=int, default=8120)
+    parser.add_argument("--app-port", type=int, default=8121)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-singleflight-")
+    fake_llm_server.serve_in_thread(fake_llm_server.create_app(latency=args.latency), args.llm_port)
+    configure(args.llm_port, workdir)
+
+    os.chdir(RAG_DIR)  # main.py serves ./static
+    import main
+    fake_llm_server.serve_in_thread(main.app, args.app_port)
+
+    failures = run_checks(f"http://127.0.0.1:{args.app_port}", f"http://127.0.0.1:{args.llm_port}", args.clients)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Local stand-in for an OpenAI-compatible API (chat completions + embeddings).
+
+Every call sleeps for a canned latency before answering (and, for streamed
+completions, for a canned delay between tokens), so the throughput of the
+service can be measured without network access or API keys.
+
+    python fake_llm_server.py --port 8100 --latency 0.5
+
+It answers on both /v1/... (OpenAI) and /openai/v1/... (Groq) paths.
+--reply-file serves a fixed completion (e.g. a generated taxonomy) and
+--rate-limit-rate answers that fraction of the completions with a 429,
+--error-rate with a 500, and --slow-rate makes that fraction of the calls
+take --slow-latency instead (a latency tail).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import embeddings  # noqa: E402
+
+
+def create_app(latency=0.2, jitter=0.0, reply=None, token_delay=0.02, rate_limit_rate=0.0, error_rate=0.0,
+               slow_rate=0.0, slow_latency=2.0):
+    #### --------- Builds the fake API; `reply(messages)` can override the canned completion ------###
+    #### --------- `rate_limit_rate` of the completions are refused with 429 + Retry-After, `error_rate` ------###
+    #### --------- fail with 500 (app.state.error_rate can be changed while it runs, e.g. for an outage) ------###
+    #### --------- and `slow_rate` of the calls take `slow_latency` seconds instead of `latency` ------###
+    app = FastAPI()
+    app.state.calls = Counter()
+    app.state.error_rate = error_rate
+    embedder = embeddings.HashEmbeddings()
+
+    async def wait():
+        if random.random() < slow_rate:
+            app.state.calls["slow"] += 1
+            await asyncio.sleep(slow_latency)
+            return
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+    def complete(messages):
+        if reply is not None:
+            return reply(messages)
+        question = messages[-1]["content"] if messages else ""
+        return f"Fake answer to: {question[:200]}"
+
+    async def chat_completions(request: Request):
+        try:
+            body = await request.json()
+        except ClientDisconnect:
+            # A hedged call cancelled by the client before its body was read
+            return Response(status_code=499)
+        app.state.calls["chat"] += 1
+        if random.random() < rate_limit_rate:
+            app.state.calls["rate_limited"] += 1
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                                status_code=429, headers={"retry-after": "1"})
+        if random.random() < app.state.error_rate:
+            app.state.calls["errors"] += 1
+            return JSONResponse({"error": {"message": "Internal server error", "type": "server_error"}},
+                                status_code=500)
+        await wait()
+        content = complete(body.get("messages", []))
+        if body.get("stream"):
+            return StreamingResponse(stream(body, content), media_type="text/event-stream")
+        prompt_tokens = sum(len(m.get("content", "").split()) for m in body.get("messages", []))
+        return {
+            "id": f"chatcmpl-fake-{app.state.calls['chat']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content.split()),
+                      "total_tokens": prompt_tokens + len(content.split())},
+        }
+
+    async def stream(body, content):
+        for i, word in enumerate(content.split(" ")):
+            if i:
+                await asyncio.sleep(token_delay)
+            piece = word if i == 0 else " " + word
+            chunk = {"object": "chat.completion.chunk", "model": body.get("model", "fake"),
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    async def create_embeddings(request: Request):
+        body = await request.json()
+        app.state.calls["embeddings"] += 1
+        await wait()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        vectors = embedder.embed_documents(texts)
+        return {
+            "object": "list",
+            "model": body.get("model", "fake"),
+            "data": [{"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    async def stats():
+        return dict(app.state.calls)
+
+    for prefix in ("/v1", "/openai/v1"):
+        app.post(prefix + "/chat/completions")(chat_completions)
+        app.post(prefix + "/embeddings")(create_embeddings)
+    app.get("/stats")(stats)
+    return app
+
+
+def serve_in_thread(app, port, host="127.0.0.1"):
+    #### --------- Runs an ASGI app under uvicorn in a daemon thread and waits until it accepts requests ------###
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"server on port {port} failed to start")
+        time.sleep(0.01)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds slept before each answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform +/- jitter on the latency")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed tokens")
+    parser.add_argument("--reply-file", help="file whose content is returned as every completion")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of completions answered 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of completions answered 500")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of calls answered after --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="seconds slept before a slow answer")
+    args = parser.parse_args()
+    reply = None
+    if args.reply_file:
+        with open(args.reply_file, 'r', encoding='utf-8') as f:
+            canned = f.read()
+        reply = lambda messages: canned  # noqa: E731
+    app = create_app(args.latency, args.jitter, reply, args.token_delay, args.rate_limit_rate, args.error_rate,
+                     args.slow_rate, args.slow_latency)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,99 @@
+"""Load test of the /query endpoint against the local fake LLM server.
+
+Starts the fake OpenAI-compatible server and the RAG service (both under
+uvicorn, on local ports), then runs waves of concurrent clients and reports
+throughput and latency per concurrency level. With a non-blocking query path
+the throughput grows with the number of clients until LLM_MAX_CONCURRENCY.
+
+    python load_test.py --concurrency 1 2 4 8 16 --requests 10 --latency 0.5
+"""
+import os
+import sys
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RAG_DIR = os.path.join(HERE, "..")
+sys.path.insert(0, os.path.join(RAG_DIR, "src"))
+
+import fake_llm_server  # noqa: E402
+
+
+def configure(llm_port, workdir):
+    #### --------- Points the service at the fake server; must run before main/llm are imported ------###
+    import config
+    config.LLM_BASE_URL = f"http://127.0.0.1:{llm_port}/v1"
+    config.EMBEDDING_BACKEND = "hash"
+    config.DOCUMENT_PATH = os.path.join(RAG_DIR, "data", "exos.txt")
+    config.INDEX_DIR = os.path.join(workdir, "index")
+    config.EMBEDDING_CACHE_PATH = os.path.join(workdir, "embeddings.sqlite")
+    config.CORPUS_DIR = os.path.join(RAG_DIR, "data")
+    config.CORPUS_INDEX_DIR = os.path.join(workdir, "corpus")
+    config.INGEST_DB_PATH = os.path.join(workdir, "jobs.sqlite")
+    config.INGEST_UPLOAD_DIR = os.path.join(workdir, "uploads")
+    # main.py reads the API key from the (git-ignored) keys module
+    sys.modules.setdefault("keys", types.SimpleNamespace(key="fake-key"))
+
+
+async def client(http, url, wave, number, requests, latencies):
+    #### --------- Questions unique to the client and the wave, answer cache skipped: every request reaches ------###
+    #### --------- the LLM, none is served from the cache or joins another one in flight (singleflight) ------###
+    for i in range(requests):
+        start = time.perf_counter()
+        query = f"Qu'est-ce qu'une onde mécanique ? ({wave}-{number}-{i})"
+        response = await http.get(url, params={"query": query, "no_cache": "true"})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_wave(url, wave, concurrency, requests):
+    latencies = []
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=concurrency)) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http, url, wave, number, requests, latencies)
+                               for number in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": statistics.median(latencies),
+        "p95": latencies[int(0.95 * (len(latencies) - 1))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests", type=int, default=10, help="requests sent by each client")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency in seconds")
+    parser.add_argument("--llm-port", type=int, default=8100)
+    parser.add_argument("--app-port", type=int, default=8101)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-load-")
+    fake_llm_server.serve_in_thread(fake_llm_server.create_app(latency=args.latency), args.llm_port)
+    configure(args.llm_port, workdir)
+
+    os.chdir(RAG_DIR)  # main.py serves ./static
+    import main
+    fake_llm_server.serve_in_thread(main.app, args.app_port)
+    url = f"http://127.0.0.1:{args.app_port}/query"
+
+    print(f"fake LLM latency: {args.latency:.3f}s")
+    print(f"{'clients':>8} {'requests':>9} {'req/s':>8} {'p50 (s)':>8} {'p95 (s)':>8}")
+    for wave, concurrency in enumerate(args.concurrency):
+        result = asyncio.run(run_wave(url, wave, concurrency, args.requests))
+        print(f"{result['concurrency']:>8} {result['requests']:>9} {result['throughput']:>8.2f}"
+              f" {result['p50']:>8.3f} {result['p95']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+import config
+
+
+## ------------------ Cache of generated answers, in front of the LLM call --------------###
+
+CachedAnswer = namedtuple("CachedAnswer", ["answer", "sources", "created"])
+
+
+class AnswerCache:
+    #### --------- Two tiers: exact (normalized query + document version) and semantic (cosine of query embeddings) ------###
+    #### --------- Entries expire after `ttl` seconds; beyond `max_entries` the least recently used one is dropped ------###
+
+    def __init__(self, max_entries=config.ANSWER_CACHE_MAX_ENTRIES, ttl=config.ANSWER_CACHE_TTL,
+                 threshold=config.ANSWER_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (version, normalized query) -> (CachedAnswer, slot)
+        # Query embeddings live in one pre-allocated matrix so a semantic lookup is a single product
+        self._vectors = None
+        self._slot_keys = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self.counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0, "evictions": 0}
+
+    @staticmethod
+    def normalize(query):
+        query = unicodedata.normalize("NFKC", query).casefold()
+        query = re.sub(r"\s+", " ", query)
+        return query.strip(" ?!.")
+
+    def _expired(self, entry):
+        return time.time() - entry.created > self.ttl
+
+    def _drop(self, key):
+        _, slot = self._entries.pop(key)
+        if slot is not None:
+            self._vectors[slot] = 0.0
+            self._slot_keys[slot] = None
+            self._free_slots.append(slot)
+
+    def get_exact(self, query, version):
+        key = (version, self.normalize(query))
+        with self._lock:
+            found = self._entries.get(key)
+            if found is not None and self._expired(found[0]):
+                self._drop(key)
+                found = None
+            if found is None:
+                return None
+            self._entries.move_to_end(key)
+            self.counters["exact_hits"] += 1
+            return found[0]
+
+    def get_similar(self, vector, version):
+        #### ------- Best cached answer for the same document whose query is within the cosine threshold -------###
+        with self._lock:
+            if self._vectors is not None and len(self._entries):
+                query = np.array(vector, dtype=np.float32)
+                query /= np.linalg.norm(query) or 1.0
+                scores = self._vectors @ query
+                candidates = np.flatnonzero(scores >= self.threshold)
+                for slot in candidates[np.argsort(-scores[candidates])]:
+                    key = self._slot_keys[slot]
+                    if key is None or key[0] != version:
+                        continue
+                    entry = self._entries[key][0]
+                    if self._expired(entry):
+                        self._drop(key)
+                        continue
+                    self._entries.move_to_end(key)
+                    self.counters["semantic_hits"] += 1
+                    return entry
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, query, version, vector, answer, sources=()):
+        key = (version, self.normalize(query))
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            while len(self._entries) >= self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+            slot = None
+            if vector is not None:
+                vector = np.asarray(vector, dtype=np.float32)
+                if self._vectors is None:
+                    self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+                slot = self._free_slots.pop()
+                self._vectors[slot] = vector / (np.linalg.norm(vector) or 1.0)
+                self._slot_keys[slot] = key
+            self._entries[key] = (CachedAnswer(answer, list(sources), time.time()), slot)
+
+    def record_bypass(self):
+        with self._lock:
+            self.counters["bypassed"] += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            hits = self.counters["exact_hits"] + self.counters["semantic_hits"]
+            lookups = hits + self.counters["misses"]
+            return {**self.counters, "entries": len(self._entries), "hit_rate": hits / lookups if lookups else 0.0}
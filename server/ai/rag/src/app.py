@@ -1,10 +1,15 @@
 import streamlit as st
-import tempfile
 import os
 import json
+import asyncio
 from dotenv import load_dotenv
 import keys  # Ensure this module contains your OpenAI API key as `key`
-import llm  # Ensure this module contains the QueryRunner class
+import bloom  # Per-question Bloom's Taxonomy transformation
+from bloomtaxonomy import record_store  # Append-only store of the submitted answers
+import llm_router
+import tokenization
+import ingest  # Queue of the course documents indexed by the API's background workers
+import config
 import datetime  # For timestamping saved files
 
 # Load environment variables if needed
@@ -16,7 +21,44 @@ os.environ["OPENAI_API_KEY"] = keys.key
 # Initialize Session State for storing answers
 if 'answers' not in st.session_state:
     st.session_state['answers'] = {}
+
+
+# Objects shared by every rerun and every session of the app, created once per process
+@st.cache_resource
+def get_tokenizer():
+    return tokenization.TextTokenizer()
+
+
+@st.cache_resource
+def get_transform_cache():
+    # Generated questions by (upload hash, model, prompt version), bounded and expiring
+    return bloom.TransformCache()
+
+
+@st.cache_resource
+def get_ingest_queue():
+    return ingest.JobQueue()
+
+
+@st.cache_resource
+def get_record_store():
+    return record_store.RecordStore()
+
+
+@st.cache_data(max_entries=config.BLOOM_CACHE_MAX_ENTRIES, show_spinner=False)
+def split_questions(content, max_tokens):
+    return get_tokenizer().split_questions(content, max_tokens)
+
     
+# Optional: Display additional information or settings
+st.sidebar.header("Configuration")
+# You can add more configuration options here if needed
+if st.sidebar.button("Clear Cached Questions"):
+    get_transform_cache().invalidate()
+    split_questions.clear()
+    st.session_state.pop('question_sets', None)
+course_name = st.sidebar.text_input("Course", value=config.DEFAULT_COURSE)
+
 # Create two columns
 col1, col2 = st.columns([1,1])
 
@@ -54,196 +96,191 @@ if uploaded_file is not None:
     # Define other configuration parameters
     MODEL_NAME = "gpt-3.5-turbo"  # or "gpt-4", etc.
     MAX_TOKENS = 500
-    TOP_N_CHUNKS = 3
-
-    # Define the query template
-    query = """
-    You are an educational design assistant specializing in Bloom's Taxonomy. Your task is to transform a set of input questions into questions aligned with each level of Bloom's Taxonomy: Remember, Understand, Apply, Analyze, Evaluate, and Create.
-
-    For each input question, generate corresponding questions at each taxonomy level, ensuring they are relevant to the original question's topic.
-
-    **Your output should be a well-formatted JSON object with a single key "Topic Questions" that maps to an array of question objects. Each question object must include the following keys: "Original Question", "Remember", "Understand", "Apply", "Analyze", "Evaluate", and "Create", with their respective aligned questions as string values.**
-
-    **Ensure the JSON is valid and free from any additional text, code blocks, or formatting. Do not include numeric keys within the array.**
-
-    **Example Output:**
-
-    ```json
-    {
-        "Topic Questions": [
-            {
-                "Original Question": "What is photosynthesis?",
-                "Remember": "Define photosynthesis.",
-                "Understand": "Explain how photosynthesis works.",
-                "Apply": "Describe how photosynthesis affects plant growth.",
-                "Analyze": "Compare photosynthesis and cellular respiration.",
-                "Evaluate": "Assess the importance of photosynthesis in ecosystems.",
-                "Create": "Design an experiment to measure the rate of photosynthesis."
-            },
-            {
-                "Original Question": "How does gravity affect planetary orbits?",
-                "Remember": "What is gravity?",
-                "Understand": "Explain the role of gravity in planetary orbits.",
-                "Apply": "Calculate the gravitational force between Earth and the Moon.",
-                "Analyze": "Compare the effects of gravity on different planetary orbits.",
-                "Evaluate": "Evaluate the impact of gravity on the stability of the solar system.",
-                "Create": "Propose a model to demonstrate gravity's effect on orbiting bodies."
-            }
-        ]
-    }
-    ```
-
-    **Input Questions:**
-
-    ```
-    {{context}}
-    ```
-    """
-
-    # Initialize the QueryRunner with the uploaded file content
-    with tempfile.NamedTemporaryFile(delete=False, mode='w', encoding='utf-8', suffix=".txt") as tmp_file:
-        tmp_file.write(file_content)
-        temp_file_path = tmp_file.name
-
-    try:
-        # Initialize the QueryRunner with the temporary file path and model name
-        query_runner = llm.QueryRunner(document_path=temp_file_path, model_name=MODEL_NAME)
-
-        # Run the query
-        response = query_runner.run_query(query)
-
-        # Access Only the 'result' Field
-        result_str = response.get('result', '')
-
-        if result_str:
-            # Clean the JSON String
-            # Remove code block markers if present
-            if result_str.startswith("```json") and result_str.endswith("```"):
-                result_str = result_str.replace("```json", "").replace("```", "").strip()
-
-            # Parse the JSON
+
+    # Split the upload into individual questions and transform them in parallel
+    questions = split_questions(file_content, MAX_TOKENS)
+    st.write(f"**Questions Found:** {len(questions)}")
+
+    # Every widget interaction reruns this script: the questions of an upload are generated once,
+    # then served from the shared cache, and pinned in the session so they never change while answered
+    transform_cache = get_transform_cache()
+    upload_key = bloom.upload_key(file_content, MODEL_NAME)
+    if st.sidebar.button("Regenerate Questions"):
+        transform_cache.invalidate(upload_key)
+        st.session_state.pop('question_sets', None)
+    pinned = st.session_state.get('question_sets')
+    json_response = pinned[1] if pinned and pinned[0] == upload_key else transform_cache.get(upload_key)
+
+    # One placeholder per question, filled as soon as its transformation finishes
+    if json_response is None:
+        progress = st.progress(0.0, text="Transforming questions...")
+        slots = [st.empty() for _ in questions]
+
+    async def generate():
+        question_sets = {}
+        try:
+            async for idx, question_set in bloom.transform_questions(questions, MODEL_NAME):
+                question_sets[idx] = question_set
+                with slots[idx].container():
+                    st.markdown(f"**Original Question {idx+1}:** {question_set['Original Question']}")
+                    if "Error" in question_set:
+                        st.error(question_set["Error"])
+                    else:
+                        for level in bloom.BLOOM_LEVELS:
+                            st.markdown(f"- **{level}:** {question_set[level]}")
+                progress.progress(len(question_sets) / len(questions),
+                                  text=f"{len(question_sets)}/{len(questions)} questions transformed")
+        finally:
+            await llm_router.get_router().aclose()
+        return question_sets
+
+    if json_response is None and questions:
+        try:
+            json_response = bloom.merge_question_sets(asyncio.run(generate()))
+            transform_cache.put(upload_key, json_response)
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+
+        # Replace the previews by the answer form once every question is done
+        progress.empty()
+        for slot in slots:
+            slot.empty()
+
+    if json_response:
+        st.session_state['question_sets'] = (upload_key, json_response)
+
+    transformed_questions = []
+    if json_response:
+        # Display Raw JSON
+        with st.expander("📄 View Raw JSON Output"):
+            st.json(json_response)
+
+        for question_set in json_response["Topic Questions"]:
+            if "Error" in question_set:
+                st.error(f"Could not transform \"{question_set['Original Question']}\": {question_set['Error']}")
+            else:
+                transformed_questions.append(question_set)
+
+    if transformed_questions:
+        # Transformed Questions Section
+        st.subheader("Transformed Questions Aligned with Bloom's Taxonomy")
+
+        # Create a form for the answers
+        with st.form(key='answer_form'):
+            student_id = st.text_input("Your Name or Student ID", key="student_id")
+
+            # Iterate over each question set and display taxonomy-aligned questions with answer fields
+            for idx, question_set in enumerate(transformed_questions):
+                original_question = question_set.get("Original Question", f"Question {idx+1}")
+
+                # Display Original Question
+                st.markdown(f"**Original Question {idx+1}:** {original_question}")
+
+                # Iterate over each taxonomy level and display the question with a text area for answers
+                for level in ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]:
+                    taxonomy_question = question_set.get(level, "N/A")
+                    answer_field = f"{level} Answer_{idx}"  # Unique key per question and level
+
+                    st.markdown(f"### {level}")
+                    st.write(taxonomy_question)
+
+                    # Display the text area for the student's answer
+                    # Pre-fill with existing answer if available
+                    if st.session_state['answers'].get(answer_field):
+                        default_value = st.session_state['answers'][answer_field]
+                    else:
+                        default_value = ""
+
+                    answer = st.text_area(
+                        label=f"Your Answer for {level}:",
+                        value=default_value,
+                        key=answer_field,
+                        height=100
+                    )
+
+                    # Update the session state with the new answer
+                    st.session_state['answers'][answer_field] = answer
+
+                # Add a horizontal line to separate different questions
+                st.markdown("---")
+
+            # Submit Button
+            submit_button = st.form_submit_button(label='Submit Your Answers')
+
+        if submit_button:
+            # Collect all answers from session state
+            student_answers = {"Topic Questions": []}
+
+            for idx, question_set in enumerate(transformed_questions):
+                original_question = question_set.get("Original Question", f"Question {idx+1}")
+                answer_set = {
+                    "Original Question": original_question,
+                    "Sub-Questions": {}
+                }
+
+                for level in ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]:
+                    taxonomy_question = question_set.get(level, "N/A")
+                    answer_field = f"{level} Answer_{idx}"  # Unique key per question and level
+                    student_answer = st.session_state['answers'].get(answer_field, "")
+
+                    answer_set["Sub-Questions"][level] = {
+                        "Question": taxonomy_question,
+                        "Answer": student_answer
+                    }
+
+                student_answers["Topic Questions"].append(answer_set)
+
+            # Timestamp for unique filename
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
             try:
-                json_response = json.loads(result_str)
-            except json.JSONDecodeError as e:
-                st.error(f"JSON decoding failed: {e}")
-                st.write("Please ensure that the input file is correctly formatted.")
-                json_response = None
-
-            # Display Raw JSON
-            if json_response:
-                with st.expander("📄 View Raw JSON Output"):
-                    st.json(json_response)
-
-                # Process the Parsed JSON
-                if isinstance(json_response, dict) and "Topic Questions" in json_response:
-                    transformed_questions = json_response["Topic Questions"]
-                elif isinstance(json_response, list):
-                    transformed_questions = json_response
-                else:
-                    st.error("Unexpected JSON structure.")
-                    transformed_questions = []
-
-                if transformed_questions:
-                    # Transformed Questions Section
-                    st.subheader("Transformed Questions Aligned with Bloom's Taxonomy")
-
-                    # Create a form for the answers
-                    with st.form(key='answer_form'):
-                        # Iterate over each question set and display taxonomy-aligned questions with answer fields
-                        for idx, question_set in enumerate(transformed_questions):
-                            original_question = question_set.get("Original Question", f"Question {idx+1}")
-
-                            # Display Original Question
-                            st.markdown(f"**Original Question {idx+1}:** {original_question}")
-
-                            # Iterate over each taxonomy level and display the question with a text area for answers
-                            for level in ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]:
-                                taxonomy_question = question_set.get(level, "N/A")
-                                answer_field = f"{level} Answer_{idx}"  # Unique key per question and level
-
-                                st.markdown(f"### {level}")
-                                st.write(taxonomy_question)
-
-                                # Display the text area for the student's answer
-                                # Pre-fill with existing answer if available
-                                if st.session_state['answers'].get(answer_field):
-                                    default_value = st.session_state['answers'][answer_field]
-                                else:
-                                    default_value = ""
-
-                                answer = st.text_area(
-                                    label=f"Your Answer for {level}:",
-                                    value=default_value,
-                                    key=answer_field,
-                                    height=100
-                                )
-
-                                # Update the session state with the new answer
-                                st.session_state['answers'][answer_field] = answer
-
-                            # Add a horizontal line to separate different questions
-                            st.markdown("---")
-
-                        # Submit Button
-                        submit_button = st.form_submit_button(label='Submit Your Answers')
-
-                    if submit_button:
-                        # Collect all answers from session state
-                        student_answers = {"Topic Questions": []}
-
-                        for idx, question_set in enumerate(transformed_questions):
-                            original_question = question_set.get("Original Question", f"Question {idx+1}")
-                            answer_set = {
-                                "Original Question": original_question,
-                                "Sub-Questions": {}
-                            }
-
-                            for level in ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]:
-                                taxonomy_question = question_set.get(level, "N/A")
-                                answer_field = f"{level} Answer_{idx}"  # Unique key per question and level
-                                student_answer = st.session_state['answers'].get(answer_field, "")
-
-                                answer_set["Sub-Questions"][level] = {
-                                    "Question": taxonomy_question,
-                                    "Answer": student_answer
-                                }
-
-                            student_answers["Topic Questions"].append(answer_set)
-
-                        # Timestamp for unique filename
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        answers_file_path = os.path.join(os.getcwd(), f"student_answers_{timestamp}.json")
-
-                        try:
-                            # Save the JSON file locally
-                            with open(answers_file_path, 'w', encoding='utf-8') as f:
-                                json.dump(student_answers, f, ensure_ascii=False, indent=4)
-
-                            # Optional: Provide a download button for the JSON file
-                            json_str = json.dumps(student_answers, ensure_ascii=False, indent=4)
-                            st.download_button(
-                                label="📥 Download Your Answers",
-                                data=json_str,
-                                file_name=f'student_answers_{timestamp}.json',
-                                mime='application/json'
-                            )
-
-                            # Display success message
-                            st.success("✅ Your answers are submitted!!")
-
-                        except Exception as e:
-                            st.error(f"Failed to save answers: {e}")
-
-    except Exception as e:
-        st.error(f"An error occurred: {e}")
-
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(temp_file_path):
-            os.unlink(temp_file_path)
+                # Append the answers to the record store, one row per question and level
+                get_record_store().append_answers(student_answers, student_id.strip() or "anonymous",
+                                                  uploaded_file.name, course_name or config.DEFAULT_COURSE,
+                                                  submission=f"{timestamp}_{student_id.strip() or 'anonymous'}")
+
+                # Optional: Provide a download button for the JSON file
+                json_str = json.dumps(student_answers, ensure_ascii=False, indent=4)
+                st.download_button(
+                    label="📥 Download Your Answers",
+                    data=json_str,
+                    file_name=f'student_answers_{timestamp}.json',
+                    mime='application/json'
+                )
+
+                # Display success message
+                st.success("✅ Your answers are submitted!!")
+
+            except Exception as e:
+                st.error(f"Failed to save answers: {e}")
 else:
     st.info("Please upload a `.txt` file to get started.")
 
-# Optional: Display additional information or settings
-st.sidebar.header("Configuration")
-# You can add more configuration options here if needed
+# Course documents: queued here, chunked and embedded in the background by the API's ingestion workers
+st.sidebar.subheader("Course Documents")
+ingest_queue = get_ingest_queue()
+course_documents = st.sidebar.file_uploader("Add documents to the course corpus", type=["txt"],
+                                            accept_multiple_files=True, key="course_documents")
+if course_documents and st.sidebar.button("Queue for Indexing"):
+    for document in course_documents:
+        try:
+            job = ingest_queue.submit_bytes(document.getvalue(), document.name, course_name)
+            st.session_state.setdefault('ingest_jobs', []).append(job["id"])
+        except ValueError as e:
+            st.sidebar.error(f"{document.name}: {e}")
+
+if st.session_state.get('ingest_jobs'):
+    # Each click reruns the script, which reads the current status of the jobs
+    st.sidebar.button("Refresh Status")
+    for job_id in st.session_state['ingest_jobs']:
+        job = ingest_queue.get(job_id)
+        if job is None:
+            continue
+        if job["status"] == "failed":
+            st.sidebar.error(f"{job['filename']}: {job['error']}")
+        elif job["status"] == "skipped":
+            st.sidebar.info(f"{job['filename']}: already indexed as {job['relpath']}")
+        elif job["status"] == "done":
+            st.sidebar.success(f"{job['filename']}: {job['chunks']} chunks indexed")
+        else:
+            st.sidebar.write(f"{job['filename']}: {job['status']}")
@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+import config
+import llm_router
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from bloomtaxonomy import json_stream  # noqa: E402
+
+
+## ------------------ Bloom's taxonomy transformer: one LLM call per question, in parallel --------------###
+
+BLOOM_LEVELS = json_stream.BLOOM_LEVELS
+
+QUESTION_PROMPT = """You are an educational design assistant specializing in Bloom's Taxonomy. Your task is to transform an input question into questions aligned with each level of Bloom's Taxonomy: Remember, Understand, Apply, Analyze, Evaluate, and Create, ensuring they are relevant to the original question's topic.
+
+**Your output should be a single well-formatted JSON object with the following keys: "Original Question", "Remember", "Understand", "Apply", "Analyze", "Evaluate", and "Create", with their respective aligned questions as string values.**
+
+**Ensure the JSON is valid and free from any additional text, code blocks, or formatting.**
+
+**Example Output:**
+
+{
+    "Original Question": "What is photosynthesis?",
+    "Remember": "Define photosynthesis.",
+    "Understand": "Explain how photosynthesis works.",
+    "Apply": "Describe how photosynthesis affects plant growth.",
+    "Analyze": "Compare photosynthesis and cellular respiration.",
+    "Evaluate": "Assess the importance of photosynthesis in ecosystems.",
+    "Create": "Design an experiment to measure the rate of photosynthesis."
+}
+
+**Input Question:**
+
+"""
+
+
+MISSING_LEVELS_PROMPT = """
+
+Only generate the following levels: {levels}. Return a JSON object with exactly these keys."""
+
+
+# Changes whenever a prompt does, so cached results of an older prompt are never served
+PROMPT_VERSION = hashlib.sha256((QUESTION_PROMPT + MISSING_LEVELS_PROMPT).encode(config.ENCODING)).hexdigest()[:12]
+
+
+def upload_key(content, model_name=config.MODEL_NAME):
+    #### ------- Cache key of the questions generated for an upload: (content hash, model, prompt version) -------###
+    return hashlib.sha256(content.encode(config.ENCODING)).hexdigest(), model_name, PROMPT_VERSION
+
+
+async def transform_question(client, question, model_name=config.MODEL_NAME, max_retries=2):
+    #### ------- Streams the answer and keeps each level as soon as its string is complete and valid -------###
+    #### ------- If the output breaks, only the levels still missing are asked again -------###
+    question_set = {"Original Question": question}
+    prompt = QUESTION_PROMPT + question
+    for attempt in range(max_retries + 1):
+        # Levels are at depth 1, or at depth 3 when the model wraps them in {"Topic Questions": [...]}
+        parser = json_stream.JsonStreamParser(depths=(1, 3))
+        messages = [{"role": "user", "content": prompt}]
+        async for piece in client.stream_chat(messages, model=model_name, temperature=0):
+            for path, value in parser.feed(piece):
+                level = path[-1]
+                if level in BLOOM_LEVELS and level not in question_set and json_stream.is_valid_level_question(value):
+                    question_set[level] = value
+        parser.close()
+        missing = [level for level in BLOOM_LEVELS if level not in question_set]
+        if not missing:
+            return question_set
+        prompt = QUESTION_PROMPT + question + MISSING_LEVELS_PROMPT.format(levels=", ".join(missing))
+    raise ValueError(f"no valid question for {', '.join(missing)} ({parser.error or 'invalid values'})")
+
+
+async def transform_questions(questions, model_name=config.MODEL_NAME, workers=config.BLOOM_WORKERS, client=None):
+    #### ------- Yields (index, question set) in completion order, at most `workers` calls in flight -------###
+    #### ------- A question that fails yields {"Original Question", "Error"} instead of stopping the others -------###
+    client = client or llm_router.get_router()
+    semaphore = asyncio.Semaphore(workers)
+
+    async def run(idx, question):
+        async with semaphore:
+            try:
+                return idx, await transform_question(client, question, model_name)
+            except Exception as e:
+                return idx, {"Original Question": question, "Error": f"{type(e).__name__}: {e}"}
+
+    for task in asyncio.as_completed([run(idx, question) for idx, question in enumerate(questions)]):
+        yield await task
+
+
+def merge_question_sets(question_sets):
+    #### ------- Per-question results, in input order, in the app's "Topic Questions" structure -------###
+    return {"Topic Questions": [question_sets[idx] for idx in sorted(question_sets)]}
+
+
+class TransformCache:
+    #### --------- Merged question sets by upload_key, shared by every session of the app. Entries expire ------###
+    #### --------- after `ttl` seconds; beyond `max_entries` the least recently used one is dropped ------###
+
+    def __init__(self, max_entries=config.BLOOM_CACHE_MAX_ENTRIES, ttl=config.BLOOM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (question sets, created)
+
+    def get(self, key):
+        with self._lock:
+            found = self._entries.get(key)
+            if found is not None and time.time() - found[1] > self.ttl:
+                del self._entries[key]
+                found = None
+            if found is None:
+                return None
+            self._entries.move_to_end(key)
+            return found[0]
+
+    def put(self, key, question_sets):
+        #### ------- Only complete results are kept: a question that failed is tried again on the next run -------###
+        if any("Error" in question_set for question_set in question_sets["Topic Questions"]):
+            return
+        with self._lock:
+            self._entries[key] = (question_sets, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        #### ------- Drops one upload, or everything when key is None -------###
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -7,6 +7,100 @@ MAX_TOKENS = 500
 # Model-related parameters
 MODEL_NAME = "gpt-3.5-turbo"
 EMBEDDING_TYPE = "cl100k_base" 
+EMBEDDING_MODEL = "text-embedding-ada-002"
 
 # Search and retrieval-related parameters
-TOP_N_CHUNKS = 3
\ No newline at end of file
+TOP_N_CHUNKS = 3
+VECTOR_BACKEND = "chroma"  # "chroma", or "numpy" for the in-process memory-mapped store
+RETRIEVAL_MODE = "hybrid"  # "hybrid" (BM25 + vectors), "vector", or "lexical" (BM25 only, no embedding call per query: the answer cache only matches exact queries)
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60  # reciprocal-rank fusion constant
+HYBRID_CANDIDATES_FACTOR = 4  # each search returns n * factor candidates to the fusion of a top n
+
+# Context packing parameters (the retrieved chunks that fit the prompt)
+MODEL_CONTEXT_WINDOW = 4096  # tokens of MODEL_NAME
+ANSWER_TOKEN_RESERVE = 512  # tokens kept free for the answer
+MESSAGE_TOKEN_OVERHEAD = 12  # tokens the chat format adds around the messages
+CONTEXT_TOKEN_BUDGET = 1200  # at most this many tokens of retrieved context per call
+CONTEXT_MIN_PASSAGE_TOKENS = 20  # smaller leftovers of a chunk are not worth packing
+
+# Index persistence parameters (one sub-directory per document/settings hash)
+INDEX_DIR = '../index'
+
+# Embedding cache parameters
+EMBEDDING_BACKEND = "openai"  # "openai", or "hash" for the deterministic offline embedder
+EMBEDDING_CACHE_PATH = '../index/embeddings.sqlite'
+EMBEDDING_CACHE_MAX_ENTRIES = 100000
+EMBEDDING_BATCH_SIZE = 64
+HASH_EMBEDDING_SIZE = 256
+
+# Chunking parameters
+CHUNK_OVERLAP = 50  # tokens shared by two consecutive chunks
+CHUNK_BLOCK_SIZE = 1 << 16  # characters read from the document per encode call
+
+# LLM client parameters (any OpenAI-compatible endpoint)
+LLM_BASE_URL = "https://api.openai.com/v1"
+LLM_MAX_CONCURRENCY = 16  # upstream calls in flight per process
+LLM_TIMEOUT = 60  # seconds per upstream HTTP call
+QUERY_TIMEOUT = 90  # seconds per /query request
+
+# LLM routing parameters (chat calls spread over several OpenAI-compatible providers, see llm_router.py)
+# e.g. [{"name": "groq", "base_url": "https://api.groq.com/openai/v1", "model": "llama3-70b-8192", "api_key_env": "GROQ_API_KEY"},
+#       {"name": "openai", "base_url": "https://api.openai.com/v1", "model": "gpt-3.5-turbo", "api_key_env": "OPENAI_API_KEY"}]
+LLM_BACKENDS = []  # empty: LLM_BASE_URL alone, with the model each caller asks for
+ROUTER_WINDOW = 200  # latest calls of each backend its latency quantiles and error rate are computed on
+ROUTER_EXPLORE_RATE = 0.05  # calls sent to another healthy backend than the fastest, so its latency stays known
+ROUTER_HEDGE = True  # send the call to the next backend too when the first one is slower than usual; the first answer wins
+ROUTER_HEDGE_QUANTILE = 0.95  # "slower than usual": past this quantile of the backend's latencies
+ROUTER_HEDGE_MIN_SAMPLES = 20  # calls a backend needs before its quantile is trusted (no hedging before)
+ROUTER_HEDGE_MIN_DELAY = 0.05  # seconds
+ROUTER_BREAKER_FAILURES = 5  # consecutive failures that open the circuit of a backend (no more calls to it)
+ROUTER_BREAKER_COOLDOWN = 30  # seconds before an open circuit lets one probe call through
+
+# Summary index parameters (tree of LLM summaries over the chunks, built offline, see summaries.py)
+SUMMARY_ROUTING = True  # broad questions ("summarize the lesson") are answered from the index's summaries, if it has some
+SUMMARY_INDEX = False  # True: `python serving.py build` also builds the summary tree of each new version (LLM calls)
+SUMMARY_MODEL = MODEL_NAME
+SUMMARY_WORKERS = 8  # summary calls in flight during a build
+SUMMARY_FANOUT = 8  # summaries of a level combined into one of the next level, at most
+SUMMARY_GROUP_TOKENS = 2000  # ... and at most this many tokens of them per call
+SUMMARY_CHUNK_WORDS = 80  # length asked for the summary of a chunk
+SUMMARY_REDUCE_WORDS = 250  # length asked for the summary of a section or of the whole document
+SUMMARY_TOP_SECTIONS = 3  # section summaries given to a broad question about one part of the document
+
+# Answer cache parameters
+ANSWER_CACHE_MAX_ENTRIES = 1024
+ANSWER_CACHE_TTL = 24 * 3600  # seconds
+ANSWER_CACHE_THRESHOLD = 0.95  # cosine similarity above which two queries share an answer
+
+# Corpus parameters (one namespace per course = first-level folder of CORPUS_DIR)
+CORPUS_DIR = '../data'
+CORPUS_INDEX_DIR = '../index/corpus'
+CORPUS_EXTENSIONS = (".txt",)
+DEFAULT_COURSE = "default"  # namespace of the files placed directly in CORPUS_DIR
+
+# Ingestion parameters (uploads added to the corpus by background workers, see ingest.py)
+INGEST_DB_PATH = '../index/jobs.sqlite'
+INGEST_UPLOAD_DIR = '../index/uploads'  # uploads waiting for a worker
+INGEST_MAX_UPLOAD_BYTES = 20 * 1024 * 1024  # larger request bodies are refused with 413
+INGEST_WORKERS = 2  # uploads chunked and embedded in parallel
+INGEST_POLL_SECONDS = 1.0  # idle workers look for jobs queued by another process this often
+INGEST_LEASE_SECONDS = 60  # a running job whose process sent no heartbeat for this long is taken by another worker
+INGEST_STOP_TIMEOUT = 30  # seconds the shutdown waits for the jobs in progress
+
+# Serving parameters (several uvicorn workers sharing one prebuilt, memory-mapped index, see serving.py)
+SERVING_MODE = False  # True: the workers map the version published by `python serving.py build` instead of building the index
+SERVING_INDEX_DIR = '../index/serving'
+SERVING_KEEP_VERSIONS = 3  # published versions kept on disk, older ones are removed by the next build
+
+# Startup parameters
+WARM_UP = True  # load tiktoken, the vector database and the embedding cache when the server starts, not on the first request
+
+# Metrics parameters (/metrics in Prometheus format, Server-Timing header on every response)
+METRICS_ENABLED = True  # False removes the per-request middleware and makes every span a no-op
+
+# Bloom transformer parameters (Streamlit app)
+BLOOM_WORKERS = 8  # questions transformed in parallel
+BLOOM_CACHE_MAX_ENTRIES = 64  # uploads whose generated questions are kept in memory
+BLOOM_CACHE_TTL = 24 * 3600  # seconds
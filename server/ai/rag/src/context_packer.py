@@ -0,0 +1,135 @@
+import re
+from collections import namedtuple
+
+import tokenization
+import config
+
+
+## ------------------ Prompt assembly: the retrieved chunks that fit a token budget --------------###
+
+# A piece of context with its [start, end) character offsets in the source, when they are known
+Passage = namedtuple("Passage", ["text", "source", "start", "end", "rank"])
+
+# Ends of sentences (or lines) where a chunk that does not fit may be cut
+_SENTENCE_END = re.compile(r"[.!?…](?=\s)|\n")
+
+_tokenizer = tokenization.TextTokenizer()
+
+
+def count_tokens(text):
+    return _tokenizer.count_tokens(text)
+
+
+def context_budget(fixed_tokens, budget=config.CONTEXT_TOKEN_BUDGET):
+    #### ------- Tokens left for the context once the prompt, the question and the answer fit the window -------###
+    room = config.MODEL_CONTEXT_WINDOW - config.ANSWER_TOKEN_RESERVE - config.MESSAGE_TOKEN_OVERHEAD - fixed_tokens
+    return max(0, min(budget, room))
+
+
+def _uncovered(start, end, covered):
+    #### ------- Parts of [start, end) not already in one of the `covered` ranges -------###
+    pieces = [(start, end)]
+    for s, e in covered:
+        remaining = []
+        for a, b in pieces:
+            if e <= a or s >= b:
+                remaining.append((a, b))
+                continue
+            if a < s:
+                remaining.append((a, s))
+            if e < b:
+                remaining.append((e, b))
+        pieces = remaining
+    return pieces
+
+
+def _header(passage):
+    if passage.source is None:
+        return ""
+    if passage.start is None:
+        return f"[{passage.source}]\n"
+    return f"[{passage.source} {passage.start}-{passage.end}]\n"
+
+
+def truncate_to_sentences(text, max_tokens):
+    #### ------- Longest prefix of whole sentences within max_tokens; "" if even the first one is too long -------###
+    if count_tokens(text) <= max_tokens:
+        return text
+    ends = [match.end() for match in _SENTENCE_END.finditer(text)]
+    # Token counts grow with the prefix: binary search the number of sentences that fit
+    lo, hi = 0, len(ends)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:ends[mid - 1]].rstrip()) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:ends[lo - 1]].rstrip() if lo else ""
+
+
+def _pieces(chunk, rank, covered, packed_texts):
+    #### ------- The parts of a chunk not already packed, as Passages in document order -------###
+    text = chunk.page_content
+    metadata = chunk.metadata or {}
+    source, start, end = metadata.get("source"), metadata.get("start"), metadata.get("end")
+    if start is None or end is None or end - start != len(text):
+        # No usable offsets: only exact or contained duplicates can be detected
+        if any(text in packed for packed in packed_texts):
+            return []
+        return [Passage(text, source, None, None, rank)]
+
+    pieces = []
+    for a, b in _uncovered(start, end, covered.get(source, [])):
+        piece = text[a - start:b - start]
+        if piece.strip():
+            # Whitespace at the cut belongs to neither passage
+            lead = len(piece) - len(piece.lstrip())
+            piece = piece.strip()
+            pieces.append(Passage(piece, source, a + lead, a + lead + len(piece), rank))
+    return pieces
+
+
+def _merge(passages):
+    #### ------- Joins passages of the same source that follow each other into one, in document order -------###
+    located = sorted((p for p in passages if p.start is not None), key=lambda p: (str(p.source), p.start))
+    merged = []
+    for passage in located:
+        last = merged[-1] if merged else None
+        if last is not None and last.source == passage.source and passage.start - last.end <= 1:
+            gap = " " * (passage.start - last.end)
+            merged[-1] = Passage(last.text + gap + passage.text, last.source, last.start, passage.end,
+                                 min(last.rank, passage.rank))
+        else:
+            merged.append(passage)
+    merged.extend(p for p in passages if p.start is None)
+    return sorted(merged, key=lambda p: p.rank)
+
+
+def pack(chunks, budget=config.CONTEXT_TOKEN_BUDGET, min_tokens=config.CONTEXT_MIN_PASSAGE_TOKENS):
+    #### ------- Greedy packing of the chunks (best first) into at most `budget` tokens of context: ------###
+    #### ------- overlaps with what is already packed are dropped, and the chunk that does not fit is ------###
+    #### ------- cut after its last whole sentence that does. Returns Passages, best first ------###
+    passages = []
+    covered = {}        # source -> [(start, end)] already packed
+    used = 0
+    for rank, chunk in enumerate(chunks):
+        for passage in _pieces(chunk, rank, covered, [p.text for p in passages]):
+            left = budget - used - count_tokens(_header(passage))
+            if left < min_tokens:
+                continue
+            text = truncate_to_sentences(passage.text, left)
+            if not text or count_tokens(text) < min(min_tokens, count_tokens(passage.text)):
+                continue
+            if passage.start is not None:
+                passage = passage._replace(text=text, end=passage.start + len(text))
+                covered.setdefault(passage.source, []).append((passage.start, passage.end))
+            else:
+                passage = passage._replace(text=text)
+            passages.append(passage)
+            used += count_tokens(_header(passage)) + count_tokens(text)
+    return _merge(passages)
+
+
+def format_context(passages):
+    #### ------- Each passage preceded by its source and offsets, e.g. "[exos.txt 1200-3410]" -------###
+    return "\n\n".join(_header(passage) + passage.text for passage in passages)
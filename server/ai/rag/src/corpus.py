@@ -0,0 +1,303 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import contextlib
+
+import numpy as np
+
+import config
+import embeddings
+import lexical
+import metrics
+import tokenization
+import vector_store
+
+
+## ------------------ Many documents, one shared index, one namespace per course --------------###
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def course_of(relpath):
+    #### ------- "physique/ondes.txt" belongs to course "physique"; files at the root to DEFAULT_COURSE -------###
+    parts = relpath.split("/")
+    return parts[0] if len(parts) > 1 else config.DEFAULT_COURSE
+
+
+class CourseStore:
+    #### --------- The part of the corpus index that belongs to one course, usable as QueryRunner.chunk_store ------###
+    summaries = None  # a course spans several documents: no summary tree
+
+    def __init__(self, corpus, course):
+        self.corpus = corpus
+        self.course = course
+
+    def retrieve(self, question, vector=None, n=config.TOP_N_CHUNKS):
+        return self.corpus.search(vector, n, self.course, question)
+
+    def retrieve_top_n_chunks(self, question, n=config.TOP_N_CHUNKS):
+        vector = None if config.RETRIEVAL_MODE == "lexical" else embeddings.get_embeddings().embed_query(question)
+        return self.retrieve(question, vector, n)
+
+
+class CorpusIndex:
+    #### --------- Ingests a directory tree into one NumPy vector store, rows grouped by course ------###
+    #### --------- Files are tracked by mtime/size/hash: a sync only re-chunks files that changed, and the ------###
+    #### --------- embedding cache makes sure only the chunks whose text changed are embedded again ------###
+    #### --------- Several processes can open the same index: writes take an exclusive file lock and start from ------###
+    #### --------- the persisted index, and every process reloads it when its manifest was replaced ------###
+
+    MANIFEST_FILE = "manifest.json"
+    LOCK_FILE = "corpus.lock"
+
+    def __init__(self, root=config.CORPUS_DIR, index_dir=config.CORPUS_INDEX_DIR):
+        self.root = root
+        self.index_dir = index_dir
+        self.files = {}             # relpath -> {"course", "mtime_ns", "size", "sha256", "chunks"}
+        self.course_versions = {}   # course -> hash of its files, changes whenever one of them does
+        # (store, {course: (first row, last row + 1)}, BM25 index) swapped as one value so searches
+        # never mix two versions
+        self._snapshot = (self._empty_store(), {}, lexical.BM25Index.build([]))
+        self.tokenizer = tokenization.TextTokenizer()
+        self._lock = threading.Lock()           # writes of this process
+        self._reload_lock = threading.Lock()    # reloads of this process
+        self._signature = None                  # manifest the snapshot was loaded from or written to
+        with self._file_lock(exclusive=False):
+            self.load()
+
+    @staticmethod
+    def _empty_store():
+        return vector_store.NumpyVectorStore([], np.zeros((0, 0), np.float32), [], embeddings.get_embeddings())
+
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive):
+        #### ------- flock on LOCK_FILE: exclusive for the writers of every process, shared for the readers -------###
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(os.path.join(self.index_dir, self.LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _manifest_signature(self):
+        try:
+            stat = os.stat(os.path.join(self.index_dir, self.MANIFEST_FILE))
+        except FileNotFoundError:
+            return None
+        # The manifest is replaced by a rename: a new inode even when the mtime does not change
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def is_stale(self):
+        return self._manifest_signature() != self._signature
+
+    def refresh(self):
+        #### ------- Reloads the index if another process (or writer) replaced it since; one stat() otherwise -------###
+        if self.is_stale():
+            with self._reload_lock:
+                if self.is_stale():
+                    with self._file_lock(exclusive=False):
+                        self.load()
+
+    def load(self):
+        #### ------- Opens the persisted index (memory-mapped), if any; call with the file lock held -------###
+        manifest_path = os.path.join(self.index_dir, self.MANIFEST_FILE)
+        # A sync of an empty tree writes the manifest alone
+        vectors_path = os.path.join(self.index_dir, vector_store.NumpyVectorStore.VECTORS_FILE)
+        signature = self._manifest_signature()
+        if signature is None or not os.path.exists(vectors_path):
+            self._signature = signature
+            return
+        with open(manifest_path, 'r', encoding=config.ENCODING) as f:
+            self.files = json.load(f)["files"]
+        store = vector_store.NumpyVectorStore.load(self.index_dir, embeddings.get_embeddings())
+        if os.path.exists(os.path.join(self.index_dir, lexical.BM25Index.FILE)):
+            lexical_index = lexical.BM25Index.load(self.index_dir)
+        else:
+            # Index written before the lexical index existed
+            lexical_index = lexical.BM25Index.build(store.texts)
+            lexical_index.save(self.index_dir)
+        self._set_store(store, lexical_index)
+        self._signature = signature
+
+    @contextlib.contextmanager
+    def _writing(self):
+        #### ------- Serializes the writers of every process; each one starts from the index persisted last -------###
+        with self._lock, self._file_lock(exclusive=True):
+            if self.is_stale():
+                self.load()
+            yield
+
+    @property
+    def store(self):
+        return self._snapshot[0]
+
+    @property
+    def courses(self):
+        return self._snapshot[1]
+
+    def _set_store(self, store, lexical_index):
+        courses = {}
+        for row, metadata in enumerate(store.metadatas):
+            start, _ = courses.get(metadata["course"], (row, row))
+            courses[metadata["course"]] = (start, row + 1)
+        self._snapshot = (store, courses, lexical_index)
+
+        self.course_versions = {}
+        for relpath in sorted(self.files):
+            entry = self.files[relpath]
+            digest = self.course_versions.setdefault(entry["course"], hashlib.sha256())
+            digest.update(f"{relpath}\0{entry['sha256']}\0".encode(config.ENCODING))
+        self.course_versions = {course: digest.hexdigest() for course, digest in self.course_versions.items()}
+
+    def _scan(self):
+        #### ------- {relpath: (mtime_ns, size)} of every document under the root -------###
+        found = {}
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(config.CORPUS_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, filename)
+                stat = os.stat(path)
+                found[os.path.relpath(path, self.root).replace(os.sep, "/")] = (stat.st_mtime_ns, stat.st_size)
+        return found
+
+    def _changed(self, relpath, signature):
+        #### ------- Returns the new sha256 if the file content changed, None otherwise -------###
+        entry = self.files.get(relpath)
+        if entry is not None and (entry["mtime_ns"], entry["size"]) == tuple(signature):
+            return None
+        digest = file_sha256(os.path.join(self.root, relpath))
+        if entry is not None and entry["sha256"] == digest:
+            entry["mtime_ns"], entry["size"] = signature  # touched, not modified
+            return None
+        return digest
+
+    def sync(self):
+        #### ------- Brings the index in line with the directory tree: adds, updates and removes files -------###
+        with self._writing():
+            found = self._scan()
+            removed = [relpath for relpath in self.files if relpath not in found]
+            changed = {}
+            for relpath, signature in found.items():
+                digest = self._changed(relpath, signature)
+                if digest is not None:
+                    changed[relpath] = (signature, digest)
+
+            summary = {
+                "added": sorted(relpath for relpath in changed if relpath not in self.files),
+                "updated": sorted(relpath for relpath in changed if relpath in self.files),
+                "removed": sorted(removed),
+            }
+            self._apply(removed, changed)
+            summary["unchanged"] = len(found) - len(changed)
+            return summary
+
+    def add_file(self, relpath):
+        #### ------- Indexes (or re-indexes) one file of the tree, e.g. right after an upload -------###
+        with self._writing():
+            stat = os.stat(os.path.join(self.root, relpath))
+            signature = (stat.st_mtime_ns, stat.st_size)
+            digest = self._changed(relpath, signature)
+            if digest is not None:
+                self._apply([], {relpath: (signature, digest)})
+            return digest is not None
+
+    def prepare_file(self, relpath):
+        #### ------- Chunks and embeds one file without touching the index, so the embedding cache already ------###
+        #### ------- holds its vectors when add_file runs; safe to call from several threads at once ------###
+        texts = [span.text for span in self.tokenizer.iter_file_chunks(os.path.join(self.root, relpath))]
+        if texts:
+            self.store.embedding.embed_documents(texts)
+        return len(texts)
+
+    def find_document(self, sha256):
+        #### ------- relpath of an indexed file with this content, or None -------###
+        self.refresh()
+        for relpath, entry in list(self.files.items()):
+            if entry["sha256"] == sha256:
+                return relpath
+        return None
+
+    def remove_file(self, relpath):
+        with self._writing():
+            if relpath in self.files:
+                self._apply([relpath], {})
+
+    def _apply(self, removed, changed):
+        #### ------- Drops the rows of removed/changed files, appends the rows of changed ones, persists -------###
+        if not removed and not changed:
+            self._persist_manifest()
+            return
+        dropped = set(removed) | set(changed)
+        old = self.store
+        keep = [row for row, metadata in enumerate(old.metadatas) if metadata["source"] not in dropped]
+        texts = [old.texts[row] for row in keep]
+        metadatas = [old.metadatas[row] for row in keep]
+        blocks = [np.asarray(old.vectors[keep])] if keep else []
+
+        for relpath in removed:
+            del self.files[relpath]
+        new_texts = []
+        for relpath, (signature, digest) in sorted(changed.items()):
+            course = course_of(relpath)
+            spans = list(self.tokenizer.iter_file_chunks(os.path.join(self.root, relpath)))
+            for number, span in enumerate(spans):
+                new_texts.append(span.text)
+                metadatas.append({"course": course, "source": relpath, "chunk": number,
+                                  "start": span.start, "end": span.end})
+            self.files[relpath] = {"course": course, "mtime_ns": signature[0], "size": signature[1],
+                                   "sha256": digest, "chunks": len(spans)}
+        if new_texts:
+            blocks.append(vector_store.normalize_rows(old.embedding.embed_documents(new_texts)))
+        texts += new_texts
+
+        # Keep every course in one contiguous block of rows so a course search is a slice, not a filter
+        order = sorted(range(len(texts)), key=lambda row: (metadatas[row]["course"], metadatas[row]["source"],
+                                                           metadatas[row]["chunk"]))
+        vectors = np.concatenate(blocks)[order] if blocks else np.zeros((0, 0), np.float32)
+        store = vector_store.NumpyVectorStore([texts[row] for row in order], vectors,
+                                              [metadatas[row] for row in order], old.embedding, self.index_dir)
+        store.persist()
+        lexical_index = lexical.BM25Index.build(store.texts)
+        lexical_index.save(self.index_dir)
+        self._set_store(vector_store.NumpyVectorStore.load(self.index_dir, old.embedding), lexical_index)
+        self._persist_manifest()
+
+    def _persist_manifest(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        path = os.path.join(self.index_dir, self.MANIFEST_FILE)
+        with open(path + ".tmp", 'w', encoding=config.ENCODING) as f:
+            json.dump({"files": self.files}, f, ensure_ascii=False, indent=1)
+        os.replace(path + ".tmp", path)
+        self._signature = self._manifest_signature()
+
+    def search(self, vector, n=config.TOP_N_CHUNKS, course=None, question=None):
+        #### ------- Top n chunks of one course (or of the whole corpus when course is None) -------###
+        #### ------- Fuses the vector and the BM25 rankings when the question text is given -------###
+        self.refresh()
+        store, courses, lexical_index = self._snapshot
+        window = courses.get(course, (0, 0)) if course is not None else None
+        if question is None:
+            rows, _ = store.top_k(vector, n, window=window)
+        else:
+            k = lexical.candidates(n)
+            rankings = []
+            if config.RETRIEVAL_MODE != "lexical" and vector is not None:
+                with metrics.span("retrieve_vector"):
+                    rankings.append(store.top_k(vector, k, window=window)[0].tolist())
+            if config.RETRIEVAL_MODE != "vector":
+                with metrics.span("retrieve_lexical"):
+                    rankings.append(lexical_index.top_k(question, k, window=window)[0].tolist())
+            rows = lexical.reciprocal_rank_fusion(rankings, n)
+        return [vector_store.Document(store.texts[row], store.metadatas[row]) for row in rows]
+
+    def course_store(self, course):
+        return CourseStore(self, course)
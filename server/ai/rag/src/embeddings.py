@@ -0,0 +1,234 @@
+import os
+import re
+import math
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from array import array
+
+import config
+import metrics
+
+
+## ------------------ Embedding backends and their on-disk cache --------------###
+
+class HashEmbeddings:
+    #### --------- Deterministic, offline embedder (feature hashing of words and word pairs) ------###
+    #### --------- Good enough for tests and benchmarks, never calls the network ------###
+
+    WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, size=config.HASH_EMBEDDING_SIZE):
+        self.size = size
+        self.model = f"hash-{size}"
+
+    def _bucket(self, feature):
+        digest = hashlib.blake2b(feature.encode(config.ENCODING), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.size, 1.0 if value >> 63 else -1.0
+
+    def _embed(self, text):
+        vector = [0.0] * self.size
+        words = self.WORD_PATTERN.findall(text.lower())
+        features = words + [a + " " + b for a, b in zip(words, words[1:])]
+        for feature in features:
+            index, sign = self._bucket(feature)
+            vector[index] += sign
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class OpenAIEmbedder:
+    #### --------- OpenAI embeddings: langchain for (sync) index builds, the pooled async client for queries ------###
+
+    def __init__(self, model=config.EMBEDDING_MODEL):
+        self.model = model
+        self._embeddings = None
+
+    def embed_documents(self, texts):
+        if self._embeddings is None:
+            from langchain.embeddings import OpenAIEmbeddings
+            self._embeddings = OpenAIEmbeddings(model=self.model)
+        return self._embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        import llm_client
+        return await llm_client.get_client().embed(texts, self.model)
+
+
+class EmbeddingCache:
+    #### --------- SQLite store of float32 vectors keyed by (model, text hash), evicted least-recently-used ------###
+
+    def __init__(self, path=config.EMBEDDING_CACHE_PATH, max_entries=config.EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # Upper bound of the rows, kept without a COUNT(*) per put: replaced rows are counted as new ones, and
+        # the rows other processes add are only seen by the exact count made once the bound passes max_entries
+        self._rows = self._count()
+
+    def get_many(self, model, text_hashes):
+        #### ------- Returns {text_hash: vector} for the hashes present, and marks them as recently used -------###
+        found = {}
+        with self._lock:
+            for start in range(0, len(text_hashes), 500):
+                batch = text_hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for text_hash, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[text_hash] = vector.tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, text_hash) for text_hash in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, model, items):
+        #### ------- Stores [(text_hash, vector)] and evicts the oldest entries beyond max_entries -------###
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, text_hash, array("f", vector).tobytes(), now) for text_hash, vector in items],
+            )
+            self._rows += len(items)
+            if self._rows > self.max_entries:
+                self._rows = self._count()
+                # Down to 90% of max_entries, so that the next exact count is 10% of the cache away
+                excess = self._rows - self.max_entries * 9 // 10 if self._rows > self.max_entries else 0
+                if excess > 0:
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE rowid IN"
+                        " (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (excess,),
+                    )
+                    self._rows -= excess
+            self._conn.commit()
+
+    def _count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._count()
+
+
+class CachedEmbeddings:
+    #### --------- Embeddings front-end: dedupes texts, serves cache hits, sends only misses in batches ------###
+    #### --------- Exposes embed_documents / embed_query so it plugs into the vector stores directly ------###
+
+    def __init__(self, embedder, model, cache=None, batch_size=config.EMBEDDING_BATCH_SIZE):
+        self.embedder = embedder
+        self.model = model
+        self.cache = cache if cache is not None else EmbeddingCache(config.EMBEDDING_CACHE_PATH)
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode(config.ENCODING)).hexdigest()
+
+    def _lookup(self, texts):
+        #### ------- Dedupes the texts and splits them into cached vectors and misses -------###
+        hashes = [self.text_hash(text) for text in texts]
+        unique = {}
+        for text_hash, text in zip(hashes, texts):
+            unique.setdefault(text_hash, text)
+
+        with metrics.span("embedding_cache"):
+            vectors = self.cache.get_many(self.model, list(unique))
+        missing = [(text_hash, text) for text_hash, text in unique.items() if text_hash not in vectors]
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+        return hashes, vectors, batches
+
+    def _store(self, vectors, batch, embedded):
+        items = [(text_hash, vector) for (text_hash, _), vector in zip(batch, embedded)]
+        self.cache.put_many(self.model, items)
+        vectors.update(items)
+
+    def embed_documents(self, texts):
+        hashes, vectors, batches = self._lookup(texts)
+        for batch in batches:
+            with metrics.span("embed"):
+                embedded = self.embedder.embed_documents([text for _, text in batch])
+            self._store(vectors, batch, embedded)
+        return [vectors[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        #### ------- Same as embed_documents, without blocking the event loop: the SQLite cache (whose lock ------###
+        #### ------- ingestion holds while it stores a whole file) and sync embedders run in threads -------###
+        hashes, vectors, batches = await asyncio.to_thread(self._lookup, texts)
+        for batch in batches:
+            batch_texts = [text for _, text in batch]
+            with metrics.span("embed"):
+                if hasattr(self.embedder, "aembed_documents"):
+                    embedded = await self.embedder.aembed_documents(batch_texts)
+                else:
+                    embedded = await asyncio.to_thread(self.embedder.embed_documents, batch_texts)
+            await asyncio.to_thread(self._store, vectors, batch, embedded)
+        return [vectors[text_hash] for text_hash in hashes]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "model": self.model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.cache),
+        }
+
+
+_embeddings = {}
+_embeddings_lock = threading.Lock()
+
+def get_embeddings(backend=None):
+    #### ------- Process-wide cached embeddings for the configured backend ("openai" or "hash") -------###
+    #### ------- (called from worker threads: only one of them opens the cache) -------###
+    backend = backend or config.EMBEDDING_BACKEND
+    if backend not in _embeddings:
+        with _embeddings_lock:
+            if backend not in _embeddings:
+                if backend == "hash":
+                    embedder = HashEmbeddings()
+                    model = embedder.model
+                else:
+                    embedder = OpenAIEmbedder()
+                    model = embedder.model
+                _embeddings[backend] = CachedEmbeddings(embedder, model)
+    return _embeddings[backend]
@@ -0,0 +1,316 @@
+import os
+import time
+import uuid
+import shutil
+import signal
+import socket
+import sqlite3
+import argparse
+import threading
+
+import config
+import corpus
+import metrics
+
+
+## ------------------ Background ingestion of uploaded documents into the corpus index --------------###
+
+# Job statuses: queued -> running -> done | skipped (same content already indexed) | failed
+# A running job is leased to the process that claimed it (owner "host:pid"), which renews its heartbeat while it
+# works; a job whose heartbeat is older than INGEST_LEASE_SECONDS was left by a process that stopped and is taken again
+FINAL_STATUSES = ("done", "skipped", "failed")
+
+
+def check_upload(filename, course=None):
+    #### ------- (file name, course) of an upload, or ValueError when they cannot be placed under CORPUS_DIR -------###
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    if not name or name.startswith(".") or not name.endswith(config.CORPUS_EXTENSIONS):
+        raise ValueError(f"Only {', '.join(config.CORPUS_EXTENSIONS)} files can be uploaded")
+    course = (course or config.DEFAULT_COURSE).strip()
+    if not course or course.startswith(".") or "/" in course or "\\" in course:
+        raise ValueError(f"Invalid course name: {course!r}")
+    return name, course
+
+
+class JobQueue:
+    #### --------- SQLite table of ingestion jobs, shared by every process that opens the same file ------###
+    #### --------- (the API workers, the Streamlit app); uploads wait in upload_dir until a worker takes them ------###
+
+    def __init__(self, path=config.INGEST_DB_PATH, upload_dir=config.INGEST_UPLOAD_DIR):
+        self.path = path
+        self.upload_dir = upload_dir
+        os.makedirs(upload_dir, exist_ok=True)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, filename TEXT NOT NULL, course TEXT NOT NULL, status TEXT NOT NULL,"
+            " relpath TEXT, sha256 TEXT, chunks INTEGER, error TEXT,"
+            " created REAL NOT NULL, started REAL, finished REAL, owner TEXT, heartbeat REAL)"
+        )
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for name, kind in (("owner", "TEXT"), ("heartbeat", "REAL")):
+            if name not in columns:
+                # Queue created before the jobs had a lease
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._conn.commit()
+
+    @property
+    def owner(self):
+        #### ------- Lease owner of the jobs this process claims (read each time: uvicorn workers are forked) -------###
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def upload_path(self, job_id):
+        #### ------- Where the content of a job waits until it is ingested -------###
+        return os.path.join(self.upload_dir, job_id)
+
+    def new_job_id(self):
+        return uuid.uuid4().hex
+
+    def submit(self, job_id, filename, course=None):
+        #### ------- Queues a job whose content was written to upload_path(job_id) -------###
+        filename, course = check_upload(filename, course)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, filename, course, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, filename, course, time.time()),
+            )
+            self._conn.commit()
+        return self.get(job_id)
+
+    def submit_bytes(self, data, filename, course=None):
+        #### ------- Writes the uploaded content and queues it; returns the job -------###
+        check_upload(filename, course)
+        job_id = self.new_job_id()
+        with open(self.upload_path(job_id), 'wb') as f:
+            f.write(data)
+        return self.submit(job_id, filename, course)
+
+    def claim(self, lease=config.INGEST_LEASE_SECONDS):
+        #### ------- Leases the oldest queued job (or running job whose lease expired) to this process and ------###
+        #### ------- returns it, or None when there is none -------###
+        owner = self.owner
+        with self._lock:
+            # BEGIN IMMEDIATE: two processes can never take the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued'"
+                    " OR (status = 'running' AND COALESCE(heartbeat, started, 0) < ?)"
+                    " ORDER BY created LIMIT 1", (now - lease,)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE jobs SET status = 'running', started = ?, owner = ?, heartbeat = ? "
+                                       "WHERE id = ?", (now, owner, now, row["id"]))
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return dict(row, status="running", owner=owner) if row is not None else None
+
+    def heartbeat(self, job_ids):
+        #### ------- Renews the lease of the jobs this process is working on -------###
+        if not job_ids:
+            return
+        owner = self.owner
+        with self._lock:
+            self._conn.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                                   [(time.time(), job_id, owner) for job_id in job_ids])
+            self._conn.commit()
+
+    def record(self, job_id, **fields):
+        #### ------- Saves fields of a running job (where its upload goes) for whoever takes it after a crash -------###
+        columns = [f"{name} = ?" for name in fields]
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {', '.join(columns)} WHERE id = ? AND owner = ?",
+                               (*fields.values(), job_id, self.owner))
+            self._conn.commit()
+
+    def finish(self, job_id, status, **fields):
+        #### ------- Final status of a job, unless its lease expired and another process took it meanwhile -------###
+        assert status in FINAL_STATUSES
+        columns = ["status = ?", "finished = ?"] + [f"{name} = ?" for name in fields]
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {', '.join(columns)} WHERE id = ? AND owner = ?",
+                               (status, time.time(), *fields.values(), job_id, self.owner))
+            self._conn.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def list(self, limit=50):
+        #### ------- The most recent jobs first -------###
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class IngestWorker:
+    #### --------- Threads that take jobs from the queue and add their document to the corpus index. ------###
+    #### --------- Chunking and embedding run in parallel; only the final index update is serialized ------###
+    #### --------- (by the corpus lock), and a document whose content is already indexed is skipped ------###
+
+    def __init__(self, corpus_index, queue, workers=config.INGEST_WORKERS, poll=config.INGEST_POLL_SECONDS,
+                 lease=config.INGEST_LEASE_SECONDS):
+        self.corpus_index = corpus_index
+        self.queue = queue
+        self.workers = workers
+        self.poll = poll
+        self.lease = lease
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._in_progress = {}      # sha256 -> relpath of the jobs being ingested
+        self._running = set()       # ids of the jobs leased by this worker
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"ingest-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self):
+        #### ------- Called after a submit in this process; jobs queued by other processes are found by polling -------###
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.queue.claim(self.lease)
+            if job is None:
+                self._wake.wait(self.poll)
+                self._wake.clear()
+                continue
+            with self._lock:
+                self._running.add(job["id"])
+            try:
+                self.ingest(job)
+            finally:
+                with self._lock:
+                    self._running.discard(job["id"])
+
+    def _heartbeat(self):
+        #### ------- Renews the leases of the jobs in progress well before they expire -------###
+        while not self._stop.wait(self.lease / 4):
+            with self._lock:
+                job_ids = list(self._running)
+            try:
+                self.queue.heartbeat(job_ids)
+            except sqlite3.Error:
+                # Database busy: the next beat comes long before the lease expires
+                pass
+
+    def _reserve(self, digest, relpath):
+        #### ------- (relpath already holding or about to hold this content, None), or (None, relpath reserved ------###
+        #### ------- for it): `relpath` itself, or name-2.txt, name-3.txt ... when another document has that name ------###
+        with self._lock:
+            existing = self.corpus_index.find_document(digest) or self._in_progress.get(digest)
+            if existing is not None:
+                return existing, None
+            taken = set(self._in_progress.values())
+            base, extension = os.path.splitext(relpath)
+            candidate, number = relpath, 1
+            while candidate in taken or os.path.exists(os.path.join(self.corpus_index.root, candidate)):
+                path = os.path.join(self.corpus_index.root, candidate)
+                if candidate not in taken and corpus.file_sha256(path) == digest:
+                    break   # the same content is already in the tree, not indexed yet
+                number += 1
+                candidate = f"{base}-{number}{extension}"
+            self._in_progress[digest] = candidate
+            return None, candidate
+
+    def _moved(self, job):
+        #### ------- relpath of a job taken again after its process stopped, if its upload was already moved -------###
+        if not job.get("relpath") or not job.get("sha256") or os.path.exists(self.queue.upload_path(job["id"])):
+            return None
+        destination = os.path.join(self.corpus_index.root, job["relpath"])
+        if os.path.exists(destination) and corpus.file_sha256(destination) == job["sha256"]:
+            return job["relpath"]
+        return None
+
+    def ingest(self, job):
+        upload = self.queue.upload_path(job["id"])
+        relpath = job["filename"] if job["course"] == config.DEFAULT_COURSE else f"{job['course']}/{job['filename']}"
+        digest = None
+        reserved = False
+        try:
+            with metrics.span("ingest"):
+                moved = self._moved(job)
+                if moved is not None:
+                    # Resumes where the previous process stopped: the document is in the tree, maybe not indexed
+                    relpath, digest = moved, job["sha256"]
+                    with self._lock:
+                        self._in_progress[digest] = relpath
+                    reserved = True
+                else:
+                    digest = corpus.file_sha256(upload)
+                    existing, relpath = self._reserve(digest, relpath)
+                    if existing is not None:
+                        os.remove(upload)
+                        self.queue.finish(job["id"], "skipped", relpath=existing, sha256=digest, chunks=0)
+                        return
+                    reserved = True
+                    destination = os.path.join(self.corpus_index.root, relpath)
+                    # Where the upload goes, saved first: a worker taking the job after a crash can resume from it
+                    self.queue.record(job["id"], relpath=relpath, sha256=digest)
+                    if os.path.exists(destination):
+                        os.remove(upload)   # same content already at that name
+                    else:
+                        os.makedirs(os.path.dirname(destination), exist_ok=True)
+                        shutil.move(upload, destination)
+                chunks = self.corpus_index.prepare_file(relpath)
+                self.corpus_index.add_file(relpath)
+            self.queue.finish(job["id"], "done", relpath=relpath, sha256=digest, chunks=chunks)
+        except Exception as e:
+            self.queue.finish(job["id"], "failed", sha256=digest, error=f"{type(e).__name__}: {e}")
+        finally:
+            if reserved:
+                with self._lock:
+                    self._in_progress.pop(digest, None)
+
+
+def main():
+    #### ------- Runs the ingestion workers in a process of their own: in SERVING_MODE the API workers only queue ------###
+    #### ------- the uploads, so that a single process writes the corpus index ------###
+    parser = argparse.ArgumentParser(description="Ingests the uploads queued by the API into the corpus index "
+                                                 "until stopped (SERVING_MODE = True).")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS, help="uploads ingested in parallel")
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    worker = IngestWorker(corpus.CorpusIndex(), JobQueue(), workers=args.workers)
+    worker.start()
+    print(f"Ingesting the uploads queued in {worker.queue.path} with {args.workers} workers (Ctrl+C to stop)")
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # The jobs in progress finish; the ones still running after the timeout are taken again once their lease expires
+        worker.stop(config.INGEST_STOP_TIMEOUT)
+
+
+if __name__ == "__main__":
+    main()
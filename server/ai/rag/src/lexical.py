@@ -0,0 +1,148 @@
+import os
+import re
+import json
+import heapq
+import unicodedata
+from collections.abc import Mapping
+
+import numpy as np
+
+import config
+
+
+## ------------------ Lexical (BM25) index built once at ingest time --------------###
+
+_WORD = re.compile(r"\w+")
+
+
+def fold(text):
+    #### ------- Lowercase without accents: "Célérité" and "celerite" are the same term -------###
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return _WORD.findall(fold(text))
+
+
+def pack_strings(strings):
+    #### ------- Strings as one UTF-8 byte array + offsets: compact and saved without pickle -------###
+    encoded = [string.encode(config.ENCODING) for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack(data, offsets):
+    data = data.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode(config.ENCODING) for i in range(len(offsets) - 1)]
+
+
+class BM25Index:
+    #### --------- Inverted index stored as CSR arrays: the postings of term t are rows[offsets[t]:offsets[t+1]] ------###
+    #### --------- (ascending rows) with their full BM25 weight (idf included) precomputed at build time, ------###
+    #### --------- so scoring a query is one vectorized add per query term ------###
+
+    FILE = "bm25.npz"
+
+    def __init__(self, terms, offsets, rows, weights, idf, texts, metadatas=None):
+        # term -> id; a sorted list of terms is turned into a dict, a mapping (serving.SortedTerms) is used as is
+        self.terms = terms if isinstance(terms, Mapping) else {term: t for t, term in enumerate(terms)}
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.idf = idf
+        self.texts = texts
+        self.metadatas = metadatas if metadatas is not None else [{} for _ in texts]
+
+    def __len__(self):
+        return len(self.texts)
+
+    @classmethod
+    def build(cls, texts, metadatas=None, k1=config.BM25_K1, b=config.BM25_B):
+        texts = list(texts)
+        postings = {}               # term -> ([rows], [term frequencies])
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for term, tf in counts.items():
+                entry = postings.setdefault(term, ([], []))
+                entry[0].append(row)
+                entry[1].append(tf)
+
+        terms = sorted(postings)
+        df = np.array([len(postings[term][0]) for term in terms], dtype=np.float32)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:], dtype=np.int64)
+        rows = np.fromiter((row for term in terms for row in postings[term][0]), dtype=np.int32, count=offsets[-1])
+        tf = np.fromiter((f for term in terms for f in postings[term][1]), dtype=np.float32, count=offsets[-1])
+
+        # Okapi BM25 with the non-negative idf variant
+        idf = np.log1p((len(texts) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        average = lengths.mean() if len(texts) else 1.0
+        norm = k1 * (1 - b + b * lengths[rows] / max(average, 1e-9))
+        weights = (np.repeat(idf, np.diff(offsets)) * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+        return cls(terms, offsets, rows, weights, idf, texts, metadatas)
+
+    def save(self, directory):
+        #### ------- Written to a temporary file first, like the vector store -------###
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.FILE)
+        terms, term_offsets = pack_strings(sorted(self.terms, key=self.terms.get))
+        texts, text_offsets = pack_strings(self.texts)
+        metadatas, metadata_offsets = pack_strings(json.dumps(metadata, ensure_ascii=False)
+                                                   for metadata in self.metadatas)
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, terms=terms, term_offsets=term_offsets, offsets=self.offsets, rows=self.rows,
+                     weights=self.weights, idf=self.idf, texts=texts, text_offsets=text_offsets,
+                     metadatas=metadatas, metadata_offsets=metadata_offsets)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory):
+        with np.load(os.path.join(directory, cls.FILE)) as data:
+            metadatas = None
+            if "metadatas" in data.files:
+                metadatas = [json.loads(m) for m in _unpack(data["metadatas"], data["metadata_offsets"])]
+            return cls(_unpack(data["terms"], data["term_offsets"]), data["offsets"], data["rows"],
+                       data["weights"], data["idf"], _unpack(data["texts"], data["text_offsets"]), metadatas)
+
+    def top_k(self, query, k, window=None):
+        #### ------- (rows, scores) of the k best rows, best first; only rows matching a query term ------###
+        #### ------- `window=(start, stop)` restricts the search to a row range -------###
+        start, stop = window if window is not None else (0, len(self.texts))
+        term_ids = {self.terms[term] for term in tokenize(query) if term in self.terms}
+        if stop <= start or k <= 0 or not term_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        scores = np.zeros(stop - start, dtype=np.float32)
+        for t in term_ids:
+            rows = self.rows[self.offsets[t]:self.offsets[t + 1]]
+            weights = self.weights[self.offsets[t]:self.offsets[t + 1]]
+            lo, hi = np.searchsorted(rows, start), np.searchsorted(rows, stop)
+            scores[rows[lo:hi] - start] += weights[lo:hi]
+
+        matched = np.flatnonzero(scores)
+        k = min(k, len(matched))
+        if k < len(matched):
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return matched + start, scores[matched]
+
+
+def reciprocal_rank_fusion(rankings, n, k=config.RRF_K):
+    #### ------- Fuses rankings (best first) of any hashable ids into the n ids with the best 1/(k + rank) sum -------###
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return heapq.nlargest(n, scores, key=scores.get)
+
+
+def candidates(n):
+    #### ------- How many results each search contributes to the fusion of a top n -------###
+    return n if config.RETRIEVAL_MODE != "hybrid" else n * config.HYBRID_CANDIDATES_FACTOR
@@ -1,15 +1,37 @@
+import io
 import os
 import sys
+import time
+import asyncio
+import threading
+import json
+import shutil
+import hashlib
 import keys
-import tokenization 
+import tokenization
+import embeddings
+import llm_router
+import answer_cache
+import vector_store
+import lexical
+import context_packer
+import summaries
+import metrics
 import config
 
-from langchain.document_loaders import TextLoader
-from langchain.indexes import VectorstoreIndexCreator
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import RetrievalQA
+
+def warm_up():
+    #### ------- Loads the heavy dependencies (tiktoken ranks, vector database, embedding cache) ahead of ------###
+    #### ------- the first request instead of during it; returns the seconds each one took ------###
+    timings = {}
+    for name, load in (("tokenizer", lambda: tokenization.get_encoding().encode("warm up")),
+                       ("vector_backend", ChunkStore._backend),
+                       ("embeddings", embeddings.get_embeddings)):
+        start = time.perf_counter()
+        load()
+        timings[name] = time.perf_counter() - start
+        metrics.observe(f"warmup_{name}", timings[name])
+    return timings
 
 
 class DocumentManager:
@@ -20,57 +42,317 @@ class DocumentManager:
         self.tokenizer = tokenization.TextTokenizer(encoding)
         self.text = None
         self.chunks = None
-    
+        self.spans = None
+
 
     def load_document(self):
-        #### ------- Loads the document from file -------### 
-        self.text = self.tokenizer.read_file(self.filename)
+        #### ------- Loads the document from file -------###
+        with metrics.span("read"):
+            self.text = self.tokenizer.read_file(self.filename)
 
-    def split_text(self, max_tokens=config.MAX_TOKENS):
-        #### ------- Splits the text into chunks -------### 
-        self.chunks = self.tokenizer.creat_chunks(self.text, max_tokens)
+    def split_text(self, max_tokens=config.MAX_TOKENS, overlap=config.CHUNK_OVERLAP):
+        #### ------- Splits the text into chunks, streaming from the file if it was not loaded -------###
+        if self.text is None:
+            spans = self.tokenizer.iter_file_chunks(self.filename, max_tokens, overlap)
+        else:
+            spans = self.tokenizer.iter_chunks(io.StringIO(self.text), max_tokens, overlap)
+        with metrics.span("chunk"):
+            self.spans = list(spans)
+        self.chunks = [span.text for span in self.spans]
 
 
 class ChunkStore:
-    def __init__(self, chunks):
+    def __init__(self, chunks, persist_directory=None, metadatas=None):
         self.chunks = chunks
-        self.vectorestore = None
+        self.metadatas = metadatas  # per chunk, e.g. {"source", "chunk", "start", "end"}
+        self.persist_directory = persist_directory
+        self.vectorstore = None
+        self.lexical = None
+        self.summaries = None  # summaries.SummaryIndex, when the index has a summary tree
+
+    @staticmethod
+    def _backend():
+        #### ------- The vector database selected by config.VECTOR_BACKEND ("chroma" or "numpy") -------###
+        if config.VECTOR_BACKEND == "numpy":
+            return vector_store.NumpyVectorStore
+        from langchain.vectorstores import Chroma
+        return Chroma
 
     def store_chunks(self):
         #### ------- stores the text chunks in a vector database -------###
         texts = [chunk for chunk in self.chunks]
-        self.vectorstore = Chroma.from_texts(texts=texts, embedding=OpenAIEmbeddings())
-
-    def retrieve_top_n_chunks(self, question, n=3):
-         #### ------- Retrieves the top n relevant chunks for a given question -------###
-        important_chunks = self.vectorstore.similarity_search(question)
-        return important_chunks[:n]
-    
-    def get_retriever(self):
-        return self.vectorstore.as_retriever()
-    
-    
+        with metrics.span("vector_index_build"):
+            self.vectorstore = self._backend().from_texts(texts=texts, embedding=embeddings.get_embeddings(),
+                                                          metadatas=self.metadatas,
+                                                          persist_directory=self.persist_directory)
+        with metrics.span("lexical_index_build"):
+            self.lexical = lexical.BM25Index.build(texts, self.metadatas)
+        if self.persist_directory:
+            with metrics.span("index_persist"):
+                self.vectorstore.persist()
+                self.lexical.save(self.persist_directory)
+
+    def load_chunks(self):
+        #### ------- re-opens a vector database previously written to persist_directory -------###
+        with metrics.span("index_load"):
+            self._load_chunks()
+
+    def _load_chunks(self):
+        backend = self._backend()
+        if backend is vector_store.NumpyVectorStore:
+            self.vectorstore = backend.load(self.persist_directory, embeddings.get_embeddings())
+        else:
+            self.vectorstore = backend(persist_directory=self.persist_directory,
+                                       embedding_function=embeddings.get_embeddings())
+        self.lexical = lexical.BM25Index.load(self.persist_directory)
+
+    def retrieve(self, question, vector=None, n=config.TOP_N_CHUNKS):
+        #### ------- Top n chunks by config.RETRIEVAL_MODE; each search only computes the k it contributes -------###
+        k = lexical.candidates(n)
+        rankings = []
+        documents = {}
+        if config.RETRIEVAL_MODE != "lexical" and vector is not None:
+            with metrics.span("retrieve_vector"):
+                found = self.vectorstore.similarity_search_by_vector(vector, k=k)
+            rankings.append([doc.page_content for doc in found])
+            documents.update((doc.page_content, doc) for doc in found)
+        if config.RETRIEVAL_MODE != "vector":
+            with metrics.span("retrieve_lexical"):
+                rows, _ = self.lexical.top_k(question, k)
+            rankings.append([self.lexical.texts[row] for row in rows])
+            for row in rows:
+                documents.setdefault(self.lexical.texts[row],
+                                     vector_store.Document(self.lexical.texts[row], self.lexical.metadatas[row]))
+        # Fused by chunk text, which both backends return
+        return [documents[text] for text in lexical.reciprocal_rank_fusion(rankings, n)]
+
+    def retrieve_top_n_chunks(self, question, n=config.TOP_N_CHUNKS):
+        #### ------- Retrieves the top n relevant chunks for a given question -------###
+        vector = None if config.RETRIEVAL_MODE == "lexical" else embeddings.get_embeddings().embed_query(question)
+        return self.retrieve(question, vector, n)
+
+
+def index_key(document_path, max_tokens=config.MAX_TOKENS, overlap=config.CHUNK_OVERLAP,
+              encoding=config.EMBEDDING_TYPE, embedding_model=None):
+    #### ------- Hashes the document content together with the chunker and embedding settings -------###
+    if embedding_model is None:
+        embedding_model = embeddings.get_embeddings().model
+    digest = hashlib.sha256()
+    with open(document_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    settings = {"max_tokens": max_tokens, "overlap": overlap, "encoding": encoding,
+                "embedding_model": embedding_model, "vector_backend": config.VECTOR_BACKEND, "lexical_index": "bm25",
+                "chunk_metadata": ["source", "chunk", "start", "end"]}
+    digest.update(json.dumps(settings, sort_keys=True).encode(config.ENCODING))
+    return digest.hexdigest()
+
+
+def chunk_document(document_path):
+    #### ------- (chunk texts, chunk metadatas) of a document, as stored in its index -------###
+    document_manager = DocumentManager(document_path)
+    document_manager.split_text()
+    source = os.path.basename(document_path)
+    metadatas = [{"source": source, "chunk": number, "start": span.start, "end": span.end}
+                 for number, span in enumerate(document_manager.spans)]
+    return document_manager.chunks, metadatas
+
+
+class DocumentIndex:
+    #### --------- Builds the vector index of a document once and reuses it from disk ------###
+    COMPLETE_MARKER = ".complete"
+
+    def __init__(self, document_path, index_dir=config.INDEX_DIR):
+        self.document_path = document_path
+        self.index_dir = index_dir
+        self.key = None
+        self.chunk_store = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        stat = os.stat(self.document_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def is_stale(self):
+        #### ------- A cheap stat() tells us whether the source file changed since the last load -------###
+        return self.chunk_store is None or self._file_signature() != self._signature
+
+    def load(self):
+        #### ------- Loads the index matching the current document content, building it if missing -------###
+        signature = self._file_signature()
+        key = index_key(self.document_path)
+        directory = os.path.join(self.index_dir, key)
+        marker = os.path.join(directory, self.COMPLETE_MARKER)
+
+        if key != self.key or self.chunk_store is None:
+            if os.path.exists(marker):
+                chunk_store = ChunkStore(None, persist_directory=directory)
+                chunk_store.load_chunks()
+            else:
+                # A directory without the marker is a build that was interrupted half-way
+                shutil.rmtree(directory, ignore_errors=True)
+                chunks, metadatas = chunk_document(self.document_path)
+                chunk_store = ChunkStore(chunks, persist_directory=directory, metadatas=metadatas)
+                chunk_store.store_chunks()
+                open(marker, 'w').close()
+            # Built offline by `python summaries.py` (LLM calls), never on a request
+            chunk_store.summaries = summaries.SummaryIndex.load(directory)
+
+            self.chunk_store = chunk_store
+            self.key = key
+
+        self._signature = signature
+        return self.chunk_store
+
+    def get_chunk_store(self):
+        if self.is_stale():
+            with self._lock:
+                if self.is_stale():
+                    self.load()
+        return self.chunk_store
+
+
+# Same prompt as the "stuff" RetrievalQA chain for chat models
+QA_SYSTEM_PROMPT = """Use the following pieces of context to answer the users question. 
+If you don't know the answer, just say that you don't know, don't try to make up an answer.
+----------------
+{context}"""
+
+
+def build_messages(query, chunks, budget=config.CONTEXT_TOKEN_BUDGET):
+    #### ------- Packs the best retrieved chunks that fit the budget into the system message and asks the question -------###
+    fixed = context_packer.count_tokens(QA_SYSTEM_PROMPT.format(context="")) + context_packer.count_tokens(query)
+    with metrics.span("pack"):
+        passages = context_packer.pack(chunks, context_packer.context_budget(fixed, budget))
+    context = context_packer.format_context(passages)
+    return [
+        {"role": "system", "content": QA_SYSTEM_PROMPT.format(context=context)},
+        {"role": "user", "content": query},
+    ]
+
+
 class QueryRunner:
-    def __init__(self, document_path, model_name=config.MODEL_NAME):
+    # Answers are only shared between identical queries when the model is deterministic
+    temperature = 0
+
+    def __init__(self, document_path, model_name=config.MODEL_NAME, chunk_store=None, client=None,
+                 cache=None, document_version=None, flights=None):
         self.document_path = document_path
         self.model_name = model_name
+        self.chunk_store = chunk_store
+        self.client = client
+        self.cache = cache
+        self.document_version = document_version
+        self.flights = flights  # singleflight.SingleFlight shared by the runners of the process, or None
+
+    def flight_key(self, kind, query):
+        #### ------- Identical requests: same normalized query, document version and model, at temperature 0 -------###
+        if self.flights is None or self.temperature != 0:
+            return None
+        return (kind, answer_cache.AnswerCache.normalize(query), self.document_version or self.document_path,
+                self.model_name, self.temperature)
+
+    async def alookup(self, query):
+        #### ------- Returns (cached answer or None, query embedding computed on the way or None) -------###
+        if self.cache is None:
+            return None, None
+        with metrics.span("answer_cache"):
+            cached = self.cache.get_exact(query, self.document_version)
+        if cached is not None or config.RETRIEVAL_MODE == "lexical":
+            # Lexical retrieval embeds nothing per query, so only the exact tier is looked up
+            return cached, None
+        vector = await embeddings.get_embeddings().aembed_query(query)
+        with metrics.span("answer_cache"):
+            return self.cache.get_similar(vector, self.document_version), vector
+
+    def remember(self, query, vector, answer, chunks):
+        if self.cache is not None:
+            sources = [{"content": chunk.page_content, "metadata": chunk.metadata} for chunk in chunks]
+            self.cache.put(query, self.document_version, vector, answer, sources)
+
+    async def aretrieve(self, query, vector=None):
+        #### ------- Embeds the query (unless already done) and retrieves the top chunks, without blocking the loop -------###
+        chunk_store = self.chunk_store
+        if chunk_store is None:
+            chunk_store = await asyncio.to_thread(DocumentIndex(self.document_path).get_chunk_store)
+
+        if vector is None and config.RETRIEVAL_MODE != "lexical":
+            vector = await embeddings.get_embeddings().aembed_query(query)
+        level = summaries.route(query) if chunk_store.summaries is not None and config.SUMMARY_ROUTING else None
+        if level is not None:
+            # A question about the whole lesson (or a part of it) gets its summaries instead of a few chunks
+            with metrics.span("retrieve_summary"):
+                return await asyncio.to_thread(chunk_store.summaries.retrieve, query, vector, level)
+        with metrics.span("retrieve"):
+            return await asyncio.to_thread(chunk_store.retrieve, query, vector, config.TOP_N_CHUNKS)
+
+    async def arun_query(self, query):
+        cached, vector = await self.alookup(query)
+        if cached is not None:
+            return {"query": query, "result": cached.answer}
+
+        key = self.flight_key("answer", query)
+        if key is None:
+            result = await self._answer(query, vector)
+        else:
+            # A burst of the same question waits for one retrieval and one upstream call
+            result = await self.flights.call(key, lambda: self._answer(query, vector))
+        return {"query": query, "result": result}
+
+    async def _answer(self, query, vector):
+        chunks = await self.aretrieve(query, vector)
+        client = self.client or llm_router.get_router()
+        with metrics.span("prompt"):
+            messages = build_messages(query, chunks)
+        with metrics.span("llm"):
+            result = await client.chat(messages, model=self.model_name, temperature=self.temperature)
+        self.remember(query, vector, result, chunks)
+        return result
+
+    async def astream_query(self, query, vector=None):
+        #### ------- Yields ("sources", chunks) then ("token", text) pieces of the answer as they are generated; ------###
+        #### ------- concurrent identical queries share the retrieval and the upstream stream ------###
+        key = self.flight_key("stream", query)
+        if key is None:
+            events = self._stream(query, vector)
+        else:
+            events = self.flights.stream(key, lambda: self._stream(query, vector))
+        async for event in events:
+            yield event
+
+    async def _stream(self, query, vector):
+        chunks = await asyncio.wait_for(self.aretrieve(query, vector), timeout=config.QUERY_TIMEOUT)
+        yield "sources", chunks
+        tokens = []
+        async for token in self.astream_answer(query, chunks):
+            tokens.append(token)
+            yield "token", token
+        self.remember(query, vector, "".join(tokens), chunks)
+
+    async def astream_answer(self, query, chunks):
+        #### ------- Yields the answer tokens for already retrieved chunks as they are generated -------###
+        client = self.client or llm_router.get_router()
+        with metrics.span("prompt"):
+            messages = build_messages(query, chunks)
+        start = time.perf_counter()
+        first = True
+        async for token in client.stream_chat(messages, model=self.model_name, temperature=self.temperature):
+            if first:
+                metrics.observe("llm_first_token", time.perf_counter() - start)
+                first = False
+            yield token
+        metrics.observe("llm", time.perf_counter() - start)
 
     def run_query(self, query):
-        document_manager = DocumentManager(self.document_path)
-        document_manager.load_document()
-        document_manager.split_text()
-        
-        chunk_store = ChunkStore(document_manager.chunks)
-        chunk_store.store_chunks()
-
-        chunk_store.retrieve_top_n_chunks(query)
-
-        llm = ChatOpenAI(model_name=self.model_name, temperature=0)
-        retriever = chunk_store.vectorstore.as_retriever()
-        qa_chain = RetrievalQA.from_chain_type(llm, retriever=retriever)
-        response = qa_chain({"query": query})
-       
-        return response
+        #### ------- Blocking entry point for scripts (CLI, Streamlit) -------###
+        async def run():
+            try:
+                return await self.arun_query(query)
+            finally:
+                await llm_router.get_router().aclose()
+
+        return asyncio.run(run())
 
 if __name__ == "__main__":
     os.environ["OPENAI_API_KEY"] = keys.key
@@ -0,0 +1,101 @@
+import os
+import json
+import asyncio
+import weakref
+
+import httpx
+
+import config
+import metrics
+
+
+## ------------------ Shared async client for OpenAI-compatible chat and embedding APIs --------------###
+
+class LLMClient:
+    #### --------- One pooled HTTP client, a bound on in-flight upstream calls and a per-call timeout ------###
+
+    def __init__(self, base_url=config.LLM_BASE_URL, api_key=None, max_concurrency=config.LLM_MAX_CONCURRENCY,
+                 timeout=config.LLM_TIMEOUT):
+        self.base_url = base_url
+        self.api_key = api_key if api_key is not None else os.environ.get("OPENAI_API_KEY", "")
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._http = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else {},
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+
+    async def _post(self, path, payload):
+        async with self._semaphore:
+            response = await self._http.post(path, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    async def complete(self, messages, model=config.MODEL_NAME, temperature=0, **params):
+        #### ------- Returns the whole chat completion response (choices, usage); None params are not sent -------###
+        payload = {"model": model, "messages": messages, "temperature": temperature, **params}
+        data = await self._post("/chat/completions", {key: value for key, value in payload.items()
+                                                      if value is not None})
+        metrics.inc("rag_llm_requests_total", endpoint="chat")
+        usage = data.get("usage") or {}
+        metrics.inc("rag_llm_tokens_total", usage.get("prompt_tokens", 0), kind="prompt")
+        metrics.inc("rag_llm_tokens_total", usage.get("completion_tokens", 0), kind="completion")
+        return data
+
+    async def chat(self, messages, model=config.MODEL_NAME, temperature=0, **params):
+        #### ------- Returns the content of the first completion choice -------###
+        data = await self.complete(messages, model, temperature, **params)
+        return data["choices"][0]["message"]["content"]
+
+    async def stream_chat(self, messages, model=config.MODEL_NAME, temperature=0, **params):
+        #### ------- Yields the completion text piece by piece as the server generates it -------###
+        payload = {"model": model, "messages": messages, "temperature": temperature, "stream": True, **params}
+        payload = {key: value for key, value in payload.items() if value is not None}
+        metrics.inc("rag_llm_requests_total", endpoint="chat_stream")
+        async with self._semaphore:
+            async with self._http.stream("POST", "/chat/completions", json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if chunk.get("usage"):
+                        # Sent in the last chunk by the servers that report usage when streaming
+                        metrics.inc("rag_llm_tokens_total", chunk["usage"].get("prompt_tokens", 0), kind="prompt")
+                        metrics.inc("rag_llm_tokens_total", chunk["usage"].get("completion_tokens", 0),
+                                    kind="completion")
+                    delta = chunk["choices"][0].get("delta", {}) if chunk.get("choices") else {}
+                    if delta.get("content"):
+                        yield delta["content"]
+
+    async def embed(self, texts, model=config.EMBEDDING_MODEL):
+        #### ------- Returns one embedding per input text, in input order -------###
+        data = await self._post("/embeddings", {"model": model, "input": list(texts)})
+        metrics.inc("rag_llm_requests_total", endpoint="embeddings")
+        metrics.inc("rag_llm_tokens_total", (data.get("usage") or {}).get("prompt_tokens", 0), kind="embedding")
+        return [item["embedding"] for item in sorted(data["data"], key=lambda item: item["index"])]
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+# httpx/asyncio objects belong to the event loop they were created in: keep one client per loop
+_clients = weakref.WeakKeyDictionary()
+
+def get_client():
+    #### ------- The long-lived client of the running event loop, created on first use -------###
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = LLMClient()
+    return client
+
+async def close_client():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,354 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+import threading
+from collections import deque
+
+import httpx
+
+import config
+import llm_client
+import metrics
+
+
+## ------------------ Chat calls routed to the fastest healthy provider, hedged and failed over --------------###
+
+class BackendsUnavailable(RuntimeError):
+    #### --------- Every backend's circuit is open ------###
+    pass
+
+
+def is_retryable(error):
+    #### ------- Errors another backend may not have: transport errors, timeouts, 408, 429, 5xx, bad bodies; ------###
+    #### ------- any other 4xx is the request's fault and would fail everywhere ------###
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status in (408, 429) or status >= 500
+    return isinstance(error, (httpx.HTTPError, asyncio.TimeoutError, ValueError, KeyError, IndexError))
+
+
+class Backend:
+    #### --------- One provider + model, with the rolling statistics and the circuit breaker the router uses. ------###
+    #### --------- Process-wide (shared by every event loop); only the HTTP clients are per loop ------###
+
+    def __init__(self, name, base_url, model=None, api_key=None, api_key_env=None,
+                 max_concurrency=config.LLM_MAX_CONCURRENCY, timeout=config.LLM_TIMEOUT, window=config.ROUTER_WINDOW):
+        self.name = name
+        self.base_url = base_url
+        self.model = model  # None: the model the caller asks for
+        self.api_key = api_key if api_key is not None else os.environ.get(api_key_env or "OPENAI_API_KEY", "")
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # Latency of the whole answer for chat calls, of the first token for streams
+        self.latencies = {"chat": deque(maxlen=window), "stream": deque(maxlen=window)}
+        self.outcomes = deque(maxlen=window)  # True for a success, False for a failure
+        self.failures = 0                     # consecutive
+        self.open_until = 0.0
+        self.probing = False
+        self.counters = {"ok": 0, "error": 0, "cancelled": 0}
+        self._lock = threading.Lock()
+        self._clients = weakref.WeakKeyDictionary()
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = llm_client.LLMClient(self.base_url, self.api_key, self.max_concurrency,
+                                                                self.timeout)
+        return client
+
+    async def aclose(self):
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    ## ------------------ Statistics --------------###
+
+    def quantile(self, kind, q):
+        with self._lock:
+            samples = sorted(self.latencies[kind])
+        return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else None
+
+    def error_rate(self):
+        with self._lock:
+            return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def score(self, kind):
+        #### ------- Expected seconds of a call: median latency, inflated by the share of calls that fail -------###
+        median = self.quantile(kind, 0.5)
+        if median is None:
+            return 0.0  # never measured: tried first, so it gets measured
+        return median / max(1.0 - self.error_rate(), 0.1)
+
+    def hedge_delay(self, kind):
+        #### ------- Seconds after which a call is slower than usual, None while there are too few samples -------###
+        with self._lock:
+            enough = len(self.latencies[kind]) >= config.ROUTER_HEDGE_MIN_SAMPLES
+        if not enough:
+            return None
+        return max(self.quantile(kind, config.ROUTER_HEDGE_QUANTILE), config.ROUTER_HEDGE_MIN_DELAY)
+
+    ## ------------------ Circuit breaker --------------###
+
+    def state(self):
+        if self.failures < config.ROUTER_BREAKER_FAILURES:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half-open"
+
+    def acquire(self):
+        #### ------- Whether a call may be sent now; a half-open circuit lets a single probe through -------###
+        with self._lock:
+            state = self.state()
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record(self, kind, seconds=None, ok=True, cancelled=False):
+        with self._lock:
+            self.probing = False
+            if cancelled:
+                # A hedged call that lost: it was at least this slow
+                self.latencies[kind].append(seconds)
+                self.counters["cancelled"] += 1
+                return
+            if ok and self.failures >= config.ROUTER_BREAKER_FAILURES:
+                # The probe of a tripped circuit got through: the backend starts over with a clean record
+                self.outcomes.clear()
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies[kind].append(seconds)
+                self.failures = 0
+                self.counters["ok"] += 1
+            else:
+                self.failures += 1
+                self.counters["error"] += 1
+                if self.failures >= config.ROUTER_BREAKER_FAILURES:
+                    self.open_until = time.monotonic() + config.ROUTER_BREAKER_COOLDOWN
+        metrics.inc("rag_llm_backend_calls_total", backend=self.name,
+                    result="cancelled" if cancelled else "ok" if ok else "error")
+
+    def stats(self):
+        def ms(kind, q):
+            value = self.quantile(kind, q)
+            return None if value is None else round(1000 * value, 1)
+
+        return {"name": self.name, "model": self.model, "state": self.state(), "error_rate": self.error_rate(),
+                "consecutive_failures": self.failures, **self.counters,
+                **{f"{kind}_{name}_ms": ms(kind, q) for kind in self.latencies
+                   for name, q in (("p50", 0.5), ("p95", 0.95))}}
+
+
+class LLMRouter:
+    #### --------- Drop-in for LLMClient's chat calls over several backends: each call goes to the backend with ------###
+    #### --------- the lowest expected latency among those whose circuit is closed. If it is slower than its p95, ------###
+    #### --------- the next backend gets the same call and the first answer wins (the other one is cancelled); ------###
+    #### --------- if it fails, the call moves on to the next backend ------###
+
+    def __init__(self, backends=None, hedge=config.ROUTER_HEDGE, explore_rate=config.ROUTER_EXPLORE_RATE):
+        if not backends:
+            backends = [{"name": "default", "base_url": config.LLM_BASE_URL}]
+        self.backends = [backend if isinstance(backend, Backend) else Backend(**backend) for backend in backends]
+        self.hedge = hedge
+        self.explore_rate = explore_rate
+        self.counters = {"calls": 0, "hedged": 0, "hedge_wins": 0, "failovers": 0}
+
+    def ranked(self, kind):
+        #### ------- Backends in the order they would be tried, fastest expected first -------###
+        # Half-open ones first (their probe decides whether they come back), then by expected latency;
+        # open ones are skipped when the call is launched
+        order = sorted(self.backends, key=lambda backend: (backend.state() != "half-open", backend.score(kind)))
+        if len(order) > 1 and random.random() < self.explore_rate:
+            other = random.randrange(1, len(order))
+            order[0], order[other] = order[other], order[0]
+        return order
+
+    async def _attempt(self, backend, kind, call, deferred=False):
+        #### ------- `deferred`: a success is recorded by the caller, once the call is really over (a stream) -------###
+        start = time.perf_counter()
+        try:
+            result = await call(backend)
+        except asyncio.CancelledError:
+            backend.record(kind, time.perf_counter() - start, cancelled=True)
+            raise
+        except Exception as e:
+            if is_retryable(e):
+                backend.record(kind, ok=False)
+            else:
+                backend.record(kind, time.perf_counter() - start)  # the backend answered, the request was wrong
+            raise
+        if not deferred:
+            backend.record(kind, time.perf_counter() - start)
+        return result
+
+    async def _route(self, kind, call, discard=None, deferred=False):
+        #### ------- (result of `await call(backend)`, backend) from the first backend that succeeds; ------###
+        #### ------- `discard(result)` releases the result of a call that succeeded but lost the race ------###
+        self.counters["calls"] += 1
+        candidates = iter(self.ranked(kind))
+        pending = {}   # task -> (backend, started at)
+        errors = []
+        hedged = False
+
+        def launch():
+            for backend in candidates:
+                if backend.acquire():
+                    task = asyncio.ensure_future(self._attempt(backend, kind, call, deferred))
+                    pending[task] = (backend, time.monotonic())
+                    return True
+            return False
+
+        if not launch():
+            raise BackendsUnavailable("every LLM backend is unavailable (circuit open)")
+        first = next(iter(pending.values()))[0]
+        try:
+            while pending:
+                timeout = None
+                if self.hedge and not hedged and len(pending) == 1:
+                    backend, started = next(iter(pending.values()))
+                    delay = backend.hedge_delay(kind)
+                    if delay is not None:
+                        timeout = max(delay - (time.monotonic() - started), 0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if launch():
+                        self.counters["hedged"] += 1
+                        metrics.inc("rag_llm_router_events_total", event="hedge")
+                    continue
+                winner = None
+                for task in done:
+                    backend, _ = pending.pop(task)
+                    if task.exception() is None:
+                        if winner is None:
+                            winner = (task.result(), backend)
+                        elif discard is not None:
+                            await discard(task.result())
+                        continue
+                    errors.append(task.exception())
+                    if not is_retryable(task.exception()):
+                        raise task.exception()
+                if winner is not None:
+                    if hedged and not errors and winner[1] is not first:
+                        self.counters["hedge_wins"] += 1
+                    return winner
+                if not pending and launch():
+                    self.counters["failovers"] += 1
+                    metrics.inc("rag_llm_router_events_total", event="failover")
+            raise errors[-1] if errors else BackendsUnavailable("every LLM backend is unavailable (circuit open)")
+        finally:
+            # The losers: cancelled, which closes their connection
+            for task in pending:
+                task.cancel()
+            results = await asyncio.gather(*pending, return_exceptions=True) if pending else []
+            for result in results:
+                if discard is not None and not isinstance(result, BaseException):
+                    await discard(result)
+
+    ## ------------------ LLMClient interface --------------###
+
+    async def complete(self, messages, model=None, temperature=0, **params):
+        #### ------- Whole chat completion response of the backend that answered first ("backend": its name) -------###
+        async def call(backend):
+            return await backend.client().complete(messages, backend.model or model or config.MODEL_NAME,
+                                                   temperature, **params)
+
+        data, backend = await self._route("chat", call)
+        return {**data, "backend": backend.name}
+
+    async def chat(self, messages, model=None, temperature=0, **params):
+        data = await self.complete(messages, model, temperature, **params)
+        return data["choices"][0]["message"]["content"]
+
+    async def stream_chat(self, messages, model=None, temperature=0, **params):
+        #### ------- Yields the completion text of the backend whose first token came first; the race (hedging ------###
+        #### ------- and failover) is over once a token has been yielded. The backend's outcome is recorded once, ------###
+        #### ------- when its stream ends: a stream that breaks after its first token is a failure, not a success ------###
+        async def first_piece(backend):
+            start = time.perf_counter()
+            pieces = backend.client().stream_chat(messages, backend.model or model or config.MODEL_NAME,
+                                                  temperature, **params)
+            try:
+                piece = await pieces.__anext__()
+            except StopAsyncIteration:
+                piece = None
+            except BaseException:
+                await pieces.aclose()
+                raise
+            return piece, pieces, time.perf_counter() - start, backend
+
+        async def discard(result):
+            # Lost the race after its first token: a success, as far as it went
+            _, pieces, seconds, backend = result
+            backend.record("stream", seconds)
+            await pieces.aclose()
+
+        (piece, pieces, seconds, _), backend = await self._route("stream", first_piece, discard, deferred=True)
+        ok = True
+        try:
+            if piece is not None:
+                yield piece
+            async for piece in pieces:
+                yield piece
+        except Exception as e:
+            ok = not is_retryable(e)    # a 4xx: the backend answered, the request was wrong
+            raise
+        finally:
+            # Also reached when the reader stops early, which is no failure of the backend
+            backend.record("stream", seconds if ok else None, ok=ok)
+            await pieces.aclose()
+
+    async def embed(self, texts, model=config.EMBEDDING_MODEL):
+        # Embeddings are not routed: every vector of an index must come from the same model
+        return await llm_client.get_client().embed(texts, model)
+
+    async def aclose(self):
+        #### ------- Closes the connections of the running event loop -------###
+        for backend in self.backends:
+            await backend.aclose()
+
+    ## ------------------ Blocking calls for scripts --------------###
+
+    def chat_sync(self, messages, model=None, temperature=0, **params):
+        async def run():
+            try:
+                return await self.chat(messages, model, temperature, **params)
+            finally:
+                await self.aclose()
+
+        return asyncio.run(run())
+
+    def stream_chat_sync(self, messages, model=None, temperature=0, **params):
+        #### ------- Blocking generator over stream_chat, on an event loop of its own -------###
+        loop = asyncio.new_event_loop()
+        pieces = self.stream_chat(messages, model, temperature, **params)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(pieces.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(pieces.aclose())
+            loop.run_until_complete(self.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    def stats(self):
+        return {**self.counters, "backends": [backend.stats() for backend in self.backends]}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+def get_router():
+    #### ------- The process-wide router over config.LLM_BACKENDS, created on first use -------###
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = LLMRouter(config.LLM_BACKENDS)
+    return _router
@@ -1,6 +1,23 @@
+import json
+import time
+import asyncio
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 
 import config
 import llm
+import corpus
+import ingest
+import serving
+import llm_client
+import llm_router
+import answer_cache
+import singleflight
+import embeddings
+import metrics
 import keys
 import os
 
@@ -13,21 +30,231 @@ sys.path.append(os.path.abspath(os.path.join(os.getcwd(), "../..")))
 app = FastAPI()
 os.environ["OPENAI_API_KEY"] = keys.key
 
+#### --------- One persistent index for the served document, shared by every request ------------------ ####
+#### --------- (in serving mode, the published version mapped read-only and shared by every worker process) ------------------ ####
+document_index = serving.ServingIndex() if config.SERVING_MODE else llm.DocumentIndex(config.DOCUMENT_PATH)
+
+#### --------- Shared index of all the course documents under CORPUS_DIR, one namespace per course ------------------ ####
+corpus_index = corpus.CorpusIndex()
+
+#### --------- Uploaded documents waiting to be added to the corpus, and the threads that add them ------------------ ####
+ingest_queue = ingest.JobQueue()
+ingest_worker = ingest.IngestWorker(corpus_index, ingest_queue)
+
+#### --------- Answers already generated for the served document, reused for repeated questions ------------------ ####
+answers = answer_cache.AnswerCache()
+
+#### --------- Identical questions asked at the same time (a classroom burst) share one answer in flight ------------------ ####
+flights = singleflight.SingleFlight()
+
+#### --------- Counters kept by the caches, exported on /metrics ------------------ ####
+metrics.register_collector("rag_answer_cache_events_total", "Answer cache hits, misses, bypasses and evictions",
+                           lambda: [({"result": name}, value) for name, value in answers.counters.items()])
+metrics.register_collector("rag_singleflight_requests_total", "Requests that started an answer or joined one in flight",
+                           lambda: [({"role": name}, value) for name, value in flights.counters.items()])
+metrics.register_collector("rag_embedding_cache_total", "Embedding cache lookups by result",
+                           lambda: [({"result": "hit"}, embeddings.get_embeddings().hits),
+                                    ({"result": "miss"}, embeddings.get_embeddings().misses)])
+
+if metrics.enabled:
+    @app.middleware("http")
+    async def add_server_timing(request, call_next):
+        #### ---------- Times every stage of the request and reports them in a Server-Timing header -------------- ####
+        #### ---------- (for /query/stream, only the stages that ran before the first byte was sent) -------------- ####
+        token = metrics.start_trace()
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            trace = metrics.end_trace(token)
+        trace.append(("total", time.perf_counter() - start))
+        response.headers["Server-Timing"] = metrics.server_timing(trace)
+        return response
+
 #### --------- Mounting static files to be served at the "/static" endpoint ------------------ ####
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+@app.on_event("startup")
+async def load_index():
+    #### ---------- Loading the heavy dependencies and (or building once) the index before the first request comes in -------------- ####
+    if config.WARM_UP:
+        await asyncio.to_thread(llm.warm_up)
+        llm_client.get_client()
+        for backend in llm_router.get_router().backends:
+            backend.client()
+    document_index.get_chunk_store()
+    if not config.SERVING_MODE:
+        # In serving mode the build step syncs the corpus once, instead of every worker at the same time,
+        # and the uploads are ingested by one dedicated process (`python ingest.py`), not by every worker
+        corpus_index.sync()
+        ingest_worker.start()
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    #### ---------- Closing the pooled upstream connections and letting the current ingestion jobs finish -------------- ####
+    await llm_client.close_client()
+    await llm_router.get_router().aclose()
+    await asyncio.to_thread(ingest_worker.stop, config.INGEST_STOP_TIMEOUT)
+
 @app.get("/")
 async def read_root():
     #### ---------- Serving the static index.html file when the root ("/") is accessed -------------- ####
     return FileResponse('static/index.html')
 
+async def create_query_runner(no_cache, course=None):
+    #### ------Creating a QueryRunner object on top of the shared index (rebuilt only if the document changed) --------------####
+    #### ------or, when a course is given, on top of that course's namespace of the corpus index --------------####
+    if course is None:
+        chunk_store = await asyncio.to_thread(document_index.get_chunk_store)
+        version = document_index.key
+    else:
+        # Documents ingested by another process since the last request are picked up here
+        await asyncio.to_thread(corpus_index.refresh)
+        if course not in corpus_index.courses:
+            raise HTTPException(status_code=404, detail=f"Unknown course: {course}")
+        chunk_store = corpus_index.course_store(course)
+        version = f"{course}:{corpus_index.course_versions[course]}"
+
+    if no_cache:
+        answers.record_bypass()
+    return llm.QueryRunner(document_path = config.DOCUMENT_PATH ,model_name=config.MODEL_NAME,
+                           chunk_store=chunk_store, cache=None if no_cache else answers,
+                           document_version=version, flights=flights)
+
 @app.get("/query")
-async def get_query_response(query: str = Query(..., description="Enter your query here")):
-    #### ------Creating a QueryRunner object with the document path and model name --------------####
-    query_runner = llm.QueryRunner(document_path = config.DOCUMENT_PATH ,model_name=config.MODEL_NAME)
+async def get_query_response(query: str = Query(..., description="Enter your query here"),
+                             course: Optional[str] = Query(None, description="Search this course of the corpus"),
+                             no_cache: bool = Query(False, description="Skip the answer cache")):
+    query_runner = await create_query_runner(no_cache, course)
 
-    #### ------ Running the query and getting the response ------------------####
-    response = query_runner.run_query(query)
+    #### ------ Running the query and getting the response, without blocking the other requests ------------------####
+    try:
+        response = await asyncio.wait_for(query_runner.arun_query(query), timeout=config.QUERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The query timed out")
 
     #### --------  Returning the response as a JSON object -------- ####
     return {"response": response}
+
+def server_sent_event(event, data):
+    #### -------- One Server-Sent Event with a JSON payload -------- ####
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/query/stream")
+async def stream_query_response(query: str = Query(..., description="Enter your query here"),
+                                course: Optional[str] = Query(None, description="Search this course of the corpus"),
+                                no_cache: bool = Query(False, description="Skip the answer cache")):
+    #### ------ Same as /query, but streams Server-Sent Events: the sources first, then the answer token by token ------------------####
+    query_runner = await create_query_runner(no_cache, course)
+
+    async def events():
+        try:
+            cached, vector = await query_runner.alookup(query)
+            if cached is not None:
+                yield server_sent_event("sources", cached.sources)
+                yield server_sent_event("token", cached.answer)
+                yield server_sent_event("done", {"cached": True})
+                return
+
+            async for kind, value in query_runner.astream_query(query, vector):
+                if kind == "sources":
+                    value = [{"content": chunk.page_content, "metadata": chunk.metadata} for chunk in value]
+                yield server_sent_event(kind, value)
+            yield server_sent_event("done", {})
+        except Exception as e:
+            yield server_sent_event("error", {"detail": str(e) or type(e).__name__})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/corpus/courses")
+async def get_courses():
+    #### -------- Courses of the corpus with their documents -------- ####
+    await asyncio.to_thread(corpus_index.refresh)
+    courses = {}
+    for relpath, entry in sorted(corpus_index.files.items()):
+        courses.setdefault(entry["course"], []).append({"source": relpath, "chunks": entry["chunks"]})
+    return courses
+
+@app.post("/corpus/sync")
+async def sync_corpus():
+    #### -------- Re-scans CORPUS_DIR and re-indexes only the files that were added, changed or removed -------- ####
+    return await asyncio.to_thread(corpus_index.sync)
+
+@app.post("/corpus/upload", status_code=202)
+async def upload_document(request: Request,
+                          filename: str = Query(..., description="Name of the document, e.g. ondes.txt"),
+                          course: Optional[str] = Query(None, description="Course the document belongs to")):
+    #### -------- Queues the request body for ingestion and returns the job at once; poll /corpus/jobs/{id} -------- ####
+    try:
+        ingest.check_upload(filename, course)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    too_large = HTTPException(status_code=413, detail=f"Uploads are limited to {config.INGEST_MAX_UPLOAD_BYTES} bytes")
+    try:
+        declared = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length header")
+    # Only an early refusal: the bytes counted while the body streams are the real limit
+    if declared > config.INGEST_MAX_UPLOAD_BYTES:
+        raise too_large
+    job_id = ingest_queue.new_job_id()
+    path = ingest_queue.upload_path(job_id)
+    # The body goes to disk block by block in a thread, so a large upload does not block the event loop
+    f = await asyncio.to_thread(open, path, 'wb')
+    try:
+        size = 0
+        async for block in request.stream():
+            size += len(block)
+            if size > config.INGEST_MAX_UPLOAD_BYTES:
+                raise too_large
+            await asyncio.to_thread(f.write, block)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.remove, path)
+        raise
+    await asyncio.to_thread(f.close)
+    job = await asyncio.to_thread(ingest_queue.submit, job_id, filename, course)
+    ingest_worker.wake()
+    return job
+
+@app.get("/corpus/jobs")
+async def get_ingest_jobs(limit: int = Query(50, ge=1, le=1000)):
+    #### -------- Most recent ingestion jobs and the number of jobs per status -------- ####
+    jobs = await asyncio.to_thread(ingest_queue.list, limit)
+    return {"counts": await asyncio.to_thread(ingest_queue.counts), "jobs": jobs}
+
+@app.get("/corpus/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = await asyncio.to_thread(ingest_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+@app.get("/index")
+async def get_index():
+    #### -------- Index this worker answers from: in serving mode, the manifest of the version it has mapped -------- ####
+    await asyncio.to_thread(document_index.get_chunk_store)
+    if config.SERVING_MODE:
+        return {"mode": "serving", "pid": os.getpid(), **document_index.manifest}
+    return {"mode": "build", "pid": os.getpid(), "key": document_index.key}
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    #### -------- Hit rate of the answer cache, and the requests that joined an answer already in flight -------- ####
+    return {**answers.stats(), "singleflight": {**flights.counters, "in_flight": flights.in_flight()}}
+
+@app.get("/metrics")
+async def get_metrics():
+    #### -------- Stage timings, token usage and cache counters in the Prometheus text format -------- ####
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/embeddings/stats")
+async def get_embedding_stats():
+    #### -------- Hit/miss counters of the embedding cache -------- ####
+    return embeddings.get_embeddings().stats()
+
+@app.get("/llm/backends")
+async def get_llm_backends():
+    #### -------- Latency, error rate and circuit state of every LLM backend the router picks from -------- ####
+    return llm_router.get_router().stats()
@@ -0,0 +1,142 @@
+import time
+import bisect
+import threading
+import contextvars
+
+import config
+
+
+## ------------------ Stage timings and counters, in Prometheus text format and Server-Timing headers --------------###
+
+# Upper bounds (seconds) of the stage histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+enabled = config.METRICS_ENABLED
+
+_lock = threading.Lock()
+_histograms = {}    # stage -> [per-bucket counts (last one is +Inf), sum, count]
+_counters = {}      # (name, ((label, value), ...)) -> value
+_collectors = []    # (name, help, collect) read when /metrics is scraped
+_trace = contextvars.ContextVar("trace", default=None)  # [(stage, seconds)] of the current request
+
+COUNTER_HELP = {
+    "rag_llm_tokens_total": "Tokens reported by the LLM API, by kind (prompt, completion)",
+    "rag_llm_requests_total": "Calls to the LLM API, by endpoint",
+}
+
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan:
+    #### --------- Returned by span() when metrics are disabled: nothing is allocated nor timed ------###
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(stage):
+    #### ------- `with metrics.span("retrieve"):` times the block into the stage histogram and the request trace -------###
+    return _Span(stage) if enabled else _NO_SPAN
+
+
+def observe(stage, seconds):
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((stage, seconds))
+
+
+def inc(name, value=1, **labels):
+    if not enabled or not value:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def register_collector(name, help, collect):
+    #### ------- `collect()` returns [(labels dict, value)] of a counter kept elsewhere (e.g. cache hit counters) -------###
+    _collectors.append((name, help, collect))
+
+
+def start_trace():
+    #### ------- Starts collecting the spans of the current request; returns the token for end_trace -------###
+    return _trace.set([])
+
+
+def end_trace(token):
+    trace = _trace.get()
+    _trace.reset(token)
+    return trace or []
+
+
+def server_timing(trace):
+    #### ------- Server-Timing header value; a stage that ran several times is reported once, summed -------###
+    totals = {}
+    for stage, seconds in trace:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={1000 * seconds:.2f}" for stage, seconds in totals.items())
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+
+def render():
+    #### ------- Every metric in the Prometheus text exposition format -------###
+    with _lock:
+        histograms = {stage: (list(h[0]), h[1], h[2]) for stage, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = ["# HELP rag_stage_seconds Time spent in each stage of the pipeline",
+             "# TYPE rag_stage_seconds histogram"]
+    for stage, (buckets, total, count) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, n in zip(BUCKETS, buckets):
+            cumulative += n
+            lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {count}')
+
+    by_name = {}
+    helps = dict(COUNTER_HELP)
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name, help, collect in _collectors:
+        by_name.setdefault(name, []).extend((tuple(sorted(labels.items())), value) for labels, value in collect())
+        helps[name] = help
+    for name, samples in sorted(by_name.items()):
+        lines.append(f"# HELP {name} {helps.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(samples):
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
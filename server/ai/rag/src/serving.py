@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import bisect
+import datetime
+import shutil
+import logging
+import argparse
+import threading
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+import config
+import corpus
+import embeddings
+import lexical
+import llm
+import summaries
+import vector_store
+
+
+## ------------------ Prebuilt index mapped read-only by every worker process (multi-worker serving) --------------###
+
+# SERVING_INDEX_DIR/
+#   CURRENT                          name of the published version, replaced atomically by `build`/`activate`
+#   20261018-153012-123456/          one directory per version, never modified once published
+#     manifest.json                  written last: a version without it is incomplete
+#     vectors.npy                    normalized float32 embeddings
+#     texts.npy, text_offsets.npy    chunk texts as one UTF-8 byte array + offsets
+#     metadatas.npy, metadata_offsets.npy
+#     bm25_*.npy                     CSR arrays of the lexical index, terms sorted
+#     summaries/                     summary tree of the document (summaries.py), when built with --summaries
+# Every file is a plain .npy opened with mmap_mode='r': N workers share one copy in the page cache.
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+logger = logging.getLogger(__name__)
+
+
+class StringTable(Sequence):
+    #### --------- Read-only list of strings over a mapped UTF-8 byte array; a string is decoded when accessed ------###
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode(config.ENCODING)
+
+
+class JSONTable(StringTable):
+    #### --------- Same, for the chunk metadatas stored as one JSON object per row ------###
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return json.loads(super().__getitem__(index))
+
+
+class SortedTerms(Mapping):
+    #### --------- term -> id of the BM25 index by binary search over its mapped, sorted vocabulary ------###
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __getitem__(self, term):
+        t = bisect.bisect_left(self.terms, term)
+        if t == len(self.terms) or self.terms[t] != term:
+            raise KeyError(term)
+        return t
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+def _save(directory, name, array):
+    np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+
+def _map(directory, name):
+    return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+
+
+def write_version(directory, texts, vectors, metadatas, bm25, manifest):
+    #### ------- Writes the files of one version; the manifest goes last -------###
+    os.makedirs(directory)
+    _save(directory, "vectors", vectors.astype(np.float32))
+    tables = (("texts", "text_offsets", texts),
+              ("metadatas", "metadata_offsets", (json.dumps(metadata, ensure_ascii=False) for metadata in metadatas)),
+              ("bm25_terms", "bm25_term_offsets", sorted(bm25.terms, key=bm25.terms.get)))
+    for name, offsets_name, strings in tables:
+        data, offsets = lexical.pack_strings(strings)
+        _save(directory, name, data)
+        _save(directory, offsets_name, offsets)
+    for name in ("offsets", "rows", "weights", "idf"):
+        _save(directory, f"bm25_{name}", getattr(bm25, name))
+    with open(os.path.join(directory, MANIFEST_FILE), 'w', encoding=config.ENCODING) as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+
+def open_version(directory):
+    #### ------- (ChunkStore over the mapped files of a version, its manifest) -------###
+    with open(os.path.join(directory, MANIFEST_FILE), 'r', encoding=config.ENCODING) as f:
+        manifest = json.load(f)
+    embedding = embeddings.get_embeddings()
+    if manifest["embedding_model"] != embedding.model:
+        raise ValueError(f"Version {manifest['version']} was embedded with {manifest['embedding_model']}, "
+                         f"not {embedding.model}")
+
+    texts = StringTable(_map(directory, "texts"), _map(directory, "text_offsets"))
+    metadatas = JSONTable(_map(directory, "metadatas"), _map(directory, "metadata_offsets"))
+    terms = SortedTerms(StringTable(_map(directory, "bm25_terms"), _map(directory, "bm25_term_offsets")))
+    chunk_store = llm.ChunkStore(None, persist_directory=directory)
+    chunk_store.vectorstore = vector_store.NumpyVectorStore(texts, _map(directory, "vectors"), metadatas, embedding,
+                                                            directory)
+    chunk_store.lexical = lexical.BM25Index(terms, _map(directory, "bm25_offsets"), _map(directory, "bm25_rows"),
+                                            _map(directory, "bm25_weights"), _map(directory, "bm25_idf"),
+                                            texts, metadatas)
+    chunk_store.summaries = summaries.SummaryIndex.load(directory)
+    return chunk_store, manifest
+
+
+def current_version(serving_dir=config.SERVING_INDEX_DIR):
+    #### ------- Name of the published version, or None -------###
+    try:
+        with open(os.path.join(serving_dir, CURRENT_FILE), 'r', encoding=config.ENCODING) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_manifest(serving_dir, version):
+    with open(os.path.join(serving_dir, version, MANIFEST_FILE), 'r', encoding=config.ENCODING) as f:
+        return json.load(f)
+
+
+def list_versions(serving_dir=config.SERVING_INDEX_DIR):
+    #### ------- Complete versions, oldest first (names start with their build time) -------###
+    if not os.path.isdir(serving_dir):
+        return []
+    return sorted(name for name in os.listdir(serving_dir)
+                  if not name.startswith(".") and os.path.exists(os.path.join(serving_dir, name, MANIFEST_FILE)))
+
+
+def activate(version, serving_dir=config.SERVING_INDEX_DIR):
+    #### ------- Points CURRENT at a version with one rename: workers switch on their next request -------###
+    if version not in list_versions(serving_dir):
+        raise ValueError(f"Unknown or incomplete version: {version}")
+    path = os.path.join(serving_dir, CURRENT_FILE)
+    with open(path + ".tmp", 'w', encoding=config.ENCODING) as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def prune(serving_dir=config.SERVING_INDEX_DIR, keep=config.SERVING_KEEP_VERSIONS):
+    #### ------- Removes all but the `keep` newest versions (and the current one); workers that still ------###
+    #### ------- map a removed version keep reading it until they switch, the files only go away then ------###
+    current = current_version(serving_dir)
+    versions = list_versions(serving_dir)
+    removed = [version for version in versions[:max(len(versions) - keep, 0)] if version != current]
+    for version in removed:
+        shutil.rmtree(os.path.join(serving_dir, version), ignore_errors=True)
+    return removed
+
+
+def build(document_path=config.DOCUMENT_PATH, serving_dir=config.SERVING_INDEX_DIR, force=False,
+          keep=config.SERVING_KEEP_VERSIONS, with_summaries=config.SUMMARY_INDEX):
+    #### ------- Chunks, embeds and indexes the document (and summarizes it, `with_summaries`) into a new ------###
+    #### ------- version and publishes it; returns the manifest of the current version (unchanged when the ------###
+    #### ------- content and settings are, and it has the summaries asked for) ------###
+    key = llm.index_key(document_path)
+    current = current_version(serving_dir)
+    if current is not None and not force:
+        manifest = read_manifest(serving_dir, current)
+        if manifest["key"] == key and (manifest.get("summaries") or not with_summaries):
+            return manifest
+
+    chunks, metadatas = llm.chunk_document(document_path)
+    if not chunks:
+        raise ValueError(f"{document_path} has no text to index")
+    embedding = embeddings.get_embeddings()
+    vectors = vector_store.normalize_rows(embedding.embed_documents(chunks))
+    bm25 = lexical.BM25Index.build(chunks, metadatas)
+    tree = summaries.summarize(chunks, metadatas) if with_summaries else None
+
+    version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    manifest = {"version": version, "key": key, "document": os.path.abspath(document_path), "chunks": len(chunks),
+                "dimensions": int(vectors.shape[1]), "embedding_model": embedding.model,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    if tree is not None:
+        manifest["summaries"] = tree[2]["levels"]
+    # Written next to the published versions, then renamed: a version directory is complete or absent
+    staging = os.path.join(serving_dir, f".{version}.tmp")
+    try:
+        write_version(staging, chunks, vectors, metadatas, bm25, manifest)
+        if tree is not None:
+            summaries.save(os.path.join(staging, summaries.SUMMARY_DIR), *tree)
+        os.replace(staging, os.path.join(serving_dir, version))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    activate(version, serving_dir)
+    prune(serving_dir, keep)
+    return manifest
+
+
+class ServingIndex:
+    #### --------- Drop-in for llm.DocumentIndex in the workers: maps the published version read-only and ------###
+    #### --------- follows CURRENT (one stat() per request); requests in flight finish on the version they started on ------###
+
+    def __init__(self, serving_dir=config.SERVING_INDEX_DIR):
+        self.serving_dir = serving_dir
+        self.key = None
+        self.version = None
+        self.manifest = None
+        self.chunk_store = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _pointer_signature(self):
+        try:
+            stat = os.stat(os.path.join(self.serving_dir, CURRENT_FILE))
+        except FileNotFoundError:
+            raise FileNotFoundError(f"No index published in {self.serving_dir}: run `python serving.py build`")
+        # A rename gives CURRENT a new inode even when the mtime does not change
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def is_stale(self):
+        return self.chunk_store is None or self._pointer_signature() != self._signature
+
+    def load(self):
+        signature = self._pointer_signature()
+        version = current_version(self.serving_dir)
+        if version != self.version:
+            try:
+                chunk_store, manifest = open_version(os.path.join(self.serving_dir, version))
+            except Exception:
+                if self.chunk_store is None:
+                    raise
+                # Keep serving the version already mapped rather than failing every request
+                logger.exception("Could not switch to index version %s, still serving %s", version, self.version)
+                self._signature = signature
+                return self.chunk_store
+            self.chunk_store, self.manifest = chunk_store, manifest
+            self.key, self.version = manifest["key"], version
+        self._signature = signature
+        return self.chunk_store
+
+    def get_chunk_store(self):
+        if self.is_stale():
+            with self._lock:
+                if self.is_stale():
+                    self.load()
+        return self.chunk_store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds and publishes the index shared by the API workers "
+                                                 "(SERVING_MODE = True).")
+    parser.add_argument("--dir", default=config.SERVING_INDEX_DIR, help="serving index directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_command = commands.add_parser("build", help="index the document and publish it as a new version")
+    build_command.add_argument("--document", default=config.DOCUMENT_PATH)
+    build_command.add_argument("--force", action="store_true", help="build even if the content did not change")
+    build_command.add_argument("--keep", type=int, default=config.SERVING_KEEP_VERSIONS,
+                               help="published versions kept on disk")
+    build_command.add_argument("--no-corpus", action="store_true", help="do not sync the course corpus index")
+    build_command.add_argument("--summaries", action=argparse.BooleanOptionalAction, default=config.SUMMARY_INDEX,
+                               help="also build the summary tree of the document (LLM calls)")
+    activate_command = commands.add_parser("activate", help="publish an existing version again (rollback)")
+    activate_command.add_argument("version")
+    commands.add_parser("list", help="versions on disk, the current one marked with *")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        previous = current_version(args.dir)
+        manifest = build(args.document, args.dir, args.force, args.keep, args.summaries)
+        state = "unchanged" if manifest["version"] == previous else "published"
+        levels = " -> ".join(str(count) for count in manifest.get("summaries", []))
+        print(f"{manifest['version']} {state}: {manifest['chunks']} chunks of {manifest['document']}"
+              + (f", {levels} summaries" if levels else ""))
+        if not args.no_corpus:
+            # The workers only load the corpus index in serving mode; it is brought up to date here
+            print(f"corpus: {corpus.CorpusIndex().sync()}")
+    elif args.command == "activate":
+        try:
+            activate(args.version, args.dir)
+        except ValueError as e:
+            sys.exit(str(e))
+        print(f"{args.version} published")
+    else:
+        current = current_version(args.dir)
+        for version in list_versions(args.dir):
+            manifest = read_manifest(args.dir, version)
+            print(f"{'*' if version == current else ' '} {version}  {manifest['chunks']:>7} chunks  "
+                  f"{manifest['key'][:12]}  {manifest['document']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import asyncio
+import weakref
+
+
+## ------------------ Identical requests in flight at the same time share one upstream call --------------###
+
+class _Broadcast:
+    #### --------- Items of one async generator, run in its own task and replayed from the start to every ------###
+    #### --------- subscriber, whenever it joined; the error of the generator, if any, is raised to all of them ------###
+
+    def __init__(self, source):
+        self.items = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = ConnectionError("The shared upstream call was cancelled")
+            raise
+        except Exception as e:
+            # Raised to the subscribers, not from the task (nobody awaits it)
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self):
+        position = 0
+        while True:
+            # Taken before reading the items: anything added from now on sets it
+            changed = self._changed
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.done and position == len(self.items):
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    #### --------- key -> the call in flight for it. A request that arrives while the call runs awaits its result ------###
+    #### --------- instead of starting its own; the flight is forgotten as soon as it ends (caching is not done here). ------###
+    #### --------- The call runs in its own task, so the request that started it can disconnect or time out ------###
+    #### --------- without failing the others ------###
+
+    def __init__(self):
+        # asyncio tasks belong to the event loop they were created in: one table of flights per loop
+        self._flights = weakref.WeakKeyDictionary()
+        self.counters = {"leaders": 0, "followers": 0}
+
+    def _join(self, key, start):
+        #### ------- The flight of key, started with start() if there is none -------###
+        flights = self._flights.setdefault(asyncio.get_running_loop(), {})
+        flight = flights.get(key)
+        if flight is not None:
+            self.counters["followers"] += 1
+            return flight
+        self.counters["leaders"] += 1
+        flight = flights[key] = start()
+        task = flight if isinstance(flight, asyncio.Future) else flight.task
+        task.add_done_callback(lambda _: flights.pop(key, None) if flights.get(key) is flight else None)
+        return flight
+
+    async def call(self, key, function):
+        #### ------- Result of `await function()`, shared with the concurrent calls of the same key -------###
+        def start():
+            task = asyncio.ensure_future(function())
+            # Marks the error as retrieved even when every caller went away before the end
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            return task
+
+        return await asyncio.shield(self._join(key, start))
+
+    async def stream(self, key, generator):
+        #### ------- Items of `generator()`, shared with the concurrent streams of the same key -------###
+        broadcast = self._join(key, lambda: _Broadcast(generator()))
+        async for item in broadcast.subscribe():
+            yield item
+
+    def in_flight(self):
+        return sum(len(flights) for flights in self._flights.values())
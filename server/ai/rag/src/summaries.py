@@ -0,0 +1,263 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+
+import numpy as np
+
+import config
+import embeddings
+import lexical
+import llm_router
+import metrics
+import context_packer
+import vector_store
+
+
+## ------------------ Tree of summaries over the chunks of a document, built once at ingest time --------------###
+
+# <index directory>/summaries/
+#   tree.json                        model, prompt version and node count of every level; written last
+#   vectors.npy, chunks.json         one row per node (NumpyVectorStore): its summary, embedding and metadata
+#                                    {"source", "level", "kind", "chunks": [first, last], "range": [start, end]}
+# Level 0 summarizes each chunk, every next level combines up to SUMMARY_FANOUT consecutive summaries of the
+# level below, until a single one is left: kind "chunk", then "section" ..., and "document" for the last level.
+
+SUMMARY_DIR = "summaries"
+TREE_FILE = "tree.json"
+
+CHUNK_PROMPT = """Summarize the following excerpt of a lecture in at most {words} words. \
+Keep its definitions, formulas, examples and conclusions, in the order they come. \
+Write in the language of the excerpt and answer with the summary only.
+----------------
+{text}"""
+
+REDUCE_PROMPT = """Here are the summaries of consecutive parts of a lecture, in order. \
+Combine them into one summary of at most {words} words that covers every part, in the same order. \
+Write in the language of the summaries and answer with the summary only.
+----------------
+{text}"""
+
+PROMPT_VERSION = hashlib.sha256((CHUNK_PROMPT + REDUCE_PROMPT).encode(config.ENCODING)).hexdigest()[:12]
+
+# Questions about the whole document or one of its parts rather than a detail of it
+_BROAD = re.compile(r"\b(r[ée]sum\w*|summar\w*|overview|outline|synth[eè]s\w*|recap\w*|r[ée]capitul\w*|"
+                    r"main (?:points?|ideas?|topics?)|key (?:points?|ideas?|takeaways?)|"
+                    r"points? (?:cl[ée]s?|essentiels?)|"
+                    r"id[ée]es? (?:principales?|essentielles?)|grandes lignes|de quoi parle|"
+                    # "what is ... about" only when it names the document: "at about 20 degrees" is a detail
+                    r"what(?: is|'s| was) (?:this|the|that|today's) (?:lessons?|lectures?|courses?|class|documents?|"
+                    r"transcripts?|videos?|recordings?|chapters?) about|"
+                    r"what did (?:we|i|you) (?:learn|cover|see))\b", re.IGNORECASE)
+# Words that name the document itself: with them (or with nothing else), the question is about all of it
+_WHOLE = re.compile(r"\b(lessons?|lectures?|courses?|class|documents?|transcripts?|videos?|recordings?|chapters?|"
+                    r"whole|entire|all|cours|le[çc]ons?|s[ée]ances?|vid[ée]os?|enregistrements?|chapitres?|"
+                    r"tout|toute|ensemble|enti[eè]re?)\b", re.IGNORECASE)
+_FILLER = set(lexical.tokenize("a an the of this that these me us please give can could you what is was are it its "
+                               "about in on for and le la les l de du des d un une ce cet cette ces moi nous "
+                               "peux pouvez tu vous quel quelle quels quelles est sont il elle en sur pour et "
+                               "qu que quoi parle s il plait svp"))
+
+
+def route(question):
+    #### ------- "document" for a question about the whole document ("summarize the lesson"), "section" for ------###
+    #### ------- a broad question about one part of it ("summarize the part on waves"), None for the others ------###
+    match = _BROAD.search(question)
+    if match is None:
+        return None
+    rest = _WHOLE.sub(" ", _BROAD.sub(" ", question))
+    topic = [word for word in lexical.tokenize(rest) if word not in _FILLER]
+    if _WHOLE.search(question) and len(topic) <= 1 or not topic:
+        return "document"
+    return "section"
+
+
+## ------------------ Build: parallel map (chunks) then reduce (levels) --------------###
+
+def group(texts, fanout=config.SUMMARY_FANOUT, max_tokens=config.SUMMARY_GROUP_TOKENS):
+    #### ------- Consecutive runs of at most `fanout` texts and `max_tokens` tokens, but at least two texts each, ------###
+    #### ------- so that every level has at most half as many summaries as the one below ------###
+    groups, current, tokens = [], [], 0
+    for index, text in enumerate(texts):
+        size = context_packer.count_tokens(text)
+        if len(current) >= 2 and (len(current) == fanout or tokens + size > max_tokens):
+            groups.append(current)
+            current, tokens = [], 0
+        current.append(index)
+        tokens += size
+    if current:
+        groups.append(current)
+    if len(groups) > 1 and len(groups[-1]) == 1:
+        # A lone last summary would be summarized on its own: it goes with the group before it
+        groups[-2].extend(groups.pop())
+    return groups
+
+
+async def build_tree(chunks, metadatas, client=None, model=config.SUMMARY_MODEL, workers=config.SUMMARY_WORKERS):
+    #### ------- (texts, metadatas, cost) of every node, level by level; the calls of a level run in parallel, ------###
+    #### ------- at most `workers` at a time ------###
+    client = client or llm_router.get_router()
+    semaphore = asyncio.Semaphore(workers)
+    cost = {"calls": 0, "prompt_tokens": 0}
+
+    async def ask(prompt, text, words):
+        content = prompt.format(words=words, text=text)
+        async with semaphore:
+            cost["calls"] += 1
+            cost["prompt_tokens"] += context_packer.count_tokens(content)
+            summary = await client.chat([{"role": "user", "content": content}], model=model, temperature=0)
+        return summary.strip()
+
+    source = metadatas[0].get("source") if metadatas else None
+    with metrics.span("summary_map"):
+        texts = await asyncio.gather(*(ask(CHUNK_PROMPT, chunk, config.SUMMARY_CHUNK_WORDS) for chunk in chunks))
+    nodes = [{"source": source, "level": 0, "chunks": [number, number],
+              "range": [metadata.get("start"), metadata.get("end")]} for number, metadata in enumerate(metadatas)]
+    all_texts, all_nodes = list(texts), list(nodes)
+    level = 0
+    while len(texts) > 1:
+        level += 1
+        groups = group(texts)
+        with metrics.span("summary_reduce"):
+            texts = await asyncio.gather(*(ask(REDUCE_PROMPT, "\n\n".join(texts[i] for i in members),
+                                               config.SUMMARY_REDUCE_WORDS) for members in groups))
+        nodes = [{"source": source, "level": level,
+                  "chunks": [nodes[members[0]]["chunks"][0], nodes[members[-1]]["chunks"][1]],
+                  "range": [nodes[members[0]]["range"][0], nodes[members[-1]]["range"][1]]} for members in groups]
+        all_texts.extend(texts)
+        all_nodes.extend(nodes)
+    for node in all_nodes:
+        node["kind"] = "document" if node["level"] == level else "chunk" if node["level"] == 0 else "section"
+    return all_texts, all_nodes, cost
+
+
+def summarize(chunks, metadatas, client=None, model=config.SUMMARY_MODEL):
+    #### ------- Blocking build_tree for scripts: (texts, node metadatas, tree description) -------###
+    if not chunks:
+        raise ValueError("no chunks to summarize")
+
+    async def run():
+        try:
+            return await build_tree(chunks, metadatas, client, model)
+        finally:
+            await (client or llm_router.get_router()).aclose()
+
+    start = time.perf_counter()
+    texts, nodes, cost = asyncio.run(run())
+    levels = max(node["level"] for node in nodes) + 1
+    tree = {"model": model, "prompt_version": PROMPT_VERSION, "embedding_model": embeddings.get_embeddings().model,
+            "levels": [sum(node["level"] == level for node in nodes) for level in range(levels)],
+            "seconds": round(time.perf_counter() - start, 3), **cost}
+    return texts, nodes, tree
+
+
+def save(summary_dir, texts, nodes, tree):
+    #### ------- Embeds and writes the nodes; tree.json goes last, so a tree without it is incomplete -------###
+    tree_path = os.path.join(summary_dir, TREE_FILE)
+    if os.path.exists(tree_path):
+        os.remove(tree_path)
+    vector_store.NumpyVectorStore.from_texts(texts, embeddings.get_embeddings(), nodes, summary_dir).persist()
+    with open(tree_path, 'w', encoding=config.ENCODING) as f:
+        json.dump(tree, f, indent=1)
+
+
+def build(directory, chunks, metadatas, client=None, model=config.SUMMARY_MODEL, force=False):
+    #### ------- Builds the summary tree of an index directory and stores it there; returns its tree.json ------###
+    #### ------- (unchanged when a tree with the same model and prompts is already there, unless `force`) ------###
+    summary_dir = os.path.join(directory, SUMMARY_DIR)
+    tree_path = os.path.join(summary_dir, TREE_FILE)
+    if os.path.exists(tree_path) and not force:
+        with open(tree_path, 'r', encoding=config.ENCODING) as f:
+            tree = json.load(f)
+        if tree["model"] == model and tree["prompt_version"] == PROMPT_VERSION:
+            return tree
+    texts, nodes, tree = summarize(chunks, metadatas, client, model)
+    save(summary_dir, texts, nodes, tree)
+    return tree
+
+
+## ------------------ Query time: the summaries a broad question is answered from --------------###
+
+class SummaryIndex:
+    #### --------- The summary tree of one index, searched like the chunks (vectors + BM25, fused) ------###
+
+    def __init__(self, store, tree):
+        self.store = store
+        self.tree = tree
+        levels = np.array([metadata["level"] for metadata in store.metadatas])
+        self.document = int(np.flatnonzero(levels == levels.max())[0])
+        # The first level of combined summaries (a few chunks each): the parts a "section" question picks from
+        self.sections = np.flatnonzero(levels == (1 if levels.max() >= 2 else 0))
+        texts = [store.texts[row] for row in self.sections]
+        self.lexical = lexical.BM25Index.build(texts, [store.metadatas[row] for row in self.sections])
+
+    @classmethod
+    def load(cls, directory):
+        #### ------- The tree stored in an index directory, or None if it has none (or an incomplete one) -------###
+        summary_dir = os.path.join(directory, SUMMARY_DIR)
+        try:
+            with open(os.path.join(summary_dir, TREE_FILE), 'r', encoding=config.ENCODING) as f:
+                tree = json.load(f)
+        except FileNotFoundError:
+            return None
+        if tree.get("embedding_model") != embeddings.get_embeddings().model:
+            return None
+        return cls(vector_store.NumpyVectorStore.load(summary_dir, embeddings.get_embeddings()), tree)
+
+    def document_summary(self):
+        return vector_store.Document(self.store.texts[self.document], self.store.metadatas[self.document])
+
+    def section_summaries(self, question, vector=None, n=config.SUMMARY_TOP_SECTIONS):
+        #### ------- The n section summaries closest to the question, best first -------###
+        rankings = []
+        k = lexical.candidates(n)
+        if vector is not None and config.RETRIEVAL_MODE != "lexical":
+            mask = np.zeros(len(self.store), dtype=bool)
+            mask[self.sections] = True
+            rows, _ = self.store.top_k(vector, k, mask)
+            rankings.append([int(row) for row in rows])
+        rows, _ = self.lexical.top_k(question, k)
+        rankings.append([int(self.sections[row]) for row in rows])
+        return [vector_store.Document(self.store.texts[row], self.store.metadatas[row])
+                for row in lexical.reciprocal_rank_fusion(rankings, n)]
+
+    def retrieve(self, question, vector=None, level=None):
+        #### ------- Summaries for a question routed to `level` ("document" or "section") -------###
+        level = level or route(question)
+        metrics.inc("rag_summary_routes_total", level=level)
+        if level == "document":
+            return [self.document_summary()]
+        return self.section_summaries(question, vector)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the summary tree of a document's index "
+                                                 "(LLM calls, once per document version).")
+    parser.add_argument("--document", default=config.DOCUMENT_PATH)
+    parser.add_argument("--model", default=config.SUMMARY_MODEL)
+    parser.add_argument("--force", action="store_true", help="build even if the index already has a tree")
+    parser.add_argument("--route", metavar="QUESTION", help="only print the level a question is routed to")
+    args = parser.parse_args()
+
+    if args.route is not None:
+        print(route(args.route) or "chunks")
+        return
+    import llm
+    index = llm.DocumentIndex(args.document)
+    index.load()
+    directory = os.path.join(index.index_dir, index.key)
+    chunks, metadatas = llm.chunk_document(args.document)
+    try:
+        tree = build(directory, chunks, metadatas, model=args.model, force=args.force)
+    except Exception as e:
+        sys.exit(f"Could not build the summaries: {type(e).__name__}: {e}")
+    print(f"{directory}: {' -> '.join(str(count) for count in tree['levels'])} summaries, "
+          f"{tree['calls']} LLM calls, {tree['prompt_tokens']} prompt tokens, {tree['seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,135 @@
-import openai 
-import tiktoken
-import os 
+import io
+import re
+import itertools
+import threading
+import os
 import config
+from collections import namedtuple
 
 
 ## ------------------Chunking the Document --------------###
 
+# A chunk of text with its [start, end) character offsets in the source document
+Chunk = namedtuple("Chunk", ["text", "start", "end"])
+
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(name=config.EMBEDDING_TYPE):
+    #### ------- Process-wide tiktoken encoder, imported and loaded on first use (the BPE ranks take a while) -------###
+    encoding = _encodings.get(name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(name)
+            if encoding is None:
+                import tiktoken
+                encoding = _encodings[name] = tiktoken.get_encoding(name)
+    return encoding
+
+
 class TextTokenizer:
     def __init__(self, encoding=config.EMBEDDING_TYPE):
         self.encoding = encoding
-        self.tt_encoding = tiktoken.get_encoding(encoding)
-    
+
+    @property
+    def tt_encoding(self):
+        return get_encoding(self.encoding)
+
     def read_file(self,fname):
         with open(fname, 'r', encoding=config.ENCODING) as f:
             file_text = f.read()
         return file_text
-    
+
     def count_tokens(self, text):
         tokens = self.tt_encoding.encode(text)
         return len(tokens)
-    
-    def creat_chunks(self, text, max_tokens):
-        chunks = []
-        current_chunk = ""
-        current_chunk_tokens = 0
-        
-        sentences = text.split(".")
-        for sentence in sentences:
-            sentence_tokens = self.count_tokens(sentence)
-            
-            # Si l'ajout de la phrase donne as exces de tokens ----> on la rajoute  
-            if current_chunk_tokens + sentence_tokens <= max_tokens:
-                current_chunk += sentence + "."
-                current_chunk_tokens += sentence_tokens
-
-            # Sinon on cree un noveau chunk avec la phrase en cours
-            else:
-                chunks.append(current_chunk)
-                current_chunk = sentence + "."
-                current_chunk_tokens = sentence_tokens
-        
-        if current_chunk:
-            chunks.append(current_chunk)
-        
-        return chunks
 
+    def _decode(self, tokens, errors="replace"):
+        return self.tt_encoding.decode_bytes(tokens).decode(config.ENCODING, errors=errors)
+
+    def _clean_cut(self, tokens, end):
+        #### ------- Moves `end` to the nearest cut where tokens[:end] decodes to whole characters -------###
+        # A multi-byte character can be split across up to 4 tokens; never cut between them
+        for cut in itertools.chain(range(end, 0, -1), range(end + 1, len(tokens) + 1)):
+            try:
+                self._decode(tokens[:cut], errors="strict")
+                return cut
+            except UnicodeDecodeError:
+                pass
+        return end
+
+    @staticmethod
+    def _last_word_boundary(text):
+        #### ------- Offset where the trailing (possibly unfinished) word and the whitespace before it start -------###
+        i = len(text) - 1
+        while i >= 0 and not text[i].isspace():
+            i -= 1
+        while i >= 0 and text[i].isspace():
+            i -= 1
+        return i + 1
+
+    def iter_chunks(self, stream, max_tokens=config.MAX_TOKENS, overlap=config.CHUNK_OVERLAP,
+                    block_size=config.CHUNK_BLOCK_SIZE):
+        #### ------- Yields Chunk(text, start, end) of at most max_tokens tokens from a text stream -------###
+        # The stream is read block by block and each block is encoded once; only the tokens of the
+        # chunk in progress are kept between blocks, so memory does not grow with the document size.
+        if not 0 <= overlap < max_tokens:
+            raise ValueError("overlap must be between 0 and max_tokens - 1")
+
+        pending = []        # tokens not emitted yet, starting with the overlap of the previous chunk
+        covered = 0         # how many leading pending tokens were already part of an emitted chunk
+        pending_start = 0   # character offset of pending[0] in the document
+        carry = ""          # text read but not encoded yet (the trailing, possibly unfinished word)
+        eof = False
+
+        while not eof:
+            block = stream.read(block_size)
+            eof = not block
+            text = carry + block
+            carry = ""
+            if not eof:
+                # Stop before the last word so no word is split between two encode calls
+                cut = self._last_word_boundary(text)
+                if cut == 0 and len(text) < 4 * block_size:
+                    carry = text
+                    continue
+                if cut > 0:
+                    text, carry = text[:cut], text[cut:]
+            pending.extend(self.tt_encoding.encode(text))
+
+            # Emit every full chunk; at the end of the stream also flush the remaining tail
+            head = 0
+            while len(pending) - head > max_tokens or (eof and len(pending) - head > covered):
+                window = pending[head:head + max_tokens]
+                end = self._clean_cut(window, len(window))
+                chunk_text = self._decode(window[:end])
+                yield Chunk(chunk_text, pending_start, pending_start + len(chunk_text))
+
+                if head + end == len(pending):
+                    break
+                step = self._clean_cut(window, max(end - overlap, 1))
+                pending_start += len(self._decode(window[:step]))
+                head += step
+                covered = end - step
+            del pending[:head]
+
+    def iter_file_chunks(self, fname, max_tokens=config.MAX_TOKENS, overlap=config.CHUNK_OVERLAP):
+        #### ------- Streams the chunks of a file without loading it into memory -------###
+        with open(fname, 'r', encoding=config.ENCODING) as f:
+            yield from self.iter_chunks(f, max_tokens, overlap)
+
+    def creat_chunks(self, text, max_tokens, overlap=config.CHUNK_OVERLAP):
+        return [chunk.text for chunk in self.iter_chunks(io.StringIO(text), max_tokens, overlap)]
+
+    def split_questions(self, text, max_tokens=config.MAX_TOKENS):
+        #### ------- One entry per question: paragraphs if the text has blank lines, lines otherwise -------###
+        # A question longer than max_tokens is cut by the chunker, like a document
+        separator = r"\n\s*\n" if re.search(r"\n\s*\n", text.strip()) else r"\n"
+        questions = []
+        for block in re.split(separator, text):
+            block = " ".join(block.split())
+            if block:
+                questions.extend(chunk.text.strip() for chunk in self.iter_chunks(io.StringIO(block), max_tokens, 0))
+        return questions
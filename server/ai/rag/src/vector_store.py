@@ -0,0 +1,115 @@
+import os
+import json
+from collections.abc import Sequence
+
+import numpy as np
+
+import config
+
+
+## ------------------ In-process vector search over a contiguous float32 matrix --------------###
+
+class Document:
+    #### --------- Same shape as the langchain Document returned by Chroma: page_content + metadata ------###
+    __slots__ = ("page_content", "metadata")
+
+    def __init__(self, page_content, metadata=None):
+        self.page_content = page_content
+        self.metadata = metadata or {}
+
+    def __repr__(self):
+        return f"Document(page_content={self.page_content!r}, metadata={self.metadata!r})"
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class NumpyVectorStore:
+    #### --------- Pre-normalized embeddings in one matrix: top-k is a matrix-vector product + argpartition ------###
+    #### --------- Persisted as vectors.npy (memory-mapped on load) and chunks.json (texts + metadata) ------###
+
+    VECTORS_FILE = "vectors.npy"
+    CHUNKS_FILE = "chunks.json"
+
+    def __init__(self, texts, vectors, metadatas=None, embedding=None, persist_directory=None):
+        # Any sequence: a list, or the tables of a serving index mapped from disk (serving.StringTable)
+        self.texts = texts if isinstance(texts, Sequence) else list(texts)
+        if metadatas is None:
+            metadatas = [{} for _ in range(len(self.texts))]
+        self.metadatas = metadatas if isinstance(metadatas, Sequence) else list(metadatas)
+        self.vectors = vectors
+        self.embedding = embedding
+        self.persist_directory = persist_directory
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, persist_directory=None):
+        #### ------- Same signature as Chroma.from_texts -------###
+        texts = list(texts)
+        vectors = normalize_rows(embedding.embed_documents(texts)) if texts else np.zeros((0, 0), np.float32)
+        return cls(texts, vectors, metadatas, embedding, persist_directory)
+
+    def persist(self):
+        #### ------- Writes to temporary files first: readers may still have the previous matrix mapped -------###
+        os.makedirs(self.persist_directory, exist_ok=True)
+        vectors_path = os.path.join(self.persist_directory, self.VECTORS_FILE)
+        with open(vectors_path + ".tmp", 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.vectors, dtype=np.float32))
+        chunks_path = os.path.join(self.persist_directory, self.CHUNKS_FILE)
+        chunks = [{"text": text, "metadata": metadata} for text, metadata in zip(self.texts, self.metadatas)]
+        with open(chunks_path + ".tmp", 'w', encoding=config.ENCODING) as f:
+            json.dump(chunks, f, ensure_ascii=False)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(chunks_path + ".tmp", chunks_path)
+
+    @classmethod
+    def load(cls, persist_directory, embedding=None, mmap=True):
+        #### ------- Maps the matrix read-only from disk: pages are shared and loaded on demand -------###
+        vectors = np.load(os.path.join(persist_directory, cls.VECTORS_FILE), mmap_mode='r' if mmap else None)
+        with open(os.path.join(persist_directory, cls.CHUNKS_FILE), 'r', encoding=config.ENCODING) as f:
+            chunks = json.load(f)
+        return cls([chunk["text"] for chunk in chunks], vectors, [chunk["metadata"] for chunk in chunks],
+                   embedding, persist_directory)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def top_k(self, vector, k, mask=None, window=None):
+        #### ------- (row indices, cosine scores) of the k best rows, best first -------###
+        #### ------- `window=(start, stop)` restricts the search to a row range; `mask` (one flag per row of the ------###
+        #### ------- store, not of the window) filters the rows -------###
+        start, stop = window if window is not None else (0, len(self.texts))
+        if stop <= start or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = normalize_rows(vector)
+        scores = self.vectors[start:stop] @ query
+        if mask is not None:
+            mask = mask[start:stop]
+            scores = np.where(mask, scores, -np.inf)
+            k = min(k, int(np.count_nonzero(mask)))
+        k = min(k, len(scores))
+        if k < len(scores):
+            rows = np.argpartition(-scores, k - 1)[:k]
+        else:
+            rows = np.arange(len(scores))
+        rows = rows[np.argsort(-scores[rows], kind="stable")][:k]
+        return rows + start, scores[rows]
+
+    def _mask(self, filter):
+        if not filter:
+            return None
+        return np.array([all(metadata.get(key) == value for key, value in filter.items())
+                         for metadata in self.metadatas], dtype=bool)
+
+    def similarity_search_with_score_by_vector(self, vector, k=4, filter=None):
+        rows, scores = self.top_k(vector, k, self._mask(filter))
+        return [(Document(self.texts[row], self.metadatas[row]), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_by_vector(self, vector, k=4, filter=None):
+        return [document for document, _ in self.similarity_search_with_score_by_vector(vector, k, filter)]
+
+    def similarity_search(self, query, k=4, filter=None):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k, filter)
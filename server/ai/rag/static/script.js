@@ -1,29 +1,54 @@
 function sendQuery() {
     const query = document.getElementById('queryInput').value;
     showQuery(query);
-    document.getElementById('queryInput').value = ""; 
+    document.getElementById('queryInput').value = "";
+
 
-    
     const typingIndicator = document.createElement('div');
     typingIndicator.className = "typingIndicator";
     typingIndicator.textContent = '.';
     responseDiv.appendChild(typingIndicator);
-    
+
     const typingInterval = setInterval(() => {
         typingIndicator.textContent += '.';
         if (typingIndicator.textContent.length > 3) typingIndicator.textContent = '.';
     }, 500)
-    
-    fetch(`http://127.0.0.1:8000/query?query=${query}`)
-        .then(response => response.json())
-        .then(data => {
-            console.log("Data:", data);
-        
-            clearInterval(typingInterval);
-            responseDiv.removeChild(typingIndicator);
-
-            showResponse(data.response)}) 
-        .catch(error => console.error('An error occurred:', error));
+
+    function stopTyping() {
+        clearInterval(typingInterval);
+        if (typingIndicator.parentNode) responseDiv.removeChild(typingIndicator);
+    }
+
+    // The answer is streamed as Server-Sent Events: "sources" first, then one "token" event per piece of text
+    const source = new EventSource(`http://127.0.0.1:8000/query/stream?query=${encodeURIComponent(query)}`);
+    let answerDiv = null;
+
+    source.addEventListener('sources', event => {
+        showSources(JSON.parse(event.data));
+    });
+
+    source.addEventListener('token', event => {
+        if (!answerDiv) {
+            stopTyping();
+            answerDiv = startResponse();
+        }
+        answerDiv.textContent += JSON.parse(event.data);
+        responseDiv.scrollTop = responseDiv.scrollHeight;
+    });
+
+    source.addEventListener('done', () => {
+        source.close();
+        stopTyping();
+        showFollowUp();
+    });
+
+    source.addEventListener('error', event => {
+        source.close();
+        stopTyping();
+        const detail = event.data ? JSON.parse(event.data).detail : 'connection lost';
+        console.error('An error occurred:', detail);
+        if (!answerDiv) startResponse().textContent = "Sorry, something went wrong. Please try again.";
+    });
 }
 
 function showQuery(query) {
@@ -35,18 +60,39 @@ function showQuery(query) {
     responseDiv.scrollTop = responseDiv.scrollHeight;
   }
 
-function showResponse(response) {
+function showSources(sources) {
+    const responseDiv = document.getElementById('responseDiv');
+    const sourcesDiv = document.createElement('details');
+    sourcesDiv.className = 'sources';
+
+    const summary = document.createElement('summary');
+    summary.textContent = `${sources.length} source passage(s)`;
+    sourcesDiv.appendChild(summary);
+
+    sources.forEach(source => {
+        const passage = document.createElement('p');
+        passage.textContent = source.content;
+        sourcesDiv.appendChild(passage);
+    });
+
+    responseDiv.appendChild(sourcesDiv);
+    responseDiv.scrollTop = responseDiv.scrollHeight;
+}
+
+function startResponse() {
     const responseDiv = document.getElementById('responseDiv');
     const responseDivMessage = document.createElement('div');
     responseDivMessage.className = 'botMessage';
-    responseDivMessage.textContent = response.result;
     responseDiv.appendChild(responseDivMessage);
+    return responseDivMessage;
+}
 
-    
+function showFollowUp() {
+    const responseDiv = document.getElementById('responseDiv');
     const followUpDiv = document.createElement('div');
     followUpDiv.className = "botMessage";
     followUpDiv.textContent = "I hope I answered your question. Do you need any more help?";
     responseDiv.appendChild(followUpDiv);
 
-    responseDiv.scrollTop = responseDiv.scrollHeight; 
+    responseDiv.scrollTop = responseDiv.scrollHeight;
 }